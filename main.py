@@ -1,26 +1,402 @@
 """ Run the London Cycle ML Pipeline. """
 
+import argparse
+import importlib
 import os
+import sys
+import threading
+import time
+from contextlib import nullcontext
+from src.helper.artifact_store import ArtifactStore
 from src.helper.dir_creation import DirCreator
+from src.helper.info_tracking import InfoTracker
 from src.model_development.config_loading import Config
-from src.model_development.data_1preview import DataPreviewer
+
+
+# Pipeline stages in execution order. Stage modules are imported only when the stage runs,
+# so heavy dependencies (geopandas, plotly, ydata_profiling, h2o) are not loaded by lightweight runs.
+STAGES = {
+    "preview": ("src.model_development.data_1preview", "DataPreviewer"),
+    "quality": ("src.model_development.data_quality", "DataQualityChecker"),
+    "durations": ("src.model_development.duration_quality", "DurationQualityChecker"),
+    "preprocess": ("src.model_development.data_2preprocessing", "DataPreprocessor"),
+    "aggregate": ("src.model_development.data_aggregation", "DataAggregator"),
+    "explore": ("src.model_development.data_3exploration", "DataExplorer"),
+    "profiles": ("src.model_development.usage_profiles", "StationUsageProfiler"),
+    "od_flows": ("src.model_development.od_flows", "ODFlowBuilder"),
+    "rebalancing": ("src.model_development.bike_rebalancing", "BikeRebalancingAnalyser"),
+    "anomalies": ("src.model_development.demand_anomalies", "DemandAnomalyDetector"),
+    "engineer": ("src.model_development.data_engineering", "DataEngineer"),
+    "model": ("src.model_development.model_development", "ModelBuilderTrainerTester"),
+    "plan": ("src.model_development.rebalancing_planner", "RebalancingPlanner"),
+    "stream": ("src.streaming.demand_monitor", "StreamingDemandMonitor"),
+}
+DEFAULT_STAGES = ["preview", "quality", "preprocess", "aggregate", "explore", "engineer"]
+# The 'model' stage runs these classes instead of H2O AutoML, in the fast search mode and the incremental training mode
+FAST_MODEL_STAGE = ("src.model_development.fast_model_search", "FastModelSearch")
+INCREMENTAL_MODEL_STAGE = ("src.model_development.incremental_training", "IncrementalModelTrainer")
+# Stages using process-wide state (pyplot and ydata_profiling, the H2O cluster, the feed socket), run one at a time in a batch
+SERIAL_STAGES = ("engineer", "model", "stream")
 
 
 class LondonCyclePipelineRunner:
-    """ Run the London Cycle ML Pipeline. """
+    """
+    Run the London Cycle ML Pipeline.
+
+    :param config_path: The path of the config yaml file.
+    :param stages: The names of the stages to run. They always run in pipeline order. All stages but modelling run by default.
+    :param query_cache: A QueryResultCache shared with other runs, so identical read-only queries are run once. Used by the batch runner.
+    :param stage_lock: A lock shared with other runs, held while a stage of SERIAL_STAGES runs. Used by the batch runner.
+    :param stage_timings: The dict the duration of each stage is written to, also when a stage fails. A new dict by default.
+    :param output_subdir: The subdirectory of every created path that the run writes to, so runs sharing a config layout
+                          do not overwrite each other's files. Used by the batch runner.
+    """
 
-    def __init__(self, config_path):
+    def __init__(self, config_path, stages=None, query_cache=None, stage_lock=None, stage_timings=None, output_subdir=None):
+        self.__query_cache = query_cache
+        self.__stage_lock = stage_lock
+        self.stage_timings = {} if stage_timings is None else stage_timings
         self.config = Config(config_path=config_path)
+        if output_subdir is not None:
+            for name, path in vars(self.config.paths2create).items():
+                setattr(self.config.paths2create, name, os.path.join(path, output_subdir))
         DirCreator(config=self.config)
-        self.run = DataPreviewer(config=self.config)\
-            .preprocess_data()\
-            .explore_data()\
-            .prepare_data_for_modelling()\
+
+        self.stages = [name for name in STAGES if name in (stages or DEFAULT_STAGES)]
+        self.info_tracker = InfoTracker()
+        self.info_tracker.attach_artifact_store(ArtifactStore(
+            directory=self.config.paths2create.artifacts,
+            spill_threshold_bytes=int(self.config.artifacts.spill_threshold_mb * 2 ** 20)
+        ))
+        self.stage_results = {}
+        self.__gcp_client = None
+
+        # The configured steps are profiled, before the prefetched jobs start
+        self.profiler = None
+        if self.config.profiling.enabled:
+            from src.helper.profiling import StepProfiler
+            self.profiler = StepProfiler(settings=self.config.profiling, directory=self.config.paths2create.profiling)
+
+        # Dependency-free warehouse jobs of later stages start now, and overlap with the earlier stages
+        self.prefetcher = None
+        if self.config.scheduling.prefetch:
+            from src.helper.prefetching import QueryPrefetcher
+            self.prefetcher = QueryPrefetcher(max_workers=self.config.scheduling.prefetch_workers)
+            self.__submit_prefetch_jobs()
+
+        try:
+            for name in self.stages:
+                self.stage_results[name] = self.__run_timed_stage(name=name)
+                # The spilled dataframes read by the stage go back to disk, with the changes made to them
+                self.info_tracker.spill_loaded()
+        finally:
+            if self.prefetcher is not None:
+                self.prefetcher.shutdown()
+            if self.__gcp_client is not None:
+                self.info_tracker.bigquery_job_metrics = self.__gcp_client.metrics.to_frame()
+            if self.profiler is not None:
+                self.info_tracker.profiling_summary = self.profiler.summary_frame()
+
+        # Keep the last stage as the run result
+        self.run = self.stage_results[self.stages[-1]] if self.stages else None
+
+    @property
+    def gcp_client(self):
+        """
+        The bigquery client is created on first use, so stages that do not query GCP do not pay for it.
+        It is shared by the stages and the prefetcher threads, with a connection pool, retries and job timeouts.
+        In a batch, the read-only queries also go through the result cache of the batch.
+        """
+        if self.__gcp_client is None:
+            from src.helper.gcp_client import GcpClientCreator
+            self.__gcp_client = GcpClientCreator.shared_bigquery_client(config=self.config)
+            if self.__query_cache is not None:
+                from src.helper.batch_resources import CachingBigQueryClient
+                self.__gcp_client = CachingBigQueryClient(client=self.__gcp_client, cache=self.__query_cache)
+        return self.__gcp_client
+
+    def __import_stage(self, name: str):
+        """ Import the class of a stage. With profiling enabled, its configured methods are profiled. """
+        module_name, class_name = STAGES[name]
+        if name == "model" and self.config.modelling.training_mode == "incremental":
+            module_name, class_name = INCREMENTAL_MODEL_STAGE
+        elif name == "model" and self.config.modelling.search_mode == "fast":
+            module_name, class_name = FAST_MODEL_STAGE
+        stage_class = getattr(importlib.import_module(module_name), class_name)
+        if self.profiler is not None:
+            stage_class = self.profiler.instrument(stage=name, stage_class=stage_class)
+        return stage_class
+
+    def __submit_prefetch_jobs(self):
+        """ Submit the jobs that the selected stages can start in advance. The modelling stage does not query GCP, so it is skipped. """
+
+        for name in self.stages:
+            if name == "model":
+                continue
+            stage_class = self.__import_stage(name=name)
+            if hasattr(stage_class, "prefetch_jobs"):
+                for job_name, job in stage_class.prefetch_jobs(config=self.config).items():
+                    self.prefetcher.submit(job_name, job, self.gcp_client)
+
+    def __run_timed_stage(self, name: str):
+        """ Run a stage and record its duration. A serial stage first waits for the stage lock, and the wait is recorded apart. """
+
+        timing = self.stage_timings[name] = {"secs": None, "wait_secs": 0.0, "status": "running"}
+        serial = self.__stage_lock is not None and name in SERIAL_STAGES
+        started = time.perf_counter()
+        if serial:
+            self.__stage_lock.acquire()
+            timing["wait_secs"] = round(time.perf_counter() - started, 3)
+            started = time.perf_counter()
+        try:
+            profiled = self.profiler is not None and self.profiler.profiles(step=name)
+            with self.profiler.profile(step=name) if profiled else nullcontext():
+                result = self.__run_stage(name=name)
+            timing["status"] = "done"
+            return result
+        except BaseException:
+            timing["status"] = "failed"
+            raise
+        finally:
+            timing["secs"] = round(time.perf_counter() - started, 3)
+            if serial:
+                self.__stage_lock.release()
+
+    def __run_stage(self, name: str):
+        """ Import the stage class and run it. """
+
+        stage_class = self.__import_stage(name=name)
+
+        # The modelling stage consumes the data created by the data engineering stage
+        if name == "model":
+            if "engineer" not in self.stage_results:
+                raise ValueError("The 'model' stage requires the 'engineer' stage to run in the same pipeline.")
+            return stage_class(
+                config=self.config,
+                info_tracker=self.info_tracker,
+                data=self.stage_results["engineer"].data_for_modelling
+            )
+
+        # Stages with prefetchable jobs receive the prefetcher, to take their results
+        if self.prefetcher is not None and hasattr(stage_class, "prefetch_jobs"):
+            return stage_class(
+                config=self.config,
+                info_tracker=self.info_tracker,
+                gcp_client=self.gcp_client,
+                prefetcher=self.prefetcher
+            )
+
+        return stage_class(
+            config=self.config,
+            info_tracker=self.info_tracker,
+            gcp_client=self.gcp_client
+        )
+
+
+class LondonCycleBatchRunner:
+    """
+    Run the pipeline for many configs (e.g. other hire tables, date windows or station sets) in one process.
+        1. The runs share the pooled bigquery client of their credentials, which is authenticated once,
+           and the stage modules, which are imported once.
+        2. The runs share a result cache, so a read-only query issued by several runs (e.g. the cycle stations table) is run once.
+           The cache is bounded by query_cache_mb. Each run records the bigquery jobs it starts in its own job metrics.
+        3. The London geodata is read once and shared by the runs.
+        4. The runs are scheduled on a pool of max_workers threads. The stages mostly wait for BigQuery, so they overlap well.
+           The stages in SERIAL_STAGES use process-wide state, and run one at a time.
+        5. Every run writes to its own subdirectory of the created paths, named after the stem of its config file,
+           so runs of config copies (e.g. with another hire table) do not overwrite each other's files.
+        6. A failed run does not stop the others. Its error is reported with the timings.
+    The timings of every stage of every run, and the total of every run, are saved in the timings dataframe.
+
+    :param config_paths: The paths of the config yaml files.
+    :param stages: The names of the stages to run for every config.
+    :param max_workers: The maximum number of runs at the same time.
+    :param query_cache_mb: The maximum memory of the cached query results. The least recently read results are evicted first.
+    """
+
+    def __init__(self, config_paths, stages=None, max_workers: int = 4, query_cache_mb: float = 1024):
+        from concurrent.futures import ThreadPoolExecutor
+        from src.helper.batch_resources import QueryResultCache
+
+        self.config_paths = list(config_paths)
+        if len(set(self.config_paths)) != len(self.config_paths):
+            raise ValueError("Every config of a batch must be given once.")
+        self.output_subdirs = {config_path: os.path.splitext(os.path.basename(config_path))[0] for config_path in self.config_paths}
+        if len(set(self.output_subdirs.values())) != len(self.config_paths):
+            raise ValueError("The config files of a batch must have different names, as every run writes to the subdirectory of its config name.")
+        self.query_cache = QueryResultCache(max_bytes=int(query_cache_mb * 2 ** 20))
+        self.__stage_lock = threading.Lock()
+        self.runs = {}
+        self.errors = {}
+        self.__stage_timings = {config_path: {} for config_path in self.config_paths}
+        self.__total_secs = {}
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="batch") as executor:
+            futures = {config_path: executor.submit(self.__run, config_path, stages) for config_path in self.config_paths}
+        for config_path, future in futures.items():
+            try:
+                self.runs[config_path] = future.result()
+            except Exception as error:
+                self.errors[config_path] = error
+        self.total_secs = round(time.perf_counter() - started, 3)
+
+        self.timings = self.__timings_frame()
+
+    def __run(self, config_path, stages):
+        """ Run the pipeline of a config, and record its total duration. """
+
+        started = time.perf_counter()
+        try:
+            return LondonCyclePipelineRunner(
+                config_path=config_path,
+                stages=stages,
+                query_cache=self.query_cache,
+                stage_lock=self.__stage_lock,
+                stage_timings=self.__stage_timings[config_path],
+                output_subdir=self.output_subdirs[config_path]
+            )
+        finally:
+            self.__total_secs[config_path] = round(time.perf_counter() - started, 3)
+
+    def __timings_frame(self):
+        """ One row per stage of every run, and a 'total' row per run with its status and error. """
+
+        import pandas as pd
+
+        rows = []
+        for config_path in self.config_paths:
+            for stage, timing in self.__stage_timings[config_path].items():
+                rows.append({"config": config_path, "stage": stage, **timing, "error": None})
+            error = self.errors.get(config_path)
+            rows.append({
+                "config": config_path,
+                "stage": "total",
+                "secs": self.__total_secs.get(config_path),
+                "wait_secs": round(sum(timing["wait_secs"] for timing in self.__stage_timings[config_path].values()), 3),
+                "status": "failed" if error is not None else "done",
+                "error": repr(error) if error is not None else None,
+            })
+        return pd.DataFrame(rows, columns=["config", "stage", "secs", "wait_secs", "status", "error"])
+
+    def __str__(self):
+        return (
+            f"{self.timings.to_string(index=False)}\n"
+            f"Batch of {len(self.config_paths)} configs in {self.total_secs} s, {len(self.errors)} failed. "
+            f"Query cache: {self.query_cache.misses} queries run, {self.query_cache.hits} served from the cache, "
+            f"{self.query_cache.evictions} results evicted."
+        )
+
+
+def parse_args(argv=None):
+    """ Parse the command line arguments of the pipeline. """
+
+    parser = argparse.ArgumentParser(description="Run the London Cycle ML Pipeline.")
+    parser.add_argument(
+        "--config",
+        default=os.path.join("src", "config", "config.yaml"),
+        help="Path of the config yaml file."
+    )
+    parser.add_argument(
+        "--configs",
+        nargs="+",
+        default=None,
+        help="Paths of several config yaml files, run as a batch that shares the bigquery client, the query results and the geodata."
+    )
+    parser.add_argument(
+        "--batch-workers",
+        type=int,
+        default=4,
+        help="The maximum number of configs of a batch running at the same time."
+    )
+    parser.add_argument(
+        "--batch-cache-mb",
+        type=float,
+        default=1024,
+        help="The maximum memory of the query results cached for the configs of a batch."
+    )
+    parser.add_argument(
+        "--stages",
+        nargs="+",
+        choices=list(STAGES),
+        default=DEFAULT_STAGES,
+        help="Stages to run. They always run in pipeline order."
+    )
+    parser.add_argument(
+        "--import-time",
+        action="store_true",
+        help="Benchmark the import time of the pipeline entry point with -X importtime and exit."
+    )
+    parser.add_argument(
+        "--import-time-budget-ms",
+        type=float,
+        default=None,
+        help="Exit with an error when the import time of the entry point exceeds this budget."
+    )
+    parser.add_argument(
+        "--serve",
+        action="store_true",
+        help="Serve the precomputed aggregates over HTTP instead of running the pipeline."
+    )
+    parser.add_argument(
+        "--replay-feed",
+        action="store_true",
+        help="Serve the rental event replay file as a socket feed for the 'stream' stage, instead of running the pipeline."
+    )
+    return parser.parse_args(argv)
 
 
 if __name__ == "__main__":
-   
-    CONFIG_PATH = os.path.join("src", "config", "config.yaml")
-    run = LondonCyclePipelineRunner(config_path=CONFIG_PATH)
-    
-    print(run.run.info_tracker.__dict__)
+
+    args = parse_args()
+
+    if args.import_time:
+        from src.helper.import_timing import ImportTimeBenchmark
+        benchmark = ImportTimeBenchmark(module="main", cwd=os.path.dirname(os.path.abspath(__file__)))
+        print(benchmark.report())
+        if args.import_time_budget_ms is not None and benchmark.total_ms > args.import_time_budget_ms:
+            sys.exit(f"Import time {benchmark.total_ms:.1f} ms exceeds the budget of {args.import_time_budget_ms:.1f} ms.")
+        sys.exit(0)
+
+    if args.serve:
+        from src.serving.aggregate_store import AggregateQueryService
+        from src.serving.query_server import AggregateQueryServer
+        config = Config(config_path=args.config)
+        server = AggregateQueryServer(
+            service=AggregateQueryService(aggregates_dir=config.paths2create.aggregates),
+            host=config.serving.host,
+            port=config.serving.port,
+            max_age_secs=config.serving.max_age_secs
+        )
+        print(f"Serving the aggregates on http://{config.serving.host}:{config.serving.port}")
+        server.serve_forever()
+        sys.exit(0)
+
+    if args.replay_feed:
+        from src.streaming.demand_monitor import StreamingDemandMonitor
+        from src.streaming.event_sources import ReplayFeedServer, RentalEventReplay
+        config = Config(config_path=args.config)
+        replay = RentalEventReplay(path=os.path.join(config.paths2create.streaming, StreamingDemandMonitor.REPLAY_FILE))
+        if not replay.exists:
+            sys.exit("The replay file does not exist. Run the 'stream' stage with the 'file' source first to export it.")
+        server = ReplayFeedServer(
+            replay=replay,
+            host=config.streaming.host,
+            port=config.streaming.port,
+            batch_size=config.streaming.batch_size,
+            speedup=config.streaming.replay_speedup
+        )
+        print(f"Serving the rental event feed on {config.streaming.host}:{config.streaming.port}")
+        server.serve_forever()
+        sys.exit(0)
+
+    if args.configs:
+        batch = LondonCycleBatchRunner(
+            config_paths=args.configs, stages=args.stages, max_workers=args.batch_workers, query_cache_mb=args.batch_cache_mb
+        )
+        print(batch)
+        sys.exit(1 if batch.errors else 0)
+
+    run = LondonCyclePipelineRunner(config_path=args.config, stages=args.stages)
+
+    print(run.info_tracker)
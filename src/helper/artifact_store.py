@@ -0,0 +1,76 @@
+""" Spill large dataframes of the info tracker to Arrow IPC files and memory-map them on access. """
+
+import os
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class SpilledFrame:
+    """ A dataframe that was spilled to an Arrow IPC file. Only its summary is kept in memory. """
+    path: str
+    n_rows: int
+    columns: List[str]
+    nbytes: int
+
+    def load(self):
+        """ Memory-map the Arrow IPC file and convert it into a pandas dataframe. """
+        from pyarrow import feather
+        table = feather.read_table(self.path, memory_map=True)
+        return table.to_pandas(split_blocks=True)
+
+    def __repr__(self) -> str:
+        return f"<spilled {self.n_rows} rows x {len(self.columns)} columns, {self.nbytes / 2 ** 20:.1f} MiB, {self.path}>"
+
+
+class ArtifactStore:
+    """
+    Keep the dataframes of the info tracker out of memory once they are larger than a threshold.
+        1. A dataframe larger than spill_threshold_bytes is written to an uncompressed Arrow IPC file and replaced by a SpilledFrame.
+        2. On access, the file is memory-mapped, so the operating system pages in only what is read and can drop it afterwards.
+        3. Smaller dataframes and other objects are kept in memory.
+
+    The info tracker keeps a loaded dataframe until it is assigned again or spilled again with its changes.
+    A file is replaced by renaming a new file over it, so the dataframes still mapped from the previous file stay valid.
+
+    :param directory: The directory of the Arrow IPC files.
+    :param spill_threshold_bytes: The in-memory size above which a dataframe is spilled.
+    """
+
+    def __init__(self, directory: str, spill_threshold_bytes: int):
+        self.directory = directory
+        self.spill_threshold_bytes = spill_threshold_bytes
+        os.makedirs(directory, exist_ok=True)
+
+    def put(self, name: str, value):
+        """ Spill the value if it is a dataframe larger than the threshold. Return what the info tracker should keep. """
+
+        # Imported here, so the info tracker does not load pandas unless it stores a dataframe
+        import pandas as pd
+
+        if not isinstance(value, pd.DataFrame):
+            return value
+
+        nbytes = int(value.memory_usage(index=True, deep=True).sum())
+        if nbytes <= self.spill_threshold_bytes:
+            return value
+
+        from pyarrow import feather
+        path = os.path.join(self.directory, f"{name}.arrow")
+        # Uncompressed files can be memory-mapped without decompressing them into memory
+        feather.write_feather(value, path + ".tmp", compression="uncompressed")
+        os.replace(path + ".tmp", path)
+        return SpilledFrame(path=path, n_rows=len(value), columns=[str(column) for column in value.columns], nbytes=nbytes)
+
+    @staticmethod
+    def describe(value) -> str:
+        """ Describe a value of the info tracker in one line, without printing its content. """
+
+        if value is None or isinstance(value, (bool, int, float, str)):
+            return repr(value)
+        if isinstance(value, SpilledFrame):
+            return repr(value)
+        if hasattr(value, "shape") and hasattr(value, "memory_usage"):
+            nbytes = int(value.memory_usage(index=True, deep=True).sum())
+            return f"<dataframe {value.shape[0]} rows x {value.shape[1]} columns, {nbytes / 2 ** 20:.1f} MiB>"
+        return f"<{type(value).__name__}>"
@@ -0,0 +1,198 @@
+""" Resources shared by the pipeline runs of a batch: a single-flight query result cache and the London geodata. """
+
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Callable, Dict, Optional
+from ..helper.gcp_client import BigQueryJobMetrics
+
+
+class QueryResultCache:
+    """
+    An in-memory cache of query results, shared by the pipeline runs of a batch.
+    A query is run once: a run asking for a query that another run is still waiting for waits for the same result.
+    Every run gets its own copy of the cached dataframe, so a stage modifying its copy does not affect the other runs.
+    The cached results are bounded by max_bytes: the least recently read results are evicted first,
+    and a result larger than the bound (e.g. the modelling extract) is handed to the runs waiting for it, but not kept.
+
+    :param max_bytes: The maximum memory of the cached results. Unbounded if None.
+    """
+
+    def __init__(self, max_bytes: Optional[int] = None):
+        self.max_bytes = max_bytes
+        self.__lock = threading.Lock()
+        self.__results: "OrderedDict[str, Future]" = OrderedDict()
+        # The memory of the finished results. The results still running are not in it, and are never evicted.
+        self.__sizes: Dict[str, int] = {}
+        self.cached_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def key(query: str, job_config=None) -> str:
+        """ The cache key of a query, including its job configuration (e.g. the query parameters). """
+        text = " ".join(query.split()) + "\x1f" + repr(job_config)
+        return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def size_of(result) -> int:
+        """ The memory of a result, with the strings of the object columns of a dataframe. """
+        if hasattr(result, "memory_usage"):
+            return int(result.memory_usage(index=True, deep=True).sum())
+        return 0
+
+    def get_or_run(self, key: str, run: Callable):
+        """
+        Return a copy of the cached result, or run the query once and cache its result. A failed query is not cached.
+        A run waiting for the query of another run that fails (e.g. a run cancelling its jobs after a failed stage) runs it once itself.
+        """
+
+        for attempt in range(2):
+            with self.__lock:
+                future = self.__results.get(key)
+                owner = future is None
+                if owner:
+                    future = self.__results[key] = Future()
+                    self.misses += 1
+                else:
+                    self.__results.move_to_end(key)
+                    self.hits += 1
+
+            if owner:
+                try:
+                    result = run()
+                except BaseException as error:
+                    with self.__lock:
+                        self.__results.pop(key, None)
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+                    self.__admit(key=key, size=self.size_of(result))
+
+            if owner or attempt == 1 or future.exception() is None:
+                return future.result().copy()
+
+    def __admit(self, key: str, size: int):
+        """ Account for a finished result, and evict the least recently read results above max_bytes. """
+
+        with self.__lock:
+            if self.max_bytes is not None and size > self.max_bytes:
+                self.__results.pop(key, None)
+                self.evictions += 1
+                return
+            self.__results.move_to_end(key)
+            self.__sizes[key] = size
+            self.cached_bytes += size
+            while self.max_bytes is not None and self.cached_bytes > self.max_bytes:
+                oldest = next(cached for cached in self.__results if cached in self.__sizes)
+                del self.__results[oldest]
+                self.cached_bytes -= self.__sizes.pop(oldest)
+                self.evictions += 1
+
+
+class CachedQueryResult:
+    """ The result of a query. to_dataframe is served from the cache, anything else (e.g. streaming pages) runs the query. """
+
+    def __init__(self, job, cache: QueryResultCache, key: str, args: tuple, kwargs: dict):
+        self.__job = job
+        self.__cache = cache
+        self.__key = key
+        self.__args = args
+        self.__kwargs = kwargs
+
+    def to_dataframe(self, *args, **kwargs):
+        return self.__cache.get_or_run(key=self.__key, run=lambda: self.__rows().to_dataframe(*args, **kwargs))
+
+    def __rows(self):
+        return self.__job().result(*self.__args, **self.__kwargs)
+
+    def __iter__(self):
+        return iter(self.__rows())
+
+    def __getattr__(self, name):
+        return getattr(self.__rows(), name)
+
+
+class CachedQueryJob:
+    """ A query job that is only started when its result is not cached, or when one of its job attributes is read. """
+
+    def __init__(self, client, cache: QueryResultCache, query: str, kwargs: dict):
+        self.__client = client
+        self.__cache = cache
+        self.__query = query
+        self.__kwargs = kwargs
+        self.__started_job = None
+        self.__lock = threading.Lock()
+
+    def __job(self):
+        with self.__lock:
+            if self.__started_job is None:
+                self.__started_job = self.__client.query(self.__query, **self.__kwargs)
+            return self.__started_job
+
+    def cancel(self) -> bool:
+        """ Cancel the job if it was started. A job served from the cache was never started, and there is nothing to cancel. """
+        with self.__lock:
+            job = self.__started_job
+        return job.cancel() if job is not None else False
+
+    def result(self, *args, **kwargs) -> CachedQueryResult:
+        key = self.__cache.key(query=self.__query, job_config=self.__kwargs.get("job_config"))
+        return CachedQueryResult(job=self.__job, cache=self.__cache, key=key, args=args, kwargs=kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.__job(), name)
+
+
+class CachingBigQueryClient:
+    """
+    A bigquery client whose read-only queries share a QueryResultCache.
+    Only SELECT and WITH queries are cached. Other statements and every other method go to the wrapped client.
+    The jobs started through this client are recorded in its own metrics, so each run of a batch reports its own jobs.
+    A query served from the cache starts no job, and is not recorded.
+
+    :param client: The bigquery client, e.g. the shared ManagedBigQueryClient.
+    :param cache: The result cache of the batch.
+    """
+
+    def __init__(self, client, cache: QueryResultCache):
+        self.client = client
+        self.cache = cache
+        self.metrics = BigQueryJobMetrics()
+
+    def query(self, query: str, **kwargs):
+        kwargs["run_metrics"] = self.metrics
+        if query.lstrip().upper().startswith(("SELECT", "WITH")):
+            return CachedQueryJob(client=self.client, cache=self.cache, query=query, kwargs=kwargs)
+        return self.client.query(query, **kwargs)
+
+    def load_table_from_file(self, file_obj, destination, **kwargs):
+        return self.client.load_table_from_file(file_obj, destination, run_metrics=self.metrics, **kwargs)
+
+    def load_table_from_dataframe(self, dataframe, destination, **kwargs):
+        return self.client.load_table_from_dataframe(dataframe, destination, run_metrics=self.metrics, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class SharedGeodata:
+    """ Load each geodata file once per process, so the runs of a batch share the same read-only GeoDataFrame. """
+
+    __frames: Dict[tuple, object] = {}
+    __lock = threading.Lock()
+
+    @classmethod
+    def read_file(cls, path: str):
+        """ Read the file with geopandas, or return the frame already read from the same unmodified file. """
+
+        key = (os.path.abspath(path), os.path.getmtime(path))
+        with cls.__lock:
+            if key not in cls.__frames:
+                # Imported here, so geopandas is only loaded when the geo data is needed
+                import geopandas as gpd
+                cls.__frames[key] = gpd.read_file(path)
+            return cls.__frames[key]
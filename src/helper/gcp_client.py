@@ -0,0 +1,198 @@
+""" Create the Google Cloud Platform clients used throughout the pipeline. """
+
+import dataclasses
+import os
+import threading
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from typing import Dict, List, Optional
+
+
+class BigQueryJobMetrics:
+    """ Thread-safe record of the jobs run through a ManagedBigQueryClient, one row per finished, failed or cancelled job. """
+
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__jobs: List[Dict] = []
+
+    def record(self, job, kind: str, status: str, wait_secs: float):
+        """ Record a job, with the statistics BigQuery reports for it. """
+
+        row = {
+            "job_id": getattr(job, "job_id", None),
+            "kind": kind,
+            "status": status,
+            "wait_secs": round(wait_secs, 3),
+            "total_bytes_processed": getattr(job, "total_bytes_processed", None),
+            "total_bytes_billed": getattr(job, "total_bytes_billed", None),
+            "slot_millis": getattr(job, "slot_millis", None),
+            "cache_hit": getattr(job, "cache_hit", None),
+            "thread": threading.current_thread().name,
+        }
+        with self.__lock:
+            self.__jobs.append(row)
+
+    def to_frame(self):
+        """ The recorded jobs as a dataframe. """
+        import pandas as pd
+        with self.__lock:
+            return pd.DataFrame(self.__jobs)
+
+    def summary(self) -> Dict:
+        """ The number of jobs per status, the total wait and the total bytes billed. """
+
+        with self.__lock:
+            jobs = list(self.__jobs)
+        summary = {"jobs": len(jobs)}
+        for status in ("done", "failed", "timed_out"):
+            summary[status] = sum(job["status"] == status for job in jobs)
+        summary["wait_secs"] = round(sum(job["wait_secs"] for job in jobs), 3)
+        summary["total_bytes_billed"] = sum(job["total_bytes_billed"] or 0 for job in jobs)
+        return summary
+
+
+class ManagedBigQueryJob:
+    """
+    A BigQuery job whose result is awaited with the client's retry policy and job timeout.
+    A job still running after the timeout is cancelled, and a TimeoutError is raised. Every other attribute is the job's own.
+    The job is recorded in the metrics of the client, and in the metrics of the run that started it, if given.
+    """
+
+    def __init__(self, job, kind: str, client: "ManagedBigQueryClient", run_metrics: Optional[BigQueryJobMetrics] = None):
+        self.__job = job
+        self.__kind = kind
+        self.__client = client
+        self.__run_metrics = run_metrics
+
+    def __record(self, status: str, wait_secs: float):
+        self.__client.metrics.record(job=self.__job, kind=self.__kind, status=status, wait_secs=wait_secs)
+        if self.__run_metrics is not None:
+            self.__run_metrics.record(job=self.__job, kind=self.__kind, status=status, wait_secs=wait_secs)
+
+    def result(self, *args, **kwargs):
+        """ Wait for the job and return its result, like the result method of the job. """
+
+        kwargs.setdefault("timeout", self.__client.job_timeout_secs)
+        kwargs.setdefault("retry", self.__client.retry)
+        if self.__kind == "query":
+            kwargs.setdefault("job_retry", self.__client.job_retry)
+
+        started = time.perf_counter()
+        try:
+            result = self.__job.result(*args, **kwargs)
+        except FutureTimeoutError:
+            self.__job.cancel()
+            self.__record(status="timed_out", wait_secs=time.perf_counter() - started)
+            raise TimeoutError(f"The {self.__kind} job {self.__job.job_id} did not finish in {kwargs['timeout']} seconds and was cancelled.")
+        except Exception:
+            self.__record(status="failed", wait_secs=time.perf_counter() - started)
+            raise
+        self.__record(status="done", wait_secs=time.perf_counter() - started)
+        return result
+
+    def __getattr__(self, name):
+        return getattr(self.__job, name)
+
+
+class ManagedBigQueryClient:
+    """
+    A bigquery client that can be shared by the stages and their threads.
+        1. The HTTP session keeps a connection pool of max_concurrency connections, instead of the default of 10,
+           so concurrent queries (e.g. prefetched jobs and stage threads) do not wait for a free connection.
+        2. The API calls and the query jobs are retried with exponential backoff on transient errors,
+           such as rate limits and backend errors, until the retry deadline.
+        3. Waiting for a job result is bounded by job_timeout_secs. A job that does not finish in time is cancelled.
+        4. Every query and load job is recorded in the job metrics, with the bytes billed and the slot time reported by BigQuery.
+           A run sharing the client (e.g. in a batch) also gives its own run_metrics, to record its jobs apart.
+    The other methods of the bigquery client (e.g. get_table, list_rows) are called on the wrapped client.
+
+    :param client: The bigquery client.
+    :param settings: The bigquery configuration, with the retry policy and the job timeout.
+    """
+
+    def __init__(self, client, settings):
+        from google.cloud.bigquery.retry import DEFAULT_JOB_RETRY, DEFAULT_RETRY
+
+        self.client = client
+        self.job_timeout_secs = settings.job_timeout_secs
+        self.retry = DEFAULT_RETRY.with_delay(
+            initial=settings.retry_initial_secs,
+            maximum=settings.retry_max_secs,
+            multiplier=settings.retry_multiplier
+        ).with_deadline(settings.retry_deadline_secs)
+        self.job_retry = DEFAULT_JOB_RETRY.with_delay(
+            initial=settings.retry_initial_secs,
+            maximum=settings.retry_max_secs,
+            multiplier=settings.retry_multiplier
+        ).with_deadline(settings.retry_deadline_secs)
+        self.metrics = BigQueryJobMetrics()
+
+    def query(self, query: str, run_metrics: Optional[BigQueryJobMetrics] = None, **kwargs) -> ManagedBigQueryJob:
+        """ Start a query job, retrying the request and the job on transient errors. """
+        kwargs.setdefault("retry", self.retry)
+        kwargs.setdefault("job_retry", self.job_retry)
+        return ManagedBigQueryJob(job=self.client.query(query, **kwargs), kind="query", client=self, run_metrics=run_metrics)
+
+    def load_table_from_file(self, file_obj, destination, run_metrics: Optional[BigQueryJobMetrics] = None, **kwargs) -> ManagedBigQueryJob:
+        """ Start a load job. The upload itself is resumable, so only the job result is retried. """
+        return ManagedBigQueryJob(
+            job=self.client.load_table_from_file(file_obj, destination, **kwargs), kind="load", client=self, run_metrics=run_metrics
+        )
+
+    def load_table_from_dataframe(self, dataframe, destination, run_metrics: Optional[BigQueryJobMetrics] = None, **kwargs) -> ManagedBigQueryJob:
+        """ Start a load job from a dataframe. """
+        return ManagedBigQueryJob(
+            job=self.client.load_table_from_dataframe(dataframe, destination, **kwargs), kind="load", client=self, run_metrics=run_metrics
+        )
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class GcpClientCreator:
+    """ Create the Google Cloud Platform clients used throughout the pipeline. """
+
+    __shared_clients: Dict[tuple, ManagedBigQueryClient] = {}
+    __shared_lock = threading.Lock()
+
+    @staticmethod
+    def create_bigquery_client(config):
+        """ Use my GCP credentials to initiate a bigquery client, with a connection pool, retries and job timeouts. """
+
+        # Imported here, so the google cloud libraries are only loaded when a client is needed
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import bigquery
+        from google.oauth2 import service_account
+        from requests.adapters import HTTPAdapter
+
+        # Define GCP credentials path
+        cred_path = os.path.join(
+            config.existing_paths.gcp_credential_dir,
+            config.existing_paths.gcp_credential_file
+        )
+
+        # Set up service account.
+        credentials = service_account.Credentials.from_service_account_file(
+            cred_path,
+            scopes=["https://www.googleapis.com/auth/cloud-platform"]
+        )
+
+        # Size the connection pool to the number of concurrent requests. The retries are handled by the client.
+        session = AuthorizedSession(credentials)
+        adapter = HTTPAdapter(pool_connections=config.bigquery.max_concurrency, pool_maxsize=config.bigquery.max_concurrency, max_retries=0)
+        session.mount("https://", adapter)
+
+        # Init client.
+        client = bigquery.Client(credentials=credentials, project=credentials.project_id, _http=session)
+
+        return ManagedBigQueryClient(client=client, settings=config.bigquery)
+
+    @classmethod
+    def shared_bigquery_client(cls, config) -> ManagedBigQueryClient:
+        """ Return the bigquery client of the given credentials and settings, creating it once per process. """
+
+        key = (config.existing_paths.gcp_credential_dir, config.existing_paths.gcp_credential_file, dataclasses.astuple(config.bigquery))
+        with cls.__shared_lock:
+            if key not in cls.__shared_clients:
+                cls.__shared_clients[key] = cls.create_bigquery_client(config=config)
+            return cls.__shared_clients[key]
@@ -0,0 +1,78 @@
+""" Measure the import time of a module, using the -X importtime option of the python interpreter. """
+
+import subprocess
+import sys
+from dataclasses import dataclass
+from typing import List
+
+
+@dataclass
+class ImportRecord:
+    """ The import time of a single module, as reported by -X importtime. Times are in microseconds. """
+    module: str
+    self_us: int
+    cumulative_us: int
+
+
+class ImportTimeBenchmark:
+    """
+    Import a module in a fresh interpreter with -X importtime and collect the import time of every imported module.
+        1. Run the import in a subprocess, so modules already imported in the current process do not hide their cost.
+        2. Parse the importtime report written to stderr.
+        3. Report the total import time and the slowest imports.
+
+    :param module: The module to be imported, e.g. "main".
+    :param cwd: The working directory of the subprocess. It should be the root directory of the project.
+    """
+
+    def __init__(self, module: str = "main", cwd: str = None):
+        self.module = module
+        self.cwd = cwd
+        self.records = self.__run_importtime()
+
+    def __run_importtime(self) -> List[ImportRecord]:
+        """ Import the module in a fresh interpreter and parse the importtime report. """
+
+        completed = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", f"import {self.module}"],
+            cwd=self.cwd,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+
+        # Report lines look like: "import time:       145 |        145 | module"
+        records = []
+        for line in completed.stderr.splitlines():
+            if not line.startswith("import time:"):
+                continue
+            fields = line[len("import time:"):].split("|")
+            if not fields[0].strip().isdigit():
+                # Skip the header line
+                continue
+            records.append(ImportRecord(
+                module=fields[2].strip(),
+                self_us=int(fields[0]),
+                cumulative_us=int(fields[1])
+            ))
+
+        return records
+
+    @property
+    def total_ms(self) -> float:
+        """ The cumulative import time of the benchmarked module in milliseconds. """
+        for record in reversed(self.records):
+            if record.module == self.module:
+                return record.cumulative_us / 1000
+        return sum(record.self_us for record in self.records) / 1000
+
+    def slowest_imports(self, n: int = 10) -> List[ImportRecord]:
+        """ Return the n imports with the highest self import time. """
+        return sorted(self.records, key=lambda record: record.self_us, reverse=True)[:n]
+
+    def report(self, n: int = 10) -> str:
+        """ Create a text report with the total import time and the n slowest imports. """
+        lines = [f"Import time of '{self.module}': {self.total_ms:.1f} ms"]
+        for record in self.slowest_imports(n=n):
+            lines.append(f"    {record.self_us / 1000:>9.1f} ms  {record.module}")
+        return "\n".join(lines)
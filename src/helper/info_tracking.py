@@ -1,8 +1,14 @@
 """ Object used to track and store useful information throughout the pipeline. """
 
+from __future__ import annotations
+import hashlib
 from dataclasses import dataclass
-from typing import Optional
-import pandas as pd
+from typing import Dict, Optional, TYPE_CHECKING
+from ..helper.artifact_store import ArtifactStore, SpilledFrame
+
+if TYPE_CHECKING:
+    # Only needed for the annotations, so importing the info tracker does not load pandas
+    import pandas as pd
 
 
 @dataclass
@@ -10,24 +16,122 @@ class InfoTracker:
     """ 
     Module used throughout the pipeline to track useful information.
     A number of info is used in later stages of the pipeline.
+    When an artifact store is attached, large dataframes are spilled to disk as soon as they are assigned
+    and memory-mapped when they are first read, so they do not stay in memory for the whole run.
+    A spilled dataframe is loaded once and the same frame is returned until the attribute is assigned again,
+    so changes made to it in place are kept. spill_loaded frees the loaded dataframes, and spills again only the ones that changed.
+    An assigned dataframe is spilled on assignment. A change made in place is detected with a fingerprint taken at load:
+    the shape, the columns and dtypes, and the hash of an evenly spaced sample of rows, so a change outside the sampled rows is not detected.
+    Dataframes that cannot be hashed, e.g. with dictionaries in their cells, are always spilled again.
     """
+    FINGERPRINT_SAMPLE_ROWS = 1000
+
     cycle_hire_preview: Optional[pd.DataFrame] = None
     cycle_stations_preview: Optional[pd.DataFrame] = None
+    cycle_hire_metadata: Optional[pd.DataFrame] = None
+    cycle_stations_metadata: Optional[pd.DataFrame] = None
     hires_null_values_count: Optional[pd.DataFrame] = None
     stations_null_values_count: Optional[pd.DataFrame] = None
+    hires_null_values_per_partition: Optional[pd.DataFrame] = None
+    hires_null_values_estimate: Optional[pd.DataFrame] = None
+    stations_null_values_estimate: Optional[pd.DataFrame] = None
+    duration_bounds_per_year: Optional[pd.DataFrame] = None
+    duration_bounds_per_station_year: Optional[pd.DataFrame] = None
+    station_year_hour_aggregate: Optional[pd.DataFrame] = None
+    route_year_aggregate: Optional[pd.DataFrame] = None
+    stations_per_year: Optional[pd.DataFrame] = None
     total_rides_n_duration_per_year: Optional[pd.DataFrame] = None
     busiest_starting_stations_in_rides: Optional[pd.DataFrame] = None
     least_busy_starting_stations_in_rides: Optional[pd.DataFrame] = None
     busiest_starting_stations_in_rides_per_year: Optional[pd.DataFrame] = None
     most_profitable_starting_station_per_year: Optional[pd.DataFrame] = None
+    duration_histogram: Optional[pd.DataFrame] = None
+    revenue_per_station_year_by_tariff: Optional[pd.DataFrame] = None
     top_destinations_of_all_time: Optional[pd.DataFrame] = None
     top_destinations_per_year: Optional[pd.DataFrame] = None
     most_popular_roots_of_all_time: Optional[pd.DataFrame] = None
     top_roots_per_year: Optional[pd.DataFrame] = None
+    top_roots_per_month: Optional[pd.DataFrame] = None
+    top_roots_per_borough: Optional[pd.DataFrame] = None
     daily_n_weekly_usage_pattern: Optional[pd.DataFrame] = None
+    station_usage_clusters: Optional[pd.DataFrame] = None
+    od_net_flows: Optional[pd.DataFrame] = None
+    rebalancing_flows_per_station_hour: Optional[pd.DataFrame] = None
+    rebalancing_moves: Optional[pd.DataFrame] = None
+    rebalancing_plan: Optional[pd.DataFrame] = None
+    rebalancing_plan_moves: Optional[pd.DataFrame] = None
+    bike_utilisation: Optional[pd.DataFrame] = None
     cycle_station_data_with_borough_names: Optional[pd.DataFrame] = None
     cycle_station_with_borough_names_preview: Optional[pd.DataFrame] = None
     total_duartion_per_borough: Optional[pd.DataFrame] = None
+    total_duration_per_borough_per_year: Optional[pd.DataFrame] = None
+    total_duration_per_borough_per_hour: Optional[pd.DataFrame] = None
+    demand_alerts: Optional[pd.DataFrame] = None
+    demand_anomalies: Optional[pd.DataFrame] = None
+    bigquery_job_metrics: Optional[pd.DataFrame] = None
+    profiling_summary: Optional[pd.DataFrame] = None
     h2o_leaderboard = None
     h2o_leaderboard_df: Optional[pd.DataFrame] = None
-                 
\ No newline at end of file
+    model_refreshes: Optional[pd.DataFrame] = None
+
+    def attach_artifact_store(self, store: ArtifactStore):
+        """ Spill the large dataframes to the given store, including the ones that are already tracked. """
+        object.__setattr__(self, "_artifact_store", store)
+        for name, value in list(vars(self).items()):
+            if not name.startswith("_"):
+                setattr(self, name, value)
+
+    def spill_loaded(self):
+        """ Spill the loaded dataframes that were changed in place again, and drop all the loaded dataframes from memory. """
+        fingerprints = self.__dict__.get("_loaded_fingerprints", {})
+        for name, frame in list(self.__dict__.get("_loaded_frames", {}).items()):
+            fingerprint = fingerprints.pop(name, None)
+            if fingerprint is None or fingerprint != self.__fingerprint(frame):
+                setattr(self, name, frame)
+            else:
+                del self.__dict__["_loaded_frames"][name]
+
+    @classmethod
+    def __fingerprint(cls, frame) -> Optional[tuple]:
+        """ A cheap fingerprint of a dataframe, or None if its values cannot be hashed. """
+
+        import numpy as np
+        import pandas as pd
+
+        rows = np.unique(np.linspace(0, len(frame) - 1, num=min(len(frame), cls.FINGERPRINT_SAMPLE_ROWS)).astype(np.int64))
+        try:
+            sample_hash = pd.util.hash_pandas_object(frame.iloc[rows], index=True).to_numpy().tobytes()
+        except TypeError:
+            return None
+        return frame.shape, tuple(map(str, frame.columns)), tuple(map(str, frame.dtypes)), hashlib.sha1(sample_hash).hexdigest()
+
+    def __setattr__(self, name, value):
+        store = self.__dict__.get("_artifact_store")
+        if store is not None and not name.startswith("_"):
+            self.__dict__.get("_loaded_frames", {}).pop(name, None)
+            self.__dict__.get("_loaded_fingerprints", {}).pop(name, None)
+            value = store.put(name=name, value=value)
+        object.__setattr__(self, name, value)
+
+    def __getattribute__(self, name):
+        value = object.__getattribute__(self, name)
+        if isinstance(value, SpilledFrame):
+            loaded_frames = object.__getattribute__(self, "__dict__").setdefault("_loaded_frames", {})
+            if name not in loaded_frames:
+                loaded_frames[name] = value.load()
+                fingerprints = object.__getattribute__(self, "__dict__").setdefault("_loaded_fingerprints", {})
+                fingerprints[name] = object.__getattribute__(self, "_InfoTracker__fingerprint")(loaded_frames[name])
+            return loaded_frames[name]
+        return value
+
+    def summary(self) -> Dict[str, str]:
+        """ Describe every tracked value in one line, without loading the spilled dataframes. """
+        return {
+            name: ArtifactStore.describe(value)
+            for name, value in vars(self).items()
+            if not name.startswith("_")
+        }
+
+    def __repr__(self) -> str:
+        lines = [f"    {name}: {description}" for name, description in self.summary().items()]
+        return "InfoTracker(\n" + "\n".join(lines) + "\n)"
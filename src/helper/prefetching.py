@@ -0,0 +1,79 @@
+""" Run dependency-free warehouse jobs in the background while earlier pipeline stages run. """
+
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+
+
+class JobTrackingClient:
+    """ A bigquery client that keeps the handles of the jobs started through it, so they can be cancelled. """
+
+    def __init__(self, client):
+        self.client = client
+        self.jobs: List = []
+        self.__lock = threading.Lock()
+
+    def query(self, *args, **kwargs):
+        job = self.client.query(*args, **kwargs)
+        with self.__lock:
+            self.jobs.append(job)
+        return job
+
+    def cancel(self):
+        """ Request the cancellation of the started jobs. Finished jobs are not affected. """
+        with self.__lock:
+            jobs = list(self.jobs)
+        for job in jobs:
+            try:
+                job.cancel()
+            except Exception:
+                # The job may have finished or failed meanwhile, which is as good as cancelled
+                pass
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+class QueryPrefetcher:
+    """
+    Submit long-running jobs at the start of the pipeline, and hand their results to the stages that consume them.
+    The jobs run in threads, as they mostly wait for the warehouse, so the earlier stages keep plotting and profiling meanwhile.
+    A result is handed over once: the consuming stage takes it, and the prefetcher drops its reference.
+    Each job queries through its own JobTrackingClient, so the warehouse jobs of the results not taken can be cancelled on shutdown.
+
+    :param max_workers: The maximum number of jobs running at the same time.
+    """
+
+    def __init__(self, max_workers: int = 2):
+        self.__executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="prefetch")
+        self.__futures: Dict[str, Future] = {}
+        self.__clients: Dict[str, JobTrackingClient] = {}
+
+    def submit(self, name: str, job: Callable, gcp_client):
+        """ Start a job in the background, under a name that the consuming stage looks up. The job is called with the bigquery client. """
+        if name in self.__futures:
+            raise ValueError(f"A job named '{name}' was already submitted.")
+        self.__clients[name] = JobTrackingClient(client=gcp_client)
+        self.__futures[name] = self.__executor.submit(job, self.__clients[name])
+
+    def has(self, name: str) -> bool:
+        """ Whether a job of the given name was submitted and not taken yet. """
+        return name in self.__futures
+
+    def take(self, name: str) -> Any:
+        """ Wait for the job of the given name and return its result. An exception of the job is raised here. """
+        self.__clients.pop(name)
+        return self.__futures.pop(name).result()
+
+    def shutdown(self):
+        """
+        Drop the jobs that were not taken, e.g. after a failed stage, without waiting for them.
+        The jobs that did not start are cancelled, and the warehouse jobs of the running ones are cancelled,
+        so their threads stop at the next wait for a result instead of downloading it.
+        """
+        for name, future in self.__futures.items():
+            if not future.cancel():
+                self.__clients[name].cancel()
+        self.__futures.clear()
+        self.__clients.clear()
+        self.__executor.shutdown(wait=False, cancel_futures=True)
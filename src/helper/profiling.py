@@ -0,0 +1,245 @@
+""" Opt-in profiling of pipeline steps: CPU stacks for flame graphs and allocation diffs, saved per step in the run directory. """
+
+import cProfile
+import inspect
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+from functools import wraps
+from typing import Dict, List
+
+
+class StackSampler:
+    """
+    Sample the Python stack of one thread at a fixed interval, from a background thread.
+    The stacks are counted as collapsed stacks ("outer;...;inner count"), the input format of flamegraph.pl and speedscope.
+    Each frame is labelled with its function and current line, so the hot lines of a function are told apart.
+    The sampling overhead does not depend on the number of calls, unlike cProfile.
+
+    :param thread_id: The ident of the sampled thread.
+    :param interval_secs: The time between two samples.
+    """
+
+    def __init__(self, thread_id: int, interval_secs: float):
+        self.thread_id = thread_id
+        self.interval_secs = interval_secs
+        self.stacks = Counter()
+        self.__stopped = threading.Event()
+        self.__thread = threading.Thread(target=self.__sample, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self.__thread.start()
+
+    def stop(self):
+        self.__stopped.set()
+        self.__thread.join()
+
+    def __sample(self):
+        while not self.__stopped.wait(self.interval_secs):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def write_collapsed(self, path: str):
+        with open(path, "w") as file:
+            for stack, count in self.stacks.most_common():
+                file.write(f"{stack} {count}\n")
+
+
+class StepProfiler:
+    """
+    Profile the configured steps of a pipeline run, and save the results per step in a directory of the run.
+        - A step is a stage (e.g. "preprocess") or a method of a stage class (e.g. "explore.__identify_daily_n_weekly_usage_pattern").
+        - The CPU is profiled by sampling the stacks of the step's thread (saved as collapsed stacks for flame graphs),
+          or with cProfile (saved as a .prof file for pstats, snakeviz or gprof2dot, and the top functions by cumulative time).
+        - The memory is traced with tracemalloc: the allocations that grew the most during the step are saved by line,
+          with the peak of the traced memory. tracemalloc traces the whole process: it is started by the first active step
+          and stopped by the last one, across all profilers of the process (e.g. the runs of a batch). The diffs of steps
+          running at the same time include each other's allocations, and their peak is not reported, as it cannot be told apart.
+        - Every profiled step adds a row to the summary, with its wall and CPU time, samples, peak and net allocations.
+    Nothing is hooked when profiling is disabled, so the pipeline runs as usual.
+
+    :param settings: The profiling configuration.
+    :param directory: The directory of the profiles. Every run gets its own subdirectory.
+    """
+
+    # The steps tracing memory in the process, over all the profilers. tracemalloc is started by the first and stopped by the last.
+    __tracing_lock = threading.Lock()
+    __tracing_steps = 0
+    # Whether a step started while others were tracing, since the peak was last reset
+    __tracing_overlapped = False
+    # Whether the profilers started tracemalloc, or found it started by someone else and leave it running
+    __tracing_started = False
+
+    def __init__(self, settings, directory: str):
+        self.settings = settings
+        self.run_directory = os.path.join(directory, datetime.now().strftime("%Y%m%d-%H%M%S-%f"))
+        os.makedirs(self.run_directory, exist_ok=True)
+        self.summary: List[Dict] = []
+        self.__lock = threading.Lock()
+        # A thread has one cProfile hook at a time, so a step nested in a step profiled by cProfile is covered by the outer profile
+        self.__cprofile_active = threading.local()
+
+    def profiles(self, step: str) -> bool:
+        """ Whether the given step is configured to be profiled. """
+        return step in self.settings.steps
+
+    def method_steps(self, stage: str) -> List[str]:
+        """ The configured methods of a stage. """
+        return [step.split(".", 1)[1] for step in self.settings.steps if step.startswith(stage + ".")]
+
+    def instrument(self, stage: str, stage_class):
+        """
+        Return a subclass of the stage class whose configured methods are profiled, or the stage class itself without any.
+        Private methods are given by their name in the class body (e.g. "__load_stations_data"), and are overridden by their mangled name.
+        The stage class itself is left unchanged, so other runs of the process are not profiled.
+        Methods called through the stage class name, instead of self or cls, bypass the subclass and are not profiled.
+        """
+
+        overrides = {}
+        for method in self.method_steps(stage=stage):
+            name = method
+            if method.startswith("__") and not method.endswith("__"):
+                name = next(
+                    (f"_{klass.__name__}{method}" for klass in stage_class.__mro__ if f"_{klass.__name__}{method}" in vars(klass)),
+                    method
+                )
+            attribute = inspect.getattr_static(stage_class, name, None)
+            if attribute is None:
+                raise ValueError(f"The '{stage}' stage has no method '{method}' to profile.")
+
+            if isinstance(attribute, (staticmethod, classmethod)):
+                overrides[name] = type(attribute)(self.__wrap(step=f"{stage}.{method}", function=attribute.__func__))
+            else:
+                overrides[name] = self.__wrap(step=f"{stage}.{method}", function=attribute)
+
+        if not overrides:
+            return stage_class
+        return type(stage_class.__name__, (stage_class,), {**overrides, "__module__": stage_class.__module__, "__doc__": stage_class.__doc__})
+
+    def __wrap(self, step: str, function):
+        @wraps(function)
+        def profiled(*args, **kwargs):
+            with self.profile(step=step):
+                return function(*args, **kwargs)
+        return profiled
+
+    @contextmanager
+    def profile(self, step: str):
+        """ Profile the code run in the context, as the given step. """
+
+        settings = self.settings
+        if settings.memory:
+            self.__start_tracing()
+            before = tracemalloc.take_snapshot()
+
+        sampler, profiler = None, None
+        if settings.profiler == "sampling":
+            sampler = StackSampler(thread_id=threading.get_ident(), interval_secs=settings.sampling_interval_ms / 1000)
+            sampler.start()
+        elif settings.profiler == "cprofile":
+            if not getattr(self.__cprofile_active, "value", False):
+                profiler = cProfile.Profile()
+                profiler.enable()
+                self.__cprofile_active.value = True
+        else:
+            raise ValueError(f"Unknown profiler '{settings.profiler}'. Use 'sampling' or 'cprofile'.")
+
+        wall, cpu = time.perf_counter(), time.process_time()
+        status = "failed"
+        try:
+            yield
+            status = "done"
+        finally:
+            wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+            if sampler is not None:
+                sampler.stop()
+            if profiler is not None:
+                profiler.disable()
+                self.__cprofile_active.value = False
+
+            row = {"step": step, "status": status, "wall_secs": round(wall, 3), "cpu_secs": round(cpu, 3)}
+            prefix = os.path.join(self.run_directory, re.sub(r"[^\w.-]", "_", step))
+            if sampler is not None:
+                sampler.write_collapsed(path=prefix + ".collapsed")
+                row["samples"] = sum(sampler.stacks.values())
+            if profiler is not None:
+                self.__write_cprofile(profiler=profiler, prefix=prefix)
+            if settings.memory:
+                after = tracemalloc.take_snapshot()
+                row["peak_mb"] = self.__stop_tracing()
+                row["net_allocated_mb"] = round(self.__write_allocation_diff(before=before, after=after, path=prefix + ".allocations.txt") / 2 ** 20, 3)
+
+            with self.__lock:
+                self.summary.append(row)
+
+    def __start_tracing(self):
+        """ Start tracemalloc for the first tracing step of the process. The peak is reset only when no other step is tracing. """
+
+        cls = StepProfiler
+        with cls.__tracing_lock:
+            if cls.__tracing_steps == 0:
+                cls.__tracing_started = not tracemalloc.is_tracing()
+                if cls.__tracing_started:
+                    tracemalloc.start(self.settings.traceback_frames)
+                tracemalloc.reset_peak()
+                cls.__tracing_overlapped = False
+            else:
+                cls.__tracing_overlapped = True
+            cls.__tracing_steps += 1
+
+    def __stop_tracing(self):
+        """ Stop tracemalloc after the last tracing step of the process. Return the peak in MB, or None if other steps traced meanwhile. """
+
+        cls = StepProfiler
+        with cls.__tracing_lock:
+            cls.__tracing_steps -= 1
+            peak_mb = None
+            if not cls.__tracing_overlapped and cls.__tracing_steps == 0:
+                peak_mb = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 3)
+            if cls.__tracing_steps == 0 and cls.__tracing_started:
+                tracemalloc.stop()
+            return peak_mb
+
+    def __write_cprofile(self, profiler: cProfile.Profile, prefix: str):
+        """ Save the profile for pstats-based viewers, and the top functions by cumulative time. """
+
+        profiler.dump_stats(prefix + ".prof")
+        report = io.StringIO()
+        pstats.Stats(profiler, stream=report).sort_stats("cumulative").print_stats(self.settings.top_n)
+        with open(prefix + ".top.txt", "w") as file:
+            file.write(report.getvalue())
+
+    def __write_allocation_diff(self, before, after, path: str) -> int:
+        """ Save the lines whose allocations grew the most during the step, excluding the profiler's own. Return the net growth in bytes. """
+
+        filters = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+        differences = after.filter_traces(filters).compare_to(before.filter_traces(filters), "traceback")
+
+        with open(path, "w") as file:
+            for difference in sorted(differences, key=lambda stat: stat.size_diff, reverse=True)[:self.settings.top_n]:
+                file.write(
+                    f"{difference.size_diff / 2 ** 20:+.3f} MB in {difference.count_diff:+d} blocks "
+                    f"(now {difference.size / 2 ** 20:.3f} MB in {difference.count} blocks)\n"
+                )
+                for line in difference.traceback.format(most_recent_first=True):
+                    file.write(f"    {line}\n")
+        return sum(difference.size_diff for difference in differences)
+
+    def summary_frame(self):
+        """ The profiled steps as a dataframe. """
+        import pandas as pd
+        return pd.DataFrame(self.summary)
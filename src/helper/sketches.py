@@ -0,0 +1,270 @@
+""" Mergeable streaming sketches with bounded memory. """
+
+from typing import Tuple
+import numpy as np
+
+
+class SpaceSaving:
+    """
+    Space-Saving heavy hitters sketch, keeping at most `capacity` items.
+    The count of a monitored item overestimates its true count by at most its error.
+    An item that is not monitored has a true count of at most the minimum monitored count.
+
+    Items are updated in batches: a batch is counted exactly and merged into the sketch, so the cost of an update
+    is a sort of the monitored items plus the batch, instead of one minimum search per evicted item.
+    Two sketches are merged the same way, which makes per-period sketches mergeable into longer periods.
+
+    :param capacity: The maximum number of monitored items.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.keys = np.empty(0, dtype=np.int64)
+        self.counts = np.empty(0, dtype=np.int64)
+        self.errors = np.empty(0, dtype=np.int64)
+        self.total = 0
+
+    @property
+    def min_count(self) -> int:
+        """ The upper bound of the true count of any item that is not monitored. """
+        if len(self.keys) < self.capacity:
+            return 0
+        return int(self.counts.min())
+
+    def update(self, keys: np.ndarray, counts: np.ndarray = None):
+        """ Count a batch of items. Each item is counted once, unless counts are given. """
+
+        keys = np.asarray(keys)
+        counts = np.ones(len(keys), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+
+        # Count the batch exactly. An exact summary has no error and a minimum count of zero.
+        batch_keys, inverse = np.unique(keys, return_inverse=True)
+        batch_counts = np.bincount(inverse, weights=counts, minlength=len(batch_keys)).astype(np.int64)
+
+        self.__combine(
+            keys=batch_keys,
+            counts=batch_counts,
+            errors=np.zeros(len(batch_keys), dtype=np.int64),
+            min_count=0,
+            total=int(counts.sum())
+        )
+
+    def merge(self, other: "SpaceSaving"):
+        """ Merge another sketch into this one. """
+        self.__combine(keys=other.keys, counts=other.counts, errors=other.errors, min_count=other.min_count, total=other.total)
+
+    def __combine(self, keys: np.ndarray, counts: np.ndarray, errors: np.ndarray, min_count: int, total: int):
+        """
+        Combine the monitored items with another summary and keep the `capacity` items with the highest counts.
+        An item missing from one summary may have been counted up to that summary's minimum count, which is added to its count and error.
+        """
+
+        own_min_count = self.min_count
+        n_own = len(self.keys)
+
+        all_keys, inverse = np.unique(np.concatenate([self.keys, keys]), return_inverse=True)
+        n_keys = len(all_keys)
+        combined_counts = np.bincount(inverse, weights=np.concatenate([self.counts, counts]), minlength=n_keys).astype(np.int64)
+        combined_errors = np.bincount(inverse, weights=np.concatenate([self.errors, errors]), minlength=n_keys).astype(np.int64)
+
+        in_own = np.zeros(n_keys, dtype=bool)
+        in_own[inverse[:n_own]] = True
+        in_other = np.zeros(n_keys, dtype=bool)
+        in_other[inverse[n_own:]] = True
+
+        combined_counts[~in_own] += own_min_count
+        combined_errors[~in_own] += own_min_count
+        combined_counts[~in_other] += min_count
+        combined_errors[~in_other] += min_count
+
+        # Keep the items with the highest counts. The dropped items are bounded by the new minimum count.
+        if n_keys > self.capacity:
+            keep = np.argpartition(-combined_counts, self.capacity - 1)[:self.capacity]
+            all_keys, combined_counts, combined_errors = all_keys[keep], combined_counts[keep], combined_errors[keep]
+
+        self.keys, self.counts, self.errors = all_keys, combined_counts, combined_errors
+        self.total += total
+
+    def top(self, k: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """ Return the keys, the estimated counts and the error bounds of the k items with the highest counts. """
+        order = np.argsort(-self.counts, kind="stable")[:k]
+        return self.keys[order], self.counts[order], self.errors[order]
+
+
+class CountMinSketch:
+    """
+    Count-Min sketch of integer keys, with `depth` rows of `width` counters.
+    The estimated count of any key overestimates its true count by at most e / width * total,
+    with probability at least 1 - exp(-depth). Sketches with the same width, depth and seed are merged by adding their counters.
+
+    :param width: The number of counters per row. It is rounded up to a power of two.
+    :param depth: The number of rows, i.e. of independent hash functions.
+    :param seed: The seed of the hash functions.
+    """
+
+    def __init__(self, width: int, depth: int, seed: int = 0):
+        self.bits = max(1, int(np.ceil(np.log2(width))))
+        self.width = 1 << self.bits
+        self.depth = depth
+        self.seed = seed
+        self.table = np.zeros((depth, self.width), dtype=np.int64)
+        self.total = 0
+
+        # Multiply-shift hashing needs odd random multipliers
+        rng = np.random.default_rng(seed)
+        self.__multipliers = rng.integers(1, 2 ** 63, size=depth, dtype=np.uint64) | np.uint64(1)
+        self.__offsets = rng.integers(0, 2 ** 63, size=depth, dtype=np.uint64)
+
+    def __hash(self, keys: np.ndarray) -> np.ndarray:
+        """ Hash the keys into a column of each row, with multiply-shift hashing on wrapping 64 bit integers. """
+        keys = np.asarray(keys).astype(np.uint64)
+        with np.errstate(over="ignore"):
+            hashed = keys[None, :] * self.__multipliers[:, None] + self.__offsets[:, None]
+        return (hashed >> np.uint64(64 - self.bits)).astype(np.int64)
+
+    def update(self, keys: np.ndarray, counts: np.ndarray = None):
+        """ Count a batch of keys. Each key is counted once, unless counts are given. """
+
+        counts = np.ones(len(keys), dtype=np.int64) if counts is None else np.asarray(counts, dtype=np.int64)
+        columns = self.__hash(keys)
+        for row in range(self.depth):
+            self.table[row] += np.bincount(columns[row], weights=counts, minlength=self.width).astype(np.int64)
+        self.total += int(counts.sum())
+
+    def estimate(self, keys: np.ndarray) -> np.ndarray:
+        """ Estimate the counts of the given keys. """
+        columns = self.__hash(keys)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    @property
+    def error_bound(self) -> float:
+        """ The maximum overestimation of any count, holding with probability 1 - exp(-depth). """
+        return np.e / self.width * self.total
+
+    def merge(self, other: "CountMinSketch"):
+        """ Merge another sketch with the same width, depth and seed into this one. """
+        if (other.width, other.depth, other.seed) != (self.width, self.depth, self.seed):
+            raise ValueError("Only Count-Min sketches with the same width, depth and seed can be merged.")
+        self.table += other.table
+        self.total += other.total
+
+
+class GroupedTDigest:
+    """
+    A t-digest per group, for approximate quantiles of many groups (e.g. station-years) in one set of arrays.
+    Each digest is a sorted list of centroids (mean and weight). The centroids near the median may be large,
+    and the centroids in the tails stay small, so extreme quantiles are kept accurate with a bounded number of centroids.
+
+    Values are appended to the centroids and compressed in batches, for all groups at once:
+    the centroids are sorted by group and mean, and the centroids of a group falling into the same bucket of the
+    k1 scale function, k(q) = compression / pi * arcsin(2q - 1), are merged into one.
+    This is a vectorised variant of the merging t-digest, which keeps at most `compression` centroids per group.
+    Digests are merged by appending their centroids and compressing, so they can be re-grouped, e.g. station-years into years.
+
+    :param compression: The compression parameter. Higher values keep more centroids and give more accurate quantiles.
+    :param buffer_size: The number of appended centroids that triggers a compression.
+    """
+
+    def __init__(self, compression: float = 100, buffer_size: int = 1_000_000):
+        self.compression = compression
+        self.buffer_size = buffer_size
+        self.groups = np.empty(0, dtype=np.int64)
+        self.means = np.empty(0, dtype=np.float64)
+        self.weights = np.empty(0, dtype=np.float64)
+        self.__n_compressed = 0
+
+    def update(self, groups: np.ndarray, values: np.ndarray, weights: np.ndarray = None):
+        """ Add a batch of values of the given groups. Each value has a weight of one, unless weights are given. """
+
+        values = np.asarray(values, dtype=np.float64)
+        weights = np.ones(len(values)) if weights is None else np.asarray(weights, dtype=np.float64)
+        self.groups = np.concatenate([self.groups, np.asarray(groups, dtype=np.int64)])
+        self.means = np.concatenate([self.means, values])
+        self.weights = np.concatenate([self.weights, weights])
+
+        if len(self.groups) - self.__n_compressed > self.buffer_size:
+            self.compress()
+
+    def merge(self, other: "GroupedTDigest"):
+        """ Merge another grouped digest into this one. The digests of the same group are merged. """
+        self.update(groups=other.groups, values=other.means, weights=other.weights)
+        self.compress()
+
+    def __sort(self):
+        """ Sort the centroids by group and mean. Return the position of each centroid's group and its mid-point quantile in the group. """
+
+        order = np.lexsort((self.means, self.groups))
+        self.groups, self.means, self.weights = self.groups[order], self.means[order], self.weights[order]
+
+        group_starts = np.r_[True, self.groups[1:] != self.groups[:-1]]
+        group_positions = np.cumsum(group_starts) - 1
+        cumulative = np.cumsum(self.weights)
+        weight_before_group = (cumulative - self.weights)[group_starts]
+        group_totals = np.bincount(group_positions, weights=self.weights)
+
+        mid_quantiles = (cumulative - weight_before_group[group_positions] - self.weights / 2) / group_totals[group_positions]
+        return group_positions, mid_quantiles
+
+    def compress(self):
+        """ Merge the centroids of each group that fall into the same bucket of the scale function. """
+
+        if len(self.groups) == 0:
+            return
+
+        group_positions, mid_quantiles = self.__sort()
+        buckets = np.floor(self.compression / np.pi * np.arcsin(2 * mid_quantiles - 1)).astype(np.int64)
+
+        starts = np.r_[True, (group_positions[1:] != group_positions[:-1]) | (buckets[1:] != buckets[:-1])]
+        centroids = np.cumsum(starts) - 1
+        weights = np.bincount(centroids, weights=self.weights)
+        self.means = np.bincount(centroids, weights=self.weights * self.means) / weights
+        self.groups = self.groups[starts]
+        self.weights = weights
+        self.__n_compressed = len(self.groups)
+
+    def quantiles(self, quantiles) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Estimate the given quantiles of every group, by interpolating between the mid-points of the centroids.
+        Return the groups and a groups x quantiles array.
+        """
+
+        self.compress()
+        quantiles = np.asarray(quantiles, dtype=np.float64)
+        group_positions, mid_quantiles = self.__sort()
+        group_starts = np.flatnonzero(np.r_[True, self.groups[1:] != self.groups[:-1]])
+        group_ends = np.append(group_starts[1:], len(self.groups)) - 1
+        n_groups = len(group_starts)
+
+        # Each group occupies [position, position + 0.5] of a single sorted key, so all groups are searched at once
+        keys = group_positions + mid_quantiles / 2
+        query_groups = np.repeat(np.arange(n_groups), len(quantiles))
+        query_quantiles = np.tile(quantiles, n_groups)
+        right = np.searchsorted(keys, query_groups + query_quantiles / 2)
+        left = right - 1
+
+        below = left < group_starts[query_groups]
+        above = right > group_ends[query_groups]
+        left = np.clip(left, group_starts[query_groups], group_ends[query_groups])
+        right = np.clip(right, group_starts[query_groups], group_ends[query_groups])
+
+        span = mid_quantiles[right] - mid_quantiles[left]
+        fraction = np.divide(query_quantiles - mid_quantiles[left], span, out=np.zeros_like(span), where=span > 0)
+        values = self.means[left] + np.clip(fraction, 0, 1) * (self.means[right] - self.means[left])
+        values = np.where(below, self.means[group_starts[query_groups]], values)
+        values = np.where(above, self.means[group_ends[query_groups]], values)
+
+        return self.groups[group_starts], values.reshape(n_groups, len(quantiles))
+
+    def save(self, path: str):
+        """ Save the compressed centroids as a .npz file. """
+        self.compress()
+        np.savez(path, groups=self.groups, means=self.means, weights=self.weights, compression=self.compression)
+
+    @classmethod
+    def load(cls, path: str) -> "GroupedTDigest":
+        """ Load the centroids saved by a previous run. """
+
+        arrays = np.load(path)
+        digest = cls(compression=float(arrays["compression"]))
+        digest.update(groups=arrays["groups"], values=arrays["means"], weights=arrays["weights"])
+        return digest
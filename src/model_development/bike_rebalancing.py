@@ -0,0 +1,249 @@
+""" Bike-level utilisation and rebalancing detection, from the ride sequence of each bike. """
+
+import glob
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict
+import numpy as np
+import pandas as pd
+from ..model_development.data_1preview import DataPreviewer
+from ..model_development.route_analytics import RouteAnalyser
+
+HOURS_PER_DAY = 24
+SECONDS_PER_HOUR = 3600
+
+
+class BikeRebalancingAnalyser:
+    """
+    Follow every bike from ride to ride, to measure its utilisation and to detect the bikes moved between stations without a ride.
+        1. Stream the rides from BigQuery page by page and hash-partition them by bike_id into Parquet files,
+           so every bike is in a single partition and only one page is held in memory at a time.
+           The partitions are written to a temporary directory, which replaces the previous partitions only when the export succeeds,
+           with a manifest of the hire table, its last modification and row count, the number of partitions and the number of rides.
+           Later runs reuse the partitions only if their manifest matches the config, the current hire table and the rides in the files,
+           unless the reuse is disabled.
+        2. Sessionise the partitions in a process pool. Each worker loads one partition, sorts it by bike and start time,
+           and compares each ride with the previous ride of the same bike with vectorised shifts:
+           the gap between the rides is idle time, and a ride starting at another station than where the previous ride ended
+           means the bike was moved, e.g. by a rebalancing van.
+        3. Sum the moves per station and hour of day, and per pair of stations. The moves are assigned to the hour of the next ride,
+           as the time of the move itself is not recorded.
+        4. Save the rebalancing flows and the bike utilisation in the aggregates directory and in the info_tracker object.
+    The memory is bounded by the size of a page and by the number of workers times the size of a partition.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    STATION_HOUR_FILE = "rebalancing_station_hour.parquet"
+    MOVES_FILE = "rebalancing_moves.parquet"
+    BIKE_UTILISATION_FILE = "bike_utilisation.parquet"
+    PARTITIONS_DIR = "rides"
+    MANIFEST_FILE = "manifest.json"
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.bike_rebalancing
+        self.__source_table = self.__gcp_client.get_table(DataPreviewer.table_id(table=self.config.database.hire_table))
+
+        paths = self.__reusable_partition_paths() if self.__settings.reuse_partitions else None
+        if paths is None:
+            paths = self.__partition_rides_by_bike()
+
+        with ProcessPoolExecutor(max_workers=self.__settings.n_workers) as executor:
+            results = list(executor.map(self.sessionise_partition, paths))
+
+        self.info_tracker.rebalancing_flows_per_station_hour = self.__sum_station_hour_flows(results=results)
+        self.info_tracker.rebalancing_moves = self.__sum_moves(results=results)
+        self.info_tracker.bike_utilisation = pd.concat([result["bikes"] for result in results], ignore_index=True)
+
+        for df, file_name in (
+            (self.info_tracker.rebalancing_flows_per_station_hour, self.STATION_HOUR_FILE),
+            (self.info_tracker.rebalancing_moves, self.MOVES_FILE),
+            (self.info_tracker.bike_utilisation, self.BIKE_UTILISATION_FILE),
+        ):
+            df.to_parquet(os.path.join(self.config.paths2create.aggregates, file_name), index=False)
+
+    @staticmethod
+    def __partition_paths(directory: str):
+        """ The partition files of a directory. """
+        return sorted(glob.glob(os.path.join(directory, "partition_*.parquet")))
+
+    def __manifest(self, n_rides: int) -> dict:
+        """ What the partitions were exported from, to tell whether they can be reused. An update of the hire table changes it. """
+        return {
+            "hire_table": self.config.database.hire_table,
+            "hire_table_modified": self.__source_table.modified.isoformat(),
+            "hire_table_rows": int(self.__source_table.num_rows),
+            "n_partitions": self.__settings.n_partitions,
+            "n_rides": n_rides,
+        }
+
+    def __reusable_partition_paths(self):
+        """ The partition files of a previous complete export with the same hire table and number of partitions, or None. """
+
+        import pyarrow.parquet as pq
+
+        directory = os.path.join(self.config.paths2create.bike_partitions, self.PARTITIONS_DIR)
+        manifest_path = os.path.join(directory, self.MANIFEST_FILE)
+        if not os.path.exists(manifest_path):
+            return None
+        with open(manifest_path) as file:
+            manifest = json.load(file)
+
+        paths = self.__partition_paths(directory=directory)
+        n_rides = sum(pq.ParquetFile(path).metadata.num_rows for path in paths)
+        if manifest != self.__manifest(n_rides=n_rides):
+            return None
+        return paths
+
+    def __partition_rides_by_bike(self):
+        """
+        Stream the rides from BigQuery and write them into one Parquet file per bike_id hash partition.
+        The partial files of a failed export are deleted, and the previous partitions are kept until the export succeeds.
+        """
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        directory = os.path.join(self.config.paths2create.bike_partitions, self.PARTITIONS_DIR)
+        temporary_directory = directory + ".tmp"
+        shutil.rmtree(temporary_directory, ignore_errors=True)
+        os.makedirs(temporary_directory)
+        # Partitions of the previous layout, written without a manifest
+        for path in self.__partition_paths(directory=self.config.paths2create.bike_partitions):
+            os.remove(path)
+
+        # Build query. The partition is computed by BigQuery, so the rides are only routed locally.
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                MOD(ABS(FARM_FINGERPRINT(CAST(bike_id AS STRING))), {self.__settings.n_partitions}) AS partition_key,
+                bike_id,
+                UNIX_SECONDS(start_date) AS start_time,
+                UNIX_SECONDS(end_date) AS end_time,
+                start_station_id,
+                end_station_id
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                bike_id IS NOT NULL
+                AND start_date IS NOT NULL
+                AND end_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND end_station_id IS NOT NULL
+            """
+        )
+
+        writers = {}
+        n_rides = 0
+        try:
+            try:
+                for page in query_job.result(page_size=self.__settings.page_size).to_dataframe_iterable():
+                    partitions = page.pop("partition_key").to_numpy(dtype=np.int64)
+                    page = page.astype(np.int64)
+                    n_rides += len(page)
+                    order = np.argsort(partitions, kind="stable")
+                    unique_partitions, starts = np.unique(partitions[order], return_index=True)
+                    ends = np.append(starts[1:], len(order))
+
+                    for partition, start, end in zip(unique_partitions.tolist(), starts, ends):
+                        table = pa.Table.from_pandas(page.iloc[order[start:end]], preserve_index=False)
+                        if partition not in writers:
+                            path = os.path.join(temporary_directory, f"partition_{partition:04d}.parquet")
+                            writers[partition] = pq.ParquetWriter(path, table.schema)
+                        writers[partition].write_table(table)
+            finally:
+                for writer in writers.values():
+                    writer.close()
+
+            # The manifest is written last, so only a complete export has one
+            with open(os.path.join(temporary_directory, self.MANIFEST_FILE), "w") as file:
+                json.dump(self.__manifest(n_rides=n_rides), file, indent=2)
+        except BaseException:
+            shutil.rmtree(temporary_directory, ignore_errors=True)
+            raise
+
+        shutil.rmtree(directory, ignore_errors=True)
+        os.replace(temporary_directory, directory)
+        return self.__partition_paths(directory=directory)
+
+    @staticmethod
+    def sessionise_partition(path: str) -> Dict[str, pd.DataFrame]:
+        """
+        Compare each ride of a partition with the previous ride of the same bike.
+        Return the moves per station and hour, the moves per pair of stations, and the utilisation of each bike of the partition.
+        """
+
+        df = pd.read_parquet(path)
+        bikes = df["bike_id"].to_numpy()
+        starts = df["start_time"].to_numpy()
+        order = np.lexsort((starts, bikes))
+        bikes, starts = bikes[order], starts[order]
+        ends = df["end_time"].to_numpy()[order]
+        start_stations = df["start_station_id"].to_numpy()[order]
+        end_stations = df["end_station_id"].to_numpy()[order]
+
+        # Shift by one ride: each ride is compared with the previous ride of the same bike
+        same_bike = bikes[1:] == bikes[:-1]
+        gaps = np.maximum(starts[1:] - ends[:-1], 0)
+        moved = same_bike & (start_stations[1:] != end_stations[:-1])
+        from_stations = end_stations[:-1][moved]
+        to_stations = start_stations[1:][moved]
+        hours = (starts[1:][moved] // SECONDS_PER_HOUR) % HOURS_PER_DAY
+
+        # Station-hour flows: bikes removed from the end station of the previous ride, and added to the start station of the next ride
+        removed_keys, removed = np.unique(from_stations * HOURS_PER_DAY + hours, return_counts=True)
+        added_keys, added = np.unique(to_stations * HOURS_PER_DAY + hours, return_counts=True)
+        station_hour = pd.concat([
+            pd.DataFrame({"key": removed_keys, "bikes_removed": removed, "bikes_added": 0}),
+            pd.DataFrame({"key": added_keys, "bikes_removed": 0, "bikes_added": added}),
+        ], ignore_index=True)
+
+        move_keys, move_counts = np.unique(from_stations * RouteAnalyser.ROUTE_KEY_FACTOR + to_stations, return_counts=True)
+        moves = pd.DataFrame({"key": move_keys, "number_of_moves": move_counts})
+
+        # Bike utilisation, summed per bike with np.bincount over the bike codes
+        unique_bikes, bike_codes = np.unique(bikes, return_inverse=True)
+        previous_codes = bike_codes[1:][same_bike]
+        n_bikes = len(unique_bikes)
+        bike_utilisation = pd.DataFrame({
+            "bike_id": unique_bikes,
+            "number_of_rides": np.bincount(bike_codes, minlength=n_bikes),
+            "riding_hours": np.bincount(bike_codes, weights=np.maximum(ends - starts, 0), minlength=n_bikes) / SECONDS_PER_HOUR,
+            "idle_hours": np.bincount(previous_codes, weights=gaps[same_bike], minlength=n_bikes) / SECONDS_PER_HOUR,
+            "number_of_moves": np.bincount(bike_codes[1:][moved], minlength=n_bikes),
+            "first_ride": pd.to_datetime(np.minimum.reduceat(starts, np.flatnonzero(np.r_[True, ~same_bike])), unit="s"),
+            "last_ride": pd.to_datetime(np.maximum.reduceat(ends, np.flatnonzero(np.r_[True, ~same_bike])), unit="s"),
+        })
+        active_hours = (bike_utilisation["last_ride"] - bike_utilisation["first_ride"]).dt.total_seconds() / SECONDS_PER_HOUR
+        bike_utilisation["utilisation"] = (bike_utilisation["riding_hours"] / active_hours.where(active_hours > 0)).round(4)
+
+        return {"station_hour": station_hour, "moves": moves, "bikes": bike_utilisation}
+
+    @staticmethod
+    def __sum_station_hour_flows(results) -> pd.DataFrame:
+        """ Sum the station-hour flows of all partitions. """
+
+        df = pd.concat([result["station_hour"] for result in results], ignore_index=True)
+        df = df.groupby("key", sort=True)[["bikes_removed", "bikes_added"]].sum().reset_index()
+        station_ids, hours = np.divmod(df.pop("key").to_numpy(), HOURS_PER_DAY)
+        df.insert(0, "station_id", station_ids)
+        df.insert(1, "hour", hours)
+        df["net_flow"] = df["bikes_added"] - df["bikes_removed"]
+        return df
+
+    def __sum_moves(self, results) -> pd.DataFrame:
+        """ Sum the moves between each pair of stations of all partitions, and keep the most frequent ones. """
+
+        df = pd.concat([result["moves"] for result in results], ignore_index=True)
+        df = df.groupby("key", sort=False)["number_of_moves"].sum().nlargest(self.__settings.top_moves).reset_index()
+        from_stations, to_stations = np.divmod(df.pop("key").to_numpy(), RouteAnalyser.ROUTE_KEY_FACTOR)
+        df.insert(0, "from_station_id", from_stations)
+        df.insert(1, "to_station_id", to_stations)
+        return df
@@ -0,0 +1,332 @@
+""" Lightweight choropleth map of the London boroughs, with simplified TopoJSON geometry. """
+
+import json
+import os
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+# The YlGnBu_09 colour scale of the previous folium map
+YLGNBU_09 = ["#ffffd9", "#edf8b1", "#c7e9b4", "#7fcdbb", "#41b6c4", "#1d91c0", "#225ea8", "#253494", "#081d58"]
+
+
+class BoroughTopology:
+    """
+    Convert the borough GeoJSON into a simplified TopoJSON topology, once, and cache it next to the aggregates.
+        1. Quantize the coordinates on an integer grid.
+        2. Find the junctions, i.e. the points where two rings meet or part, and cut the rings into arcs at the junctions.
+           A border shared by two boroughs becomes a single arc, so it is stored once and simplified the same way for both.
+        3. Simplify each arc with the Douglas-Peucker algorithm. The junctions are arc ends, so they are always kept.
+        4. Delta-encode the arcs, and store the name and the area-weighted centroid of each borough with its geometry.
+    The cache is rebuilt when the GeoJSON file, the tolerance or the quantization change.
+
+    :param topology: The TopoJSON topology, with a single geometry collection named boroughs.
+    """
+
+    OBJECT = "boroughs"
+
+    def __init__(self, topology: dict):
+        self.topology = topology
+        self.names = [geometry["properties"]["name"] for geometry in topology["objects"][self.OBJECT]["geometries"]]
+
+    @classmethod
+    def load_or_build(cls, geojson_path: str, cache_path: str, tolerance: float, quantization: int) -> "BoroughTopology":
+        """ Load the cached topology if it was built from the same file and settings, otherwise build and cache it. """
+
+        source = {"path": os.path.abspath(geojson_path), "mtime": os.path.getmtime(geojson_path), "tolerance": tolerance, "quantization": quantization}
+        if os.path.exists(cache_path):
+            with open(cache_path) as file:
+                topology = json.load(file)
+            if topology.get("source") == source:
+                return cls(topology=topology)
+
+        with open(geojson_path) as file:
+            geojson = json.load(file)
+        topology = cls.build(geojson=geojson, tolerance=tolerance, quantization=quantization)
+        topology["source"] = source
+        with open(cache_path, "w") as file:
+            json.dump(topology, file, separators=(",", ":"))
+        return cls(topology=topology)
+
+    @classmethod
+    def build(cls, geojson: dict, tolerance: float, quantization: int) -> dict:
+        """ Build the topology of the features of a GeoJSON feature collection of polygons and multipolygons. """
+
+        features = geojson["features"]
+        polygons_per_feature = [
+            feature["geometry"]["coordinates"] if feature["geometry"]["type"] == "MultiPolygon" else [feature["geometry"]["coordinates"]]
+            for feature in features
+        ]
+        all_points = np.concatenate([np.asarray(ring, dtype=np.float64)[:, :2] for polygons in polygons_per_feature for polygon in polygons for ring in polygon])
+        translate = all_points.min(axis=0)
+        scale = np.maximum(all_points.max(axis=0) - translate, 1e-12) / (quantization - 1)
+
+        # Quantized rings, without the closing point and without repeated points
+        rings = []
+        for polygons in polygons_per_feature:
+            for polygon in polygons:
+                for ring in polygon:
+                    points = np.round((np.asarray(ring, dtype=np.float64)[:, :2] - translate) / scale).astype(np.int64)
+                    points = points[np.r_[True, np.any(points[1:] != points[:-1], axis=1)]]
+                    if len(points) > 1 and np.array_equal(points[0], points[-1]):
+                        points = points[:-1]
+                    rings.append(points)
+
+        junctions = cls.__find_junctions(rings=rings)
+        arcs, arc_index, ring_arcs = [], {}, []
+        for ring in rings:
+            ring_arcs.append([cls.__register_arc(arc=arc, arcs=arcs, arc_index=arc_index) for arc in cls.__cut_ring(ring=ring, junctions=junctions)])
+
+        tolerance_units = tolerance / scale.min()
+        encoded_arcs = []
+        for arc in arcs:
+            arc = arc[cls.douglas_peucker(points=arc.astype(np.float64), tolerance=tolerance_units)]
+            encoded_arcs.append(np.vstack([arc[:1], np.diff(arc, axis=0)]).tolist())
+
+        geometries = []
+        position = 0
+        for feature, polygons in zip(features, polygons_per_feature):
+            arcs_of_polygons = []
+            for polygon in polygons:
+                arcs_of_polygons.append(ring_arcs[position:position + len(polygon)])
+                position += len(polygon)
+            geometries.append({
+                "type": "MultiPolygon",
+                "arcs": arcs_of_polygons,
+                "properties": {"name": feature["properties"]["name"], "centroid": cls.centroid(polygons=polygons)},
+            })
+
+        return {
+            "type": "Topology",
+            "transform": {"scale": scale.tolist(), "translate": translate.tolist()},
+            "objects": {cls.OBJECT: {"type": "GeometryCollection", "geometries": geometries}},
+            "arcs": encoded_arcs,
+        }
+
+    @staticmethod
+    def __point_keys(points: np.ndarray) -> np.ndarray:
+        """ A single int64 key per quantized point. """
+        return points[:, 0] * (1 << 32) + points[:, 1]
+
+    @classmethod
+    def __find_junctions(cls, rings: List[np.ndarray]) -> set:
+        """ The points that are visited with different neighbours, i.e. where rings meet or part. """
+
+        keys, lows, highs = [], [], []
+        for ring in rings:
+            point_keys = cls.__point_keys(ring)
+            previous, following = np.roll(point_keys, 1), np.roll(point_keys, -1)
+            keys.append(point_keys)
+            lows.append(np.minimum(previous, following))
+            highs.append(np.maximum(previous, following))
+
+        neighbours = np.unique(np.column_stack([np.concatenate(keys), np.concatenate(lows), np.concatenate(highs)]), axis=0)
+        points, counts = np.unique(neighbours[:, 0], return_counts=True)
+        return set(points[counts > 1].tolist())
+
+    @classmethod
+    def __cut_ring(cls, ring: np.ndarray, junctions: set) -> List[np.ndarray]:
+        """ Cut a ring into arcs at its junctions. A ring without junctions is a single closed arc. """
+
+        point_keys = cls.__point_keys(ring)
+        cuts = np.flatnonzero([key in junctions for key in point_keys.tolist()])
+        if len(cuts) == 0:
+            return [np.vstack([ring, ring[:1]])]
+
+        ring = np.roll(ring, -cuts[0], axis=0)
+        cuts = np.append(cuts - cuts[0], len(ring))
+        ring = np.vstack([ring, ring[:1]])
+        return [ring[start:end + 1] for start, end in zip(cuts[:-1], cuts[1:])]
+
+    @staticmethod
+    def __register_arc(arc: np.ndarray, arcs: List[np.ndarray], arc_index: Dict[bytes, int]) -> int:
+        """ Return the index of the arc, or the one's complement of the index of its reverse, adding the arc if it is new. """
+
+        key = arc.tobytes()
+        if key in arc_index:
+            return arc_index[key]
+        reverse_key = arc[::-1].tobytes()
+        if reverse_key in arc_index:
+            return ~arc_index[reverse_key]
+        arc_index[key] = len(arcs)
+        arcs.append(arc)
+        return arc_index[key]
+
+    @staticmethod
+    def douglas_peucker(points: np.ndarray, tolerance: float) -> np.ndarray:
+        """ The indices of the points kept by the Douglas-Peucker simplification. Both ends are always kept. """
+
+        keep = np.zeros(len(points), dtype=bool)
+        keep[[0, -1]] = True
+        stack = [(0, len(points) - 1)]
+        while stack:
+            start, end = stack.pop()
+            if end - start < 2:
+                continue
+            segment = points[end] - points[start]
+            offsets = points[start + 1:end] - points[start]
+            length = np.hypot(*segment)
+            if length > 0:
+                distances = np.abs(segment[0] * offsets[:, 1] - segment[1] * offsets[:, 0]) / length
+            else:
+                # A closed arc: the distance to its start point
+                distances = np.hypot(offsets[:, 0], offsets[:, 1])
+            farthest = int(np.argmax(distances))
+            if distances[farthest] > tolerance:
+                middle = start + 1 + farthest
+                keep[middle] = True
+                stack.extend([(start, middle), (middle, end)])
+
+        # A closed ring needs at least four points to stay a polygon
+        if np.array_equal(points[0], points[-1]) and keep.sum() < 4:
+            keep[np.linspace(0, len(points) - 1, 4).astype(int)] = True
+        return np.flatnonzero(keep)
+
+    @staticmethod
+    def centroid(polygons) -> List[float]:
+        """ The area-weighted centroid of the polygons, with the holes subtracted, computed with the shoelace formula. """
+
+        areas, xs, ys = [], [], []
+        for polygon in polygons:
+            for position, ring in enumerate(polygon):
+                points = np.asarray(ring, dtype=np.float64)[:, :2]
+                x, y = points[:, 0], points[:, 1]
+                x_next, y_next = np.roll(x, -1), np.roll(y, -1)
+                cross = x * y_next - x_next * y
+                area = cross.sum() / 2
+                if area == 0:
+                    continue
+                # The holes are subtracted, whatever the orientation of the rings
+                sign = 1 if position == 0 else -1
+                areas.append(sign * abs(area))
+                xs.append(((x + x_next) * cross).sum() / (6 * area))
+                ys.append(((y + y_next) * cross).sum() / (6 * area))
+
+        areas = np.asarray(areas)
+        return [round(float(np.dot(areas, xs) / areas.sum()), 6), round(float(np.dot(areas, ys) / areas.sum()), 6)]
+
+
+class BoroughChoropleth:
+    """
+    Render the boroughs coloured by a value, e.g. the total riding duration, in a standalone Leaflet page.
+        - The simplified topology is embedded once. Each layer, e.g. all years or a single year, only adds one colour and one value per borough,
+          which are looked up for all boroughs at once with a hash index over the borough names.
+        - The labels are placed at the precomputed centroids, and the geometry is decoded in the browser with topojson-client.
+        - Boroughs without a value get zero, as in the previous folium map.
+
+    :param topology: The borough topology.
+    :param colours: The colour scale, from the lowest to the highest value.
+    """
+
+    def __init__(self, topology: BoroughTopology, colours: List[str] = None):
+        self.topology = topology
+        self.colours = np.asarray(colours or YLGNBU_09)
+        self.__borough_index = pd.Index(topology.names)
+
+    def layer(self, df: pd.DataFrame, value_column: str, name_column: str = "borough_name") -> dict:
+        """ The values and colours of every borough, in the order of the topology, with a linear colour scale between the minimum and the maximum. """
+
+        positions = self.__borough_index.get_indexer(df[name_column])
+        values = np.zeros(len(self.__borough_index))
+        found = positions >= 0
+        values[positions[found]] = df[value_column].to_numpy(dtype=float)[found]
+
+        low, high = values.min(), values.max()
+        thresholds = np.linspace(low, high, len(self.colours) + 1)[1:-1]
+        return {
+            "values": values.round(2).tolist(),
+            "colours": self.colours[np.digitize(values, thresholds)].tolist(),
+            "legend": {"min": float(low), "max": float(high)},
+        }
+
+    def render(self, layers: Dict[str, dict], path: str, title: str, value_label: str):
+        """ Write the map page, with a selector of the layers if there are several. """
+
+        page = PAGE_TEMPLATE
+        for placeholder, value in (
+            ("__TITLE__", title),
+            ("__VALUE_LABEL__", json.dumps(value_label)),
+            ("__COLOURS__", json.dumps(self.colours.tolist())),
+            ("__TOPOLOGY__", json.dumps({key: value for key, value in self.topology.topology.items() if key != "source"}, separators=(",", ":"))),
+            ("__LAYERS__", json.dumps(layers, separators=(",", ":"))),
+        ):
+            page = page.replace(placeholder, value)
+
+        with open(path, "w") as file:
+            file.write(page)
+
+
+PAGE_TEMPLATE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>__TITLE__</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<script src="https://unpkg.com/topojson-client@3"></script>
+<style>
+  html, body, #map { height: 100%; margin: 0; background: #ffffff; }
+  .label { font: bold 6pt Arial; text-align: center; white-space: nowrap; }
+  .panel { background: #ffffff; padding: 6px 8px; font: 12px Arial; box-shadow: 0 0 4px rgba(0, 0, 0, 0.4); }
+  .legend span { display: inline-block; width: 16px; height: 10px; }
+</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+const topology = __TOPOLOGY__;
+const layers = __LAYERS__;
+const colours = __COLOURS__;
+const valueLabel = __VALUE_LABEL__;
+const boroughs = topojson.feature(topology, topology.objects.boroughs);
+const map = L.map("map", {zoomSnap: 0.25});
+let current = Object.keys(layers)[0];
+
+const shapes = L.geoJSON(boroughs, {
+  style: {color: "black", weight: 2, fillOpacity: 0.7},
+  onEachFeature: (feature, layer) => {
+    layer.bindTooltip("");
+    layer.on("mouseover", () => layer.setStyle({weight: 5}));
+    layer.on("mouseout", () => layer.setStyle({weight: 2}));
+  }
+}).addTo(map);
+map.fitBounds(shapes.getBounds());
+
+boroughs.features.forEach(feature => {
+  const [lon, lat] = feature.properties.centroid;
+  L.marker([lat, lon], {icon: L.divIcon({className: "label", html: feature.properties.name, iconSize: [50, 50]}), interactive: false}).addTo(map);
+});
+
+const legend = L.control({position: "bottomright"});
+legend.onAdd = () => L.DomUtil.create("div", "panel legend");
+legend.addTo(map);
+
+function show(name) {
+  current = name;
+  const layer = layers[name];
+  let index = 0;
+  shapes.eachLayer(shape => {
+    shape.setStyle({fillColor: layer.colours[index]});
+    shape.setTooltipContent(`Borough: ${shape.feature.properties.name}<br>${valueLabel}: ${layer.values[index].toLocaleString()}`);
+    index += 1;
+  });
+  legend.getContainer().innerHTML = `${valueLabel}<br>${layer.legend.min.toLocaleString()} ` +
+    colours.map(colour => `<span style="background:${colour}"></span>`).join("") + ` ${layer.legend.max.toLocaleString()}`;
+}
+
+if (Object.keys(layers).length > 1) {
+  const selector = L.control({position: "topright"});
+  selector.onAdd = () => {
+    const div = L.DomUtil.create("div", "panel");
+    div.innerHTML = "<select>" + Object.keys(layers).map(name => `<option>${name}</option>`).join("") + "</select>";
+    div.firstChild.onchange = event => show(event.target.value);
+    L.DomEvent.disableClickPropagation(div);
+    return div;
+  };
+  selector.addTo(map);
+}
+show(current);
+</script>
+</body>
+</html>
+"""
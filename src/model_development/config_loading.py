@@ -1,7 +1,7 @@
 """ Load configuration from the config yaml file. """
 
 from dataclasses import dataclass
-from typing import Type
+from typing import List, Optional, Type
 from ..helper.yaml_reading import YamlReader
 
 
@@ -41,13 +41,33 @@ class Paths2Create:
     plots_path: str
     eda_report: str
     model_results: str
+    data_quality_cache: str
+    aggregates: str
+    usage_profiles: str
+    artifacts: str
+    streaming: str
+    station_distances: str
+    bike_partitions: str
+    od_flows: str
+    demand_anomalies: str
+    profiling: str
 
     @classmethod
     def read_config(cls: Type["Paths2Create"], obj: dict):
         return cls(
             plots_path=obj["paths"]["paths2create"]["plots_path"],
             eda_report=obj["paths"]["paths2create"]["eda_report"],
-            model_results=obj["paths"]["paths2create"]["model_results"]
+            model_results=obj["paths"]["paths2create"]["model_results"],
+            data_quality_cache=obj["paths"]["paths2create"]["data_quality_cache"],
+            aggregates=obj["paths"]["paths2create"]["aggregates"],
+            usage_profiles=obj["paths"]["paths2create"]["usage_profiles"],
+            artifacts=obj["paths"]["paths2create"]["artifacts"],
+            streaming=obj["paths"]["paths2create"]["streaming"],
+            station_distances=obj["paths"]["paths2create"]["station_distances"],
+            bike_partitions=obj["paths"]["paths2create"]["bike_partitions"],
+            od_flows=obj["paths"]["paths2create"]["od_flows"],
+            demand_anomalies=obj["paths"]["paths2create"]["demand_anomalies"],
+            profiling=obj["paths"]["paths2create"]["profiling"]
         )
 
 
@@ -71,6 +91,420 @@ class DataBase:
         )
         
 
+@dataclass
+class BigQuery:
+    """ Read the bigquery client configuration from the config yaml file. """
+    max_concurrency: int
+    retry_initial_secs: float
+    retry_max_secs: float
+    retry_multiplier: float
+    retry_deadline_secs: float
+    job_timeout_secs: Optional[float]
+
+    @classmethod
+    def read_config(cls: Type["BigQuery"], obj: dict):
+        return cls(
+            max_concurrency=obj["bigquery"]["max_concurrency"],
+            retry_initial_secs=obj["bigquery"]["retry_initial_secs"],
+            retry_max_secs=obj["bigquery"]["retry_max_secs"],
+            retry_multiplier=obj["bigquery"]["retry_multiplier"],
+            retry_deadline_secs=obj["bigquery"]["retry_deadline_secs"],
+            job_timeout_secs=obj["bigquery"]["job_timeout_secs"]
+        )
+
+
+@dataclass
+class Scheduling:
+    """ Read the pipeline scheduling configuration from the config yaml file. """
+    prefetch: bool
+    prefetch_workers: int
+
+    @classmethod
+    def read_config(cls: Type["Scheduling"], obj: dict):
+        return cls(
+            prefetch=obj["scheduling"]["prefetch"],
+            prefetch_workers=obj["scheduling"]["prefetch_workers"]
+        )
+
+
+@dataclass
+class Preprocessing:
+    """ Read preprocessing configuration from the config yaml file. """
+    identify_boroughs: bool
+    upload_borough_table: bool
+
+    @classmethod
+    def read_config(cls: Type["Preprocessing"], obj: dict):
+        return cls(
+            identify_boroughs=obj["preprocessing"]["identify_boroughs"],
+            upload_borough_table=obj["preprocessing"]["upload_borough_table"]
+        )
+
+
+@dataclass
+class DataQuality:
+    """ Read data quality configuration from the config yaml file. """
+    null_counts_mode: str
+    partition_column: str
+    sample_percent: float
+    confidence_level: float
+
+    @classmethod
+    def read_config(cls: Type["DataQuality"], obj: dict):
+        return cls(
+            null_counts_mode=obj["data_quality"]["null_counts_mode"],
+            partition_column=obj["data_quality"]["partition_column"],
+            sample_percent=obj["data_quality"]["sample_percent"],
+            confidence_level=obj["data_quality"]["confidence_level"]
+        )
+
+
+@dataclass
+class DurationQuality:
+    """ Read the duration quality configuration from the config yaml file. """
+    compression: float
+    lower_quantile: float
+    upper_quantile: float
+    min_duration_secs: float
+    page_size: int
+    trim_metrics: bool
+
+    @classmethod
+    def read_config(cls: Type["DurationQuality"], obj: dict):
+        return cls(
+            compression=obj["duration_quality"]["compression"],
+            lower_quantile=obj["duration_quality"]["lower_quantile"],
+            upper_quantile=obj["duration_quality"]["upper_quantile"],
+            min_duration_secs=obj["duration_quality"]["min_duration_secs"],
+            page_size=obj["duration_quality"]["page_size"],
+            trim_metrics=obj["duration_quality"]["trim_metrics"]
+        )
+
+
+@dataclass
+class RouteAnalytics:
+    """ Read the route analytics configuration from the config yaml file. """
+    mode: str
+    top_routes_of_all_time: int
+    top_routes_per_period: int
+    per_month: bool
+    per_borough: bool
+    sketch_capacity: int
+    count_min_width: int
+    count_min_depth: int
+    page_size: int
+    route_metrics: bool
+
+    @classmethod
+    def read_config(cls: Type["RouteAnalytics"], obj: dict):
+        return cls(
+            mode=obj["route_analytics"]["mode"],
+            top_routes_of_all_time=obj["route_analytics"]["top_routes_of_all_time"],
+            top_routes_per_period=obj["route_analytics"]["top_routes_per_period"],
+            per_month=obj["route_analytics"]["per_month"],
+            per_borough=obj["route_analytics"]["per_borough"],
+            sketch_capacity=obj["route_analytics"]["sketch_capacity"],
+            count_min_width=obj["route_analytics"]["count_min_width"],
+            count_min_depth=obj["route_analytics"]["count_min_depth"],
+            page_size=obj["route_analytics"]["page_size"],
+            route_metrics=obj["route_analytics"]["route_metrics"]
+        )
+
+
+@dataclass
+class Revenue:
+    """ Read the revenue engine configuration from the config yaml file. """
+    bin_width_secs: int
+    max_duration_secs: int
+    default_tariff: str
+    tariffs: List[dict]
+    tariff_mixes: List[dict]
+
+    @classmethod
+    def read_config(cls: Type["Revenue"], obj: dict):
+        return cls(
+            bin_width_secs=obj["revenue"]["bin_width_secs"],
+            max_duration_secs=obj["revenue"]["max_duration_secs"],
+            default_tariff=obj["revenue"]["default_tariff"],
+            tariffs=obj["revenue"]["tariffs"],
+            tariff_mixes=obj["revenue"]["tariff_mixes"]
+        )
+
+
+@dataclass
+class UsageProfiles:
+    """ Read the station usage profiles configuration from the config yaml file. """
+    per_year: bool
+    normalisation: str
+    clustering: str
+    n_clusters: int
+
+    @classmethod
+    def read_config(cls: Type["UsageProfiles"], obj: dict):
+        return cls(
+            per_year=obj["usage_profiles"]["per_year"],
+            normalisation=obj["usage_profiles"]["normalisation"],
+            clustering=obj["usage_profiles"]["clustering"],
+            n_clusters=obj["usage_profiles"]["n_clusters"]
+        )
+
+
+@dataclass
+class BoroughMap:
+    """ Read the borough choropleth map configuration from the config yaml file. """
+    enabled: bool
+    simplify_tolerance: float
+    quantization: int
+    per_year_layers: bool
+
+    @classmethod
+    def read_config(cls: Type["BoroughMap"], obj: dict):
+        return cls(
+            enabled=obj["borough_map"]["enabled"],
+            simplify_tolerance=obj["borough_map"]["simplify_tolerance"],
+            quantization=obj["borough_map"]["quantization"],
+            per_year_layers=obj["borough_map"]["per_year_layers"]
+        )
+
+
+@dataclass
+class ODFlows:
+    """ Read the origin-destination flow matrices configuration from the config yaml file. """
+    slicing: str
+    years: List[int]
+    page_size: int
+
+    @classmethod
+    def read_config(cls: Type["ODFlows"], obj: dict):
+        return cls(
+            slicing=obj["od_flows"]["slicing"],
+            years=obj["od_flows"]["years"],
+            page_size=obj["od_flows"]["page_size"]
+        )
+
+
+@dataclass
+class BikeRebalancing:
+    """ Read the bike rebalancing analysis configuration from the config yaml file. """
+    n_partitions: int
+    n_workers: Optional[int]
+    page_size: int
+    reuse_partitions: bool
+    top_moves: int
+
+    @classmethod
+    def read_config(cls: Type["BikeRebalancing"], obj: dict):
+        return cls(
+            n_partitions=obj["bike_rebalancing"]["n_partitions"],
+            n_workers=obj["bike_rebalancing"]["n_workers"],
+            page_size=obj["bike_rebalancing"]["page_size"],
+            reuse_partitions=obj["bike_rebalancing"]["reuse_partitions"],
+            top_moves=obj["bike_rebalancing"]["top_moves"]
+        )
+
+
+@dataclass
+class Engineering:
+    """ Read the data engineering configuration from the config yaml file. """
+    capacity_feature: bool
+
+    @classmethod
+    def read_config(cls: Type["Engineering"], obj: dict):
+        return cls(
+            capacity_feature=obj["engineering"]["capacity_feature"]
+        )
+
+
+@dataclass
+class Modelling:
+    """ Read the modelling configuration from the config yaml file. """
+    search_mode: str
+    test_fraction: float
+    nfolds: int
+    sort_metric: str
+    time_budget_secs: float
+    n_candidates: int
+    halving_factor: int
+    min_resource_fraction: float
+    n_jobs: int
+    training_mode: str
+    additional_trees: int
+    incremental_learning_rate_factor: float
+    drift_threshold: float
+
+    @classmethod
+    def read_config(cls: Type["Modelling"], obj: dict):
+        return cls(
+            search_mode=obj["modelling"]["search_mode"],
+            test_fraction=obj["modelling"]["test_fraction"],
+            nfolds=obj["modelling"]["nfolds"],
+            sort_metric=obj["modelling"]["sort_metric"],
+            time_budget_secs=obj["modelling"]["time_budget_secs"],
+            n_candidates=obj["modelling"]["n_candidates"],
+            halving_factor=obj["modelling"]["halving_factor"],
+            min_resource_fraction=obj["modelling"]["min_resource_fraction"],
+            n_jobs=obj["modelling"]["n_jobs"],
+            training_mode=obj["modelling"]["training_mode"],
+            additional_trees=obj["modelling"]["additional_trees"],
+            incremental_learning_rate_factor=obj["modelling"]["incremental_learning_rate_factor"],
+            drift_threshold=obj["modelling"]["drift_threshold"]
+        )
+
+
+@dataclass
+class DemandTimeSeries:
+    """ Read the hourly demand time series plot configuration from the config yaml file. """
+    enabled: bool
+    points_per_trace: int
+    daily_max_days: int
+    hourly_max_days: int
+
+    @classmethod
+    def read_config(cls: Type["DemandTimeSeries"], obj: dict):
+        return cls(
+            enabled=obj["demand_timeseries"]["enabled"],
+            points_per_trace=obj["demand_timeseries"]["points_per_trace"],
+            daily_max_days=obj["demand_timeseries"]["daily_max_days"],
+            hourly_max_days=obj["demand_timeseries"]["hourly_max_days"]
+        )
+
+
+@dataclass
+class DemandAnomalies:
+    """ Read the seasonal demand anomaly detection configuration from the config yaml file. """
+    window_weeks: int
+    min_weeks: int
+    threshold: float
+    min_mad: float
+    chunk_mb: float
+    streaming: bool
+
+    @classmethod
+    def read_config(cls: Type["DemandAnomalies"], obj: dict):
+        return cls(
+            window_weeks=obj["demand_anomalies"]["window_weeks"],
+            min_weeks=obj["demand_anomalies"]["min_weeks"],
+            threshold=obj["demand_anomalies"]["threshold"],
+            min_mad=obj["demand_anomalies"]["min_mad"],
+            chunk_mb=obj["demand_anomalies"]["chunk_mb"],
+            streaming=obj["demand_anomalies"]["streaming"]
+        )
+
+
+@dataclass
+class RebalancingPlan:
+    """ Read the demand-aware rebalancing planner configuration from the config yaml file. """
+    plan_start: Optional[str]
+    horizon_hours: int
+    history_weeks: int
+    use_predictions: bool
+    n_scenarios: int
+    n_levels: int
+    loss_tolerance: float
+    nearest_stations: int
+    max_move_km: float
+
+    @classmethod
+    def read_config(cls: Type["RebalancingPlan"], obj: dict):
+        return cls(
+            plan_start=obj["rebalancing_plan"]["plan_start"],
+            horizon_hours=obj["rebalancing_plan"]["horizon_hours"],
+            history_weeks=obj["rebalancing_plan"]["history_weeks"],
+            use_predictions=obj["rebalancing_plan"]["use_predictions"],
+            n_scenarios=obj["rebalancing_plan"]["n_scenarios"],
+            n_levels=obj["rebalancing_plan"]["n_levels"],
+            loss_tolerance=obj["rebalancing_plan"]["loss_tolerance"],
+            nearest_stations=obj["rebalancing_plan"]["nearest_stations"],
+            max_move_km=obj["rebalancing_plan"]["max_move_km"]
+        )
+
+
+@dataclass
+class Profiling:
+    """ Read the step profiling configuration from the config yaml file. """
+    enabled: bool
+    steps: List[str]
+    profiler: str
+    sampling_interval_ms: float
+    memory: bool
+    traceback_frames: int
+    top_n: int
+
+    @classmethod
+    def read_config(cls: Type["Profiling"], obj: dict):
+        return cls(
+            enabled=obj["profiling"]["enabled"],
+            steps=obj["profiling"]["steps"],
+            profiler=obj["profiling"]["profiler"],
+            sampling_interval_ms=obj["profiling"]["sampling_interval_ms"],
+            memory=obj["profiling"]["memory"],
+            traceback_frames=obj["profiling"]["traceback_frames"],
+            top_n=obj["profiling"]["top_n"]
+        )
+
+
+@dataclass
+class Artifacts:
+    """ Read the artifact store configuration from the config yaml file. """
+    spill_threshold_mb: float
+
+    @classmethod
+    def read_config(cls: Type["Artifacts"], obj: dict):
+        return cls(
+            spill_threshold_mb=obj["artifacts"]["spill_threshold_mb"]
+        )
+
+
+@dataclass
+class Streaming:
+    """ Read the streaming demand monitoring configuration from the config yaml file. """
+    source: str
+    replay_start: str
+    replay_days: int
+    replay_speedup: float
+    host: str
+    port: int
+    batch_size: int
+    max_station_id: int
+    window_hours: int
+    class_thresholds: List[float]
+    alert_class: int
+    model_path: Optional[str]
+
+    @classmethod
+    def read_config(cls: Type["Streaming"], obj: dict):
+        return cls(
+            source=obj["streaming"]["source"],
+            replay_start=obj["streaming"]["replay_start"],
+            replay_days=obj["streaming"]["replay_days"],
+            replay_speedup=obj["streaming"]["replay_speedup"],
+            host=obj["streaming"]["host"],
+            port=obj["streaming"]["port"],
+            batch_size=obj["streaming"]["batch_size"],
+            max_station_id=obj["streaming"]["max_station_id"],
+            window_hours=obj["streaming"]["window_hours"],
+            class_thresholds=obj["streaming"]["class_thresholds"],
+            alert_class=obj["streaming"]["alert_class"],
+            model_path=obj["streaming"]["model_path"]
+        )
+
+
+@dataclass
+class Serving:
+    """ Read the analytics query service configuration from the config yaml file. """
+    host: str
+    port: int
+    max_age_secs: int
+
+    @classmethod
+    def read_config(cls: Type["Serving"], obj: dict):
+        return cls(
+            host=obj["serving"]["host"],
+            port=obj["serving"]["port"],
+            max_age_secs=obj["serving"]["max_age_secs"]
+        )
+
+
 @dataclass
 class PlotDefault:
     """ Read plotting configuration from the config yaml file. """
@@ -123,5 +557,25 @@ class Config:
         self.existing_paths = ExistingPaths.read_config(obj=config_file)
         self.paths2create = Paths2Create.read_config(obj=config_file)
         self.database = DataBase.read_config(obj=config_file)
+        self.bigquery = BigQuery.read_config(obj=config_file)
+        self.scheduling = Scheduling.read_config(obj=config_file)
+        self.preprocessing = Preprocessing.read_config(obj=config_file)
+        self.data_quality = DataQuality.read_config(obj=config_file)
+        self.duration_quality = DurationQuality.read_config(obj=config_file)
+        self.route_analytics = RouteAnalytics.read_config(obj=config_file)
+        self.revenue = Revenue.read_config(obj=config_file)
+        self.usage_profiles = UsageProfiles.read_config(obj=config_file)
+        self.borough_map = BoroughMap.read_config(obj=config_file)
+        self.od_flows = ODFlows.read_config(obj=config_file)
+        self.bike_rebalancing = BikeRebalancing.read_config(obj=config_file)
+        self.engineering = Engineering.read_config(obj=config_file)
+        self.modelling = Modelling.read_config(obj=config_file)
+        self.demand_timeseries = DemandTimeSeries.read_config(obj=config_file)
+        self.demand_anomalies = DemandAnomalies.read_config(obj=config_file)
+        self.rebalancing_plan = RebalancingPlan.read_config(obj=config_file)
+        self.profiling = Profiling.read_config(obj=config_file)
+        self.artifacts = Artifacts.read_config(obj=config_file)
+        self.streaming = Streaming.read_config(obj=config_file)
+        self.serving = Serving.read_config(obj=config_file)
         self.plotdefault = PlotDefault.read_config(obj=config_file)
         self.random_state = RandomState.read_config(obj=config_file)
\ No newline at end of file
@@ -1,10 +1,9 @@
 import os
-import time
-import geopandas as gpd
+from typing import TYPE_CHECKING
 import pandas as pd
-from shapely.geometry import shape, Point
-from google.cloud import bigquery
-from ..model_development.data_3exploration import DataExplorer
+
+if TYPE_CHECKING:
+    import geopandas as gpd
 
 
 class DataPreprocessor:
@@ -16,8 +15,8 @@ class DataPreprocessor:
         2. Load the cycle_stations data.
         3. Iterate through the cycle_stations data and use a function to identify in which London borough each cycle station is located.
         4. Save the data in pd dataframe format in the info_tracker object.
-        5. Store the processed data in a bigquery dataset.
-        6. Create preview for the processed data.
+        5. Store the processed data in a bigquery dataset, if the upload is enabled in the config.
+        6. Create preview for the processed data, if the upload is enabled in the config.
 
     :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.              
     :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
@@ -29,18 +28,25 @@ class DataPreprocessor:
         self.info_tracker = info_tracker
         self.__gcp_client = gcp_client
 
-        # self.__london_geodf = self.__load_london_geodata()
-        # self.__bike_stations_data = self.__load_stations_data()
-        # self.info_tracker.cycle_station_data_with_borough_names = self.__add_borough_name_in_station_data()
-        # self.__upload_cycle_station_data_with_borough_names_to_bigquery()
-        # self.info_tracker.cycle_station_with_borough_names_preview = self.__create_cycle_station_data_with_borough_names_preview()
+        if self.config.preprocessing.identify_boroughs:
+            self.__london_geodf = self.__load_london_geodata()
+            self.__bike_stations_data = self.__load_stations_data()
+            self.info_tracker.cycle_station_data_with_borough_names = self.__add_borough_name_in_station_data()
+
+            # The borough rollup is computed locally from the in-memory mapping,
+            # so the upload is only needed by queries that join the borough table in BigQuery
+            if self.config.preprocessing.upload_borough_table:
+                self.__upload_cycle_station_data_with_borough_names_to_bigquery()
+                self.info_tracker.cycle_station_with_borough_names_preview = self.__create_cycle_station_data_with_borough_names_preview()
 
-    def __load_london_geodata(self) -> gpd.GeoDataFrame:
+    def __load_london_geodata(self) -> "gpd.GeoDataFrame":
         """ Load the London Geo data. """
 
-        # Make geojson path and read London geo-data
+        from ..helper.batch_resources import SharedGeodata
+
+        # Make geojson path and read London geo-data. It is read once per process, and shared by the runs of a batch.
         geojson_path = os.path.join(self.config.existing_paths.london_geodata_dir, self.config.existing_paths.london_geodata_file)
-        london_geodf = gpd.read_file(geojson_path)
+        london_geodf = SharedGeodata.read_file(geojson_path)
         
         # print(london_geodf)
         return london_geodf
@@ -69,6 +75,9 @@ class DataPreprocessor:
         Return the borough name
         """
 
+        # Imported here, so shapely is only loaded when the geo data is needed
+        from shapely.geometry import shape, Point
+
         # Make a geo-point using the given latitude and longitude
         point = Point(given_lon, given_lat)
 
@@ -115,6 +124,9 @@ class DataPreprocessor:
     def __upload_cycle_station_data_with_borough_names_to_bigquery(self):
         """ Load the crated cycle station data with borough names to bigquery. """
 
+        # Imported here, so the bigquery library is only loaded when the upload is needed
+        from google.cloud import bigquery
+
         # Set a name to temporarily save the processed cycle station data
         file_name = "temp_df.csv"
 
@@ -138,10 +150,8 @@ class DataPreprocessor:
         with open(rf"{file_name}", "rb") as source_file:
             job = self.__gcp_client.load_table_from_file(source_file, table_id, job_config=job_config)
 
-        while job.state != "DONE":
-            time.sleep(10)
-            job.reload()
-            print(job.state)
+        # Wait for the job, with the retry policy and the job timeout of the client
+        job.result()
 
         # Delete temporary df
         os.remove(file_name)
@@ -165,11 +175,27 @@ class DataPreprocessor:
 
         # Print outcome if show config is True
         if self.config.show_outcome.show_outcome:
-            Printer().print_outcome(outcome=df, display_name=name)
+            print(f"{name}:\n{df}")
     
         return df
 
+    def aggregate_data(self):
+        """ Call DataAggregator class to precompute the aggregates of the data. """
+
+        from ..model_development.data_aggregation import DataAggregator
+
+        return DataAggregator(
+            config=self.config,
+            info_tracker=self.info_tracker,
+            gcp_client=self.__gcp_client
+        )
+
     def explore_data(self):
+        """ Call DataExplorer class to explore the data. """
+
+        # Imported here, so the plotting libraries are only loaded when the exploration step is reached
+        from ..model_development.data_3exploration import DataExplorer
+
         return DataExplorer(
             config=self.config,
             info_tracker=self.info_tracker,
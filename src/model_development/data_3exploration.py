@@ -1,15 +1,16 @@
 """ Data exploration. """
 
 import os
-# import folium
 import pandas as pd
-# import geopandas as gpd
 import numpy as np
 import plotly.graph_objects as go
 import plotly.express as px
 from plotly.subplots import make_subplots
-# from branca.colormap import linear
-from ..model_development.data_engineering import DataEngineer
+from ..model_development.borough_map import BoroughChoropleth, BoroughTopology
+from ..model_development.duration_quality import DurationBounds
+from ..model_development.revenue_engine import RevenueEngine
+from ..model_development.route_analytics import RouteAnalyser
+from ..model_development.station_distances import RouteMetrics
 
 
 class DataExplorer:
@@ -24,14 +25,20 @@ class DataExplorer:
         7. Top destinations per year.
         8. Most popular roots of all time.
         9. Most popular roots per year.
+           The route rankings are approximated by the RouteAnalyser class, unless the route analytics mode is exact.
+           The RouteMetrics class adds the distance, implied speed and round trips to the route and destination rankings, if configured.
         10. Daily and weekly usage pattern.
-        11. Total riding duration per borough.
+        11. Total riding duration per borough, also per year and per hour of day when it is rolled up locally.
+            It is mapped on a choropleth of the boroughs, with a layer per year if configured.
+    The duration metrics trim the outliers with the bounds of the DurationQualityChecker class, if enabled in the config.
     """
 
     def __init__(self, config, info_tracker, gcp_client):
         self.config = config
         self.info_tracker = info_tracker
         self.__gcp_client = gcp_client
+        # Duration outliers are trimmed the same way by every duration metric, if enabled in the config
+        self.__duration_condition = DurationBounds.sql_condition_from_config(config=self.config)
 
         self.info_tracker.total_rides_n_duration_per_year = self.__calc_total_rides_n_duration_per_year()
         self.__plot_total_rides_n_duration_per_year()
@@ -47,12 +54,18 @@ class DataExplorer:
         self.__plot_top_destinations_of_all_time()
         self.info_tracker.top_destinations_per_year = self.__identify_top_destinations_per_year()
         self.__plot_top_destinations_per_year()
-        self.info_tracker.top_roots_of_all_time = self.__identify_the_most_popular_roots_of_all_time()
-        self.info_tracker.top_roots_per_year = self.__identify_the_most_popular_roots_per_year()
+        if self.config.route_analytics.mode == "exact":
+            self.info_tracker.top_roots_of_all_time = self.__identify_the_most_popular_roots_of_all_time()
+            self.info_tracker.top_roots_per_year = self.__identify_the_most_popular_roots_per_year()
+        else:
+            RouteAnalyser(config=self.config, info_tracker=self.info_tracker, gcp_client=self.__gcp_client)
+        if self.config.route_analytics.route_metrics:
+            RouteMetrics(config=self.config, info_tracker=self.info_tracker, gcp_client=self.__gcp_client)
         self.info_tracker.daily_n_weekly_usage_pattern = self.__identify_daily_n_weekly_usage_pattern()
         self.__plot_the_daily_n_weekly_usage()       
         self.info_tracker.total_duartion_per_borough = self.__create_cycle_hire_data_with_london_borough_name()
-        # self.__make_an_interactive_london_map_with_boroughs_n_riding_duration()
+        if self.config.borough_map.enabled:
+            self.__make_an_interactive_london_map_with_boroughs_n_riding_duration()
 
     def __calc_total_rides_n_duration_per_year(self) -> pd.DataFrame:
         """
@@ -71,6 +84,7 @@ class DataExplorer:
                 bigquery-public-data.london_bicycles.{self.config.database.hire_table}
             WHERE
                 start_date IS NOT NULL
+                AND {self.__duration_condition}
             GROUP BY 
                 year
             ORDER BY 
@@ -333,73 +347,76 @@ class DataExplorer:
         # Save figure.
         fig.write_html(os.path.join(self.config.paths2create.plots_path, name + ".html"))
         
-    def __identify_most_profitable_stations_per_year(self) -> pd.DataFrame:
-        """ 
-        Identify the top 3 starting stations with the highest profitability.
-        Profitability Calculation:
-        1. Consider a rate of £1.65 for each subsequent 30-minute period of bike usage following the initial 30 minutes from the start of the rental. 
-            The pricing policy described above pertains to the current basic subscription for Santander bikes in London.
-        2. Subtract 1800 seconds (equivalent to half an hour) from the duration column (riding measured in seconds),
-            to exclude the initial 30 minutes of free riding offered for each ride within the first 24 hours of subscription.
-            Extra charge is added after the first 30 minutes of riding.
-        3. The above mentioned charge varies depending on yearly and premium subscripition.
-            However, for this analysis, we focus on the standard/basic subscription due to the lack of specific subscription data.
-        4. To calculate the extra 30 mins chargable periods, the remaining time is devided my 1800 and the results is stored in the extra_time column.
-            So, the extra_time filled in with a float greater than 0 that shows the number of extra 30 minute riding periods.
-        5. Calculate the extra profitability by multiplying the "extra_time" factor by the price per 30 minutes (£1.65).
-        6. The calculated profitability does not include the initial subscription fee.
+    def __extract_duration_histogram(self) -> pd.DataFrame:
+        """
+        Count the rides per year, starting station and fixed-width duration bin, in a single scan of the cycle_hire table.
+        Rides longer than the maximum duration are collected in the last bin, whose total duration is kept to price it.
+        Negative durations are counted in the first bin, as they are not charged.
         """
 
+        bin_width = self.config.revenue.bin_width_secs
+        overflow_bin = int(np.ceil(self.config.revenue.max_duration_secs / bin_width))
+
         # Build query.
         query_job = self.__gcp_client.query(
             f"""
-            WITH ChargableTime AS (
-                SELECT
-                    EXTRACT(YEAR FROM start_date) AS year,
-                    start_station_name,
-                    SUM(CEIL(GREATEST(ROUND((duration - 1800) / 1800, 2), 0))) AS extra_time
-                FROM
-                    bigquery-public-data.london_bicycles.{self.config.database.hire_table}
-                GROUP BY
-                    year,
-                    start_station_name
-            ),
-
-            ProfitData AS (
-                SELECT
-                    year,
-                    start_station_name,
-                    ROUND(SUM(extra_time * 1.65), 2) AS profit
-                FROM
-                    ChargableTime
-                GROUP BY
-                    year,
-                    start_station_name
-            )
-
             SELECT
-                year,
+                EXTRACT(YEAR FROM start_date) AS year,
                 start_station_name,
-                profit
-            FROM(
-                SELECT
-                    year,
-                    start_station_name,
-                    profit,
-                    ROW_NUMBER() OVER(PARTITION BY year ORDER BY profit DESC) AS row_num
-                FROM 
-                    ProfitData
-            )
+                LEAST(DIV(GREATEST(CAST(duration AS INT64), 0), {bin_width}), {overflow_bin}) AS duration_bin,
+                COUNT(*) AS number_of_rides,
+                SUM(duration) AS total_duration
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
             WHERE
-                row_num <= 3
-            ORDER BY
+                duration IS NOT NULL
+                AND {self.__duration_condition}
+            GROUP BY
                 year,
-                profit DESC;
+                start_station_name,
+                duration_bin;
             """
         )
         df = query_job.result().to_dataframe()
         return df
 
+    def __identify_most_profitable_stations_per_year(self) -> pd.DataFrame:
+        """
+        Identify the top 3 starting stations with the highest profitability.
+        Profitability Calculation:
+        1. The profit of each station and year is calculated by the RevenueEngine class, over the duration histogram of the rides.
+            So, any tariff of the revenue configuration is evaluated locally, without scanning the cycle_hire table again.
+            The revenue of every station-year under every configured tariff is saved in the info tracker object.
+        2. The default tariff considers a rate of £1.65 for each subsequent 30-minute period of bike usage following the initial 30 minutes from the start of the rental.
+            The pricing policy described above pertains to the current basic subscription for Santander bikes in London.
+        3. The above mentioned charge varies depending on yearly and premium subscripition.
+            Mixes of tariffs can be configured to simulate different shares of subscriptions.
+        4. The calculated profitability does not include the initial subscription fee.
+        """
+
+        # The histogram is also saved, to evaluate further pricing scenarios offline
+        self.info_tracker.duration_histogram = self.__extract_duration_histogram()
+        self.info_tracker.duration_histogram.to_parquet(
+            os.path.join(self.config.paths2create.aggregates, "duration_histogram.parquet"),
+            index=False
+        )
+
+        engine = RevenueEngine(
+            histogram=self.info_tracker.duration_histogram,
+            bin_width_secs=self.config.revenue.bin_width_secs,
+            max_duration_secs=self.config.revenue.max_duration_secs
+        )
+        tariffs = RevenueEngine.read_tariffs(tariffs=self.config.revenue.tariffs, tariff_mixes=self.config.revenue.tariff_mixes)
+        tariffs_by_name = {tariff.name: tariff for tariff in tariffs}
+
+        self.info_tracker.revenue_per_station_year_by_tariff = engine.evaluate(tariffs=tariffs, tariffs_by_name=tariffs_by_name)
+
+        return engine.top_stations_per_year(
+            tariff=tariffs_by_name[self.config.revenue.default_tariff],
+            n=3,
+            tariffs_by_name=tariffs_by_name
+        )
+
     def __plot_most_profitable_stations_per_year(self):
         """ Create an interactive bar chart with multiple categories to show the most_profitable_stations_per_year. """
         name = "Most_profitable_stations_per_year"
@@ -562,19 +579,22 @@ class DataExplorer:
         fig.write_html(os.path.join(self.config.paths2create.plots_path, name + ".html"))
 
     def __identify_the_most_popular_roots_of_all_time(self) -> pd.DataFrame:
-        """ Identify the 20 most popular roots of all time. """
+        """ Identify the 20 most popular roots of all time. The routes are keyed by station ids, so renamed stations are not split. """
 
         # Build query.
         query_job = self.__gcp_client.query(
             f"""
             SELECT 
-                start_station_name, 
-                end_station_name, 
+                ANY_VALUE(start_station_name) AS start_station_name, 
+                ANY_VALUE(end_station_name) AS end_station_name, 
                 COUNT(*) AS frequency
             FROM 
                 bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_station_id IS NOT NULL
+                AND end_station_id IS NOT NULL
             GROUP BY 
-                start_station_name, end_station_name
+                start_station_id, end_station_id
             ORDER BY 
                 frequency DESC
             LIMIT 20;
@@ -584,7 +604,7 @@ class DataExplorer:
         return df
 
     def __identify_the_most_popular_roots_per_year(self) -> pd.DataFrame:
-        """ Identify the 3 most popular roots per year. """
+        """ Identify the 3 most popular roots per year. The routes are keyed by station ids, so renamed stations are not split. """
 
         # Build query.
         query_job = self.__gcp_client.query(
@@ -592,15 +612,18 @@ class DataExplorer:
             WITH PopularRoots AS (
                 SELECT
                     EXTRACT(YEAR FROM start_date) AS year,
-                    start_station_name, 
-                    end_station_name, 
+                    ANY_VALUE(start_station_name) AS start_station_name, 
+                    ANY_VALUE(end_station_name) AS end_station_name, 
                     COUNT(*) AS number_of_routes
                 FROM
                     bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+                WHERE
+                    start_station_id IS NOT NULL
+                    AND end_station_id IS NOT NULL
                 GROUP BY
                     year,
-                    start_station_name, 
-                    end_station_name
+                    start_station_id, 
+                    end_station_id
             )
             
             SELECT
@@ -640,6 +663,8 @@ class DataExplorer:
                 ROUND(SUM(duration / 3600), 2) AS total_duration
             FROM
                 bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                {self.__duration_condition}
             GROUP BY
                 day_of_week,
                 hour_of_day
@@ -703,7 +728,86 @@ class DataExplorer:
         # Save figure.
         fig.write_html(os.path.join(self.config.paths2create.plots_path, name + ".html"))
 
-    def __create_cycle_hire_data_with_london_borough_name(self):
+    def __create_cycle_hire_data_with_london_borough_name(self) -> pd.DataFrame:
+        """
+        Sum the riding duration in hours per London borough, to identify the boroughs with the highest riding duration.
+        The borough names are assigned based on the start_station_id of the rides.
+        If the station aggregate of the DataAggregator class and the station boroughs of the DataPreprocessor class are available,
+        the boroughs are rolled up locally, which also saves the per-year and per-hour breakdowns in the info_tracker object.
+        Otherwise the cycle_hire table is joined with the uploaded borough table in BigQuery.
+        """
+
+        station_aggregate = self.__load_station_year_hour_aggregate()
+        station_boroughs = self.info_tracker.cycle_station_data_with_borough_names
+
+        if station_aggregate is None or station_boroughs is None:
+            return self.__join_cycle_hire_with_borough_table_in_bigquery()
+
+        return self.__roll_up_duration_per_borough(station_aggregate=station_aggregate, station_boroughs=station_boroughs)
+
+    def __load_station_year_hour_aggregate(self):
+        """ Get the station aggregate from the info tracker, or from the aggregates directory if it was created by a previous run. """
+
+        if self.info_tracker.station_year_hour_aggregate is not None:
+            return self.info_tracker.station_year_hour_aggregate
+
+        from ..model_development.data_aggregation import DataAggregator
+        path = os.path.join(self.config.paths2create.aggregates, DataAggregator.STATION_YEAR_HOUR_FILE)
+        if os.path.exists(path):
+            return pd.read_parquet(path)
+        return None
+
+    def __roll_up_duration_per_borough(self, station_aggregate: pd.DataFrame, station_boroughs: pd.DataFrame) -> pd.DataFrame:
+        """
+        Roll up the riding duration of the station aggregate per borough, per borough and year, and per borough and hour of day.
+        Each row of the aggregate is mapped to its borough with a hash index over the station ids,
+        and the three rollups are computed in the same pass with np.bincount over the borough codes.
+        Stations without a borough get a missing borough name, as in the LEFT JOIN of the BigQuery version.
+        """
+
+        # Hash index from station id to borough code. The last code is used for stations without a borough.
+        borough_names, station_borough_codes = np.unique(station_boroughs["borough_name"].astype(str).to_numpy(), return_inverse=True)
+        positions = pd.Index(station_boroughs["id"]).get_indexer(station_aggregate["start_station_id"])
+        codes = np.where(positions >= 0, station_borough_codes[positions], len(borough_names))
+        names = np.append(borough_names.astype(object), None)
+        n_boroughs = len(names)
+
+        duration = station_aggregate["total_duration_in_hours"].to_numpy(dtype=float)
+        rides = station_aggregate["number_of_rides"].to_numpy(dtype=float)
+        years, year_codes = np.unique(station_aggregate["year"].to_numpy(dtype=np.int64), return_inverse=True)
+        hours = station_aggregate["hour"].to_numpy(dtype=np.int64)
+
+        def roll_up(keys: np.ndarray, n_keys: int):
+            return (
+                np.bincount(keys, weights=duration, minlength=n_keys),
+                np.bincount(keys, weights=rides, minlength=n_keys)
+            )
+
+        total_duration, total_rides = roll_up(keys=codes, n_keys=n_boroughs)
+        year_duration, year_rides = roll_up(keys=codes * len(years) + year_codes, n_keys=n_boroughs * len(years))
+        hour_duration, hour_rides = roll_up(keys=codes * 24 + hours, n_keys=n_boroughs * 24)
+
+        # Keep only the combinations with rides
+        per_year = pd.DataFrame({
+            "borough_name": np.repeat(names, len(years)),
+            "year": np.tile(years, n_boroughs),
+            "total_duration_in_hours": year_duration.round(2)
+        })[year_rides > 0].reset_index(drop=True)
+        per_hour = pd.DataFrame({
+            "borough_name": np.repeat(names, 24),
+            "hour": np.tile(np.arange(24), n_boroughs),
+            "total_duration_in_hours": hour_duration.round(2)
+        })[hour_rides > 0].reset_index(drop=True)
+
+        self.info_tracker.total_duration_per_borough_per_year = per_year
+        self.info_tracker.total_duration_per_borough_per_hour = per_hour
+
+        return pd.DataFrame({
+            "borough_name": names,
+            "total_duration_in_hours": total_duration.round(2)
+        })[total_rides > 0].reset_index(drop=True)
+
+    def __join_cycle_hire_with_borough_table_in_bigquery(self) -> pd.DataFrame:
         """
         Join cycle hire table and the processed station table created and saved by the preproc_data class,
         to create a cycle hire table with London borough names.
@@ -712,6 +816,12 @@ class DataExplorer:
         So, we sum the duration duration is also divided by 3600 to be converted in hours and we group by the borough name.
         """
 
+        duration_condition = DurationBounds.sql_condition_from_config(
+            config=self.config,
+            duration_column="hire_table.duration",
+            date_column="hire_table.start_date"
+        )
+
         # Build query
         query_job = self.__gcp_client.query(
             f"""
@@ -726,6 +836,7 @@ class DataExplorer:
                 hire_table.start_station_id = station_table.id
             WHERE 
                 hire_table.start_station_id IS NOT NULL
+                AND {duration_condition}
             GROUP BY 
                 station_table.borough_name;
             """
@@ -734,86 +845,42 @@ class DataExplorer:
         df = query_job.result().to_dataframe()
         return df
 
-    # def __make_an_interactive_london_map_with_boroughs_n_riding_duration(self):
-    #     """ xxx """
-
-    #     # Get data from info tracker
-    #     duration_data = self.info_tracker.total_duartion_per_borough
-
-    #     # Load London geo data
-    #     geojson_path = os.path.join(self.config.paths.london_geodata_dir, self.config.paths.london_geodata_file)
-    #     gdf = gpd.read_file(geojson_path)
-    #     # Convert the geo-df into pandas df
-    #     pd_gdf = pd.DataFrame(gdf)
-
-    #     # Merge the duration df and the London geo-df
-    #     # And fill missing values with 0
-    #     merged_df = pd_gdf.merge(duration_data, how="left", left_on="name", right_on="borough_name")
-    #     merged_df["total_duration_in_hours"].fillna(0, inplace=True)
-    #     merged_df.drop(columns=["borough_name"], inplace=True)
-    #     merged_gdf = gpd.GeoDataFrame(merged_df)        
-
-    #     # Create a colourmap considering the total_duration values
-    #     colormap = linear.YlGnBu_09.scale(
-    #         merged_gdf["total_duration_in_hours"].min(), 
-    #         merged_gdf["total_duration_in_hours"].max()
-    #     )
-    #     colormap.caption = "Total duration color map"
-
-    #     # Calculate the bounding box of the London boroughs
-    #     bbox = merged_gdf.total_bounds
-        
-    #     # Create a blank map with a transparent background
-    #     m = folium.Map(
-    #         location=[(bbox[1] + bbox[3]) / 2, (bbox[0] + bbox[2]) / 2],
-    #         zoom_start=12,
-    #         tiles=None,
-    #     )
-
-    #     # Define a colourmap function
-    #     def color_mapper(feature):
-    #         return colormap(feature["properties"]["total_duration_in_hours"])
-
-    #     # Add GeoJSON data for London boroughs to the map with colors based on total_duration_in_hours
-    #     folium.GeoJson(
-    #         merged_gdf,
-    #         name="London Boroughs",
-    #         style_function=lambda x: {
-    #             "fillColor": color_mapper(x),
-    #             "color": 'black',
-    #             "weight": 2,
-    #             "fillOpacity": 0.7,
-    #         },
-    #         highlight_function=lambda x: {
-    #             "weight": 5,
-    #             "color": "black",
-    #         },
-    #         tooltip=folium.GeoJsonTooltip(
-    #             fields=["name", "total_duration_in_hours"], 
-    #             aliases=["Borough", "Total riding duration (hours)"], 
-    #             labels=True
-    #         ),
-    #     ).add_to(m)
-
-    #     # Add the colorbar to the map
-    #     colormap.add_to(m)
-        
-    #     # Add borough names as markers
-    #     for index, row in gdf.iterrows():
-    #         centroid = row["geometry"].centroid
-    #         folium.Marker(
-    #             location=[centroid.y, centroid.x],
-    #             icon=folium.DivIcon(
-    #                 html=f"<div style='font-size: 6pt; font-weight: bold;'>{row['name']}</div>",
-    #                 icon_size=(50, 50),
-    #             ),
-    #             popup=row["name"],
-    #         ).add_to(m)
-        
-    #     # Save the map to an HTML file
-    #     m.save(os.path.join(self.config.paths.plots_path, "london_boroughs_colored_by_extra_data_matplotlib_cmap_map3.html"))
-        
+    def __make_an_interactive_london_map_with_boroughs_n_riding_duration(self):
+        """
+        Colour the London boroughs by total riding duration, using the BoroughChoropleth class.
+        The simplified borough geometry is built once and cached in the aggregates directory.
+        A layer per year is added if the per-year durations were rolled up locally, and all layers share the same geometry.
+        """
+
+        settings = self.config.borough_map
+        topology = BoroughTopology.load_or_build(
+            geojson_path=os.path.join(self.config.existing_paths.london_geodata_dir, self.config.existing_paths.london_geodata_file),
+            cache_path=os.path.join(self.config.paths2create.aggregates, "london_boroughs.topojson"),
+            tolerance=settings.simplify_tolerance,
+            quantization=settings.quantization
+        )
+        choropleth = BoroughChoropleth(topology=topology)
+
+        layers = {"All years": choropleth.layer(df=self.info_tracker.total_duartion_per_borough, value_column="total_duration_in_hours")}
+        per_year = self.info_tracker.total_duration_per_borough_per_year
+        if settings.per_year_layers and per_year is not None:
+            for year, df in per_year.groupby("year", sort=True):
+                layers[str(year)] = choropleth.layer(df=df, value_column="total_duration_in_hours")
+
+        # Save the map to an HTML file
+        choropleth.render(
+            layers=layers,
+            path=os.path.join(self.config.paths2create.plots_path, "london_boroughs_total_riding_duration.html"),
+            title="Total riding duration per London borough",
+            value_label="Total riding duration (hours)"
+        )
+
     def prepare_data_for_modelling(self):
+        """ Call DataEngineer class to prepare the data for modelling. """
+
+        # Imported here, so the profiling library is only loaded when the data engineering step is reached
+        from ..model_development.data_engineering import DataEngineer
+
         return DataEngineer(
             config=self.config,
             info_tracker=self.info_tracker,
@@ -0,0 +1,152 @@
+""" Precompute the aggregates of the London Cycle Hire data that are served by the analytics query service. """
+
+import os
+import pandas as pd
+from ..model_development.duration_quality import DurationBounds
+from ..model_development.station_dimension import StationDimension
+
+
+class DataAggregator:
+    """
+    Precompute the full aggregates of the cycle_hire table, so new questions can be answered locally without scanning the warehouse.
+        1. Aggregate the rides and the riding duration per year, hour and starting station.
+        2. Aggregate the rides and the riding duration per year and route (starting station and end station).
+        3. Save the station to borough mapping created by the DataPreprocessor class, if available.
+        4. Build the time-valid station dimension and count the stations existing in each year of the rides.
+        5. Save all aggregates as Parquet files in the aggregates directory and in the info_tracker object.
+    The duration outliers are trimmed with the bounds of the DurationQualityChecker class, if enabled in the config.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    STATION_YEAR_HOUR_FILE = "station_year_hour.parquet"
+    ROUTE_YEAR_FILE = "route_year.parquet"
+    STATION_BOROUGH_FILE = "station_borough.parquet"
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__duration_condition = DurationBounds.sql_condition_from_config(config=self.config)
+
+        self.info_tracker.station_year_hour_aggregate = self.__aggregate_rides_per_station_year_n_hour()
+        self.__save_aggregate(df=self.info_tracker.station_year_hour_aggregate, file_name=self.STATION_YEAR_HOUR_FILE)
+        self.info_tracker.route_year_aggregate = self.__aggregate_rides_per_route_n_year()
+        self.__save_aggregate(df=self.info_tracker.route_year_aggregate, file_name=self.ROUTE_YEAR_FILE)
+        self.__save_station_borough_mapping()
+        self.station_dimension = StationDimension(versions=self.__load_station_versions())
+        self.station_dimension.save(directory=self.config.paths2create.aggregates)
+        self.info_tracker.stations_per_year = self.station_dimension.count_per_year(
+            years=self.info_tracker.station_year_hour_aggregate["year"].unique().tolist()
+        )
+
+    def __aggregate_rides_per_station_year_n_hour(self) -> pd.DataFrame:
+        """ Count the rides and sum the riding duration in hours per year, hour of day and starting station. """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                EXTRACT(YEAR FROM start_date) AS year,
+                EXTRACT(HOUR FROM start_date) AS hour,
+                start_station_id,
+                ANY_VALUE(start_station_name) AS start_station_name,
+                COUNT(rental_id) AS number_of_rides,
+                SUM(duration / 3600) AS total_duration_in_hours
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND {self.__duration_condition}
+            GROUP BY
+                year,
+                hour,
+                start_station_id;
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __aggregate_rides_per_route_n_year(self) -> pd.DataFrame:
+        """ Count the rides and sum the riding duration in hours per year and route. """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                EXTRACT(YEAR FROM start_date) AS year,
+                start_station_id,
+                ANY_VALUE(start_station_name) AS start_station_name,
+                end_station_id,
+                ANY_VALUE(end_station_name) AS end_station_name,
+                COUNT(rental_id) AS number_of_rides,
+                SUM(duration / 3600) AS total_duration_in_hours
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND end_station_id IS NOT NULL
+                AND {self.__duration_condition}
+            GROUP BY
+                year,
+                start_station_id,
+                end_station_id;
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __load_station_versions(self) -> pd.DataFrame:
+        """ Load the attributes and the install and removal dates of each station. """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                id,
+                name,
+                installed,
+                locked,
+                temporary,
+                bikes_count,
+                docks_count,
+                install_date,
+                removal_date
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.station_table}
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __save_station_borough_mapping(self):
+        """ Save the station id, name and borough name of each station, if the boroughs were identified in preprocessing. """
+
+        station_data = self.info_tracker.cycle_station_data_with_borough_names
+        if station_data is None:
+            return
+
+        self.__save_aggregate(
+            df=station_data[["id", "name", "borough_name"]],
+            file_name=self.STATION_BOROUGH_FILE
+        )
+
+    def __save_aggregate(self, df: pd.DataFrame, file_name: str):
+        """ Save an aggregate as a Parquet file in the aggregates directory. """
+        df.to_parquet(os.path.join(self.config.paths2create.aggregates, file_name), index=False)
+
+    def explore_data(self):
+        """ Call DataExplorer class to explore the data. """
+
+        # Imported here, so the plotting libraries are only loaded when the exploration step is reached
+        from ..model_development.data_3exploration import DataExplorer
+
+        return DataExplorer(
+            config=self.config,
+            info_tracker=self.info_tracker,
+            gcp_client=self.__gcp_client
+        )
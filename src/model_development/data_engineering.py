@@ -1,13 +1,16 @@
 """ Data Engineering class. """
 
 import os
-from ydata_profiling import ProfileReport
-# from ..model_development.s5_build_model_train_n_test import ModelBuilderTrainerTester
+from typing import Callable, Dict
+import pandas as pd
 
 
 class DataEngineer:
 
-    def __init__(self, config, info_tracker, gcp_client):
+    # The name of the prefetched modelling extract
+    MODELLING_EXTRACT = "modelling_extract"
+
+    def __init__(self, config, info_tracker, gcp_client, prefetcher=None):
         """
         Extract data for modelling and run data engineering for the specific dataset only.
 
@@ -20,18 +23,30 @@ class DataEngineer:
             month
             day
             hour
+            docks_count (only if the capacity feature is enabled, from the station version valid at that hour)
             rental_count (this attribute is removed at the end of engineering process)
             labels (the labels are created based on the rental count)
 
         An Exploratory Data Analysis report is created and saved for the specific dataset.
+        The hourly rental counts of the stations are plotted with the DemandTimeSeriesPlot class, if enabled in the config.
+
+        The extract does not depend on the earlier stages, so the pipeline runner can start it at the beginning of the pipeline
+        with a QueryPrefetcher. In that case the prefetched extract is used instead of querying it again.
         """
         
         self.config = config
         self.info_tracker = info_tracker
         self.__gcp_client = gcp_client
 
-        self.__data_for_modelling = self.__extract_data_for_modelling()
+        if prefetcher is not None and prefetcher.has(self.MODELLING_EXTRACT):
+            self.__data_for_modelling = prefetcher.take(self.MODELLING_EXTRACT)
+        else:
+            self.__data_for_modelling = self.extract_data_for_modelling(config=self.config, gcp_client=self.__gcp_client)
+        if self.config.engineering.capacity_feature:
+            self.__add_station_capacity_as_of_each_hour()
         self.__plot_rental_count_distribution()
+        if self.config.demand_timeseries.enabled:
+            self.__plot_hourly_rental_count_per_station()
         self.__bin_rental_count_to_create_classes()
         self.__remove_rental_count_attribute()
         self.__create_eda_report_for_modelling_data()
@@ -40,21 +55,27 @@ class DataEngineer:
     def data_for_modelling(self):
         return self.__data_for_modelling 
 
-    # Build query
-    def __extract_data_for_modelling(self):
+    @classmethod
+    def prefetch_jobs(cls, config) -> Dict[str, Callable]:
+        """ The jobs of this stage that the pipeline runner can start in advance. Each job takes the bigquery client. """
+        return {cls.MODELLING_EXTRACT: lambda gcp_client: cls.extract_data_for_modelling(config=config, gcp_client=gcp_client)}
+
+    @staticmethod
+    def extract_data_for_modelling(config, gcp_client) -> pd.DataFrame:
         """ Extract the cycle_data only for the 20 busiest stations. """
 
-        query_job = self.__gcp_client.query(
+        # Build query
+        query_job = gcp_client.query(
             f"""
             WITH Top20Stations AS (
                 SELECT *
                 FROM 
-                    bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+                    bigquery-public-data.london_bicycles.{config.database.hire_table}
                 WHERE 
                     start_station_id 
                 IN (
                     SELECT start_station_id
-                    FROM bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+                    FROM bigquery-public-data.london_bicycles.{config.database.hire_table}
                     WHERE start_station_id IS NOT NULL
                     GROUP BY start_station_id
                     ORDER BY COUNT(rental_id) DESC
@@ -79,10 +100,40 @@ class DataEngineer:
 
         return query_job.result().to_dataframe()
 
+    def __add_station_capacity_as_of_each_hour(self):
+        """ Add the docks count of the station version valid at each hour, with an as-of lookup in the station dimension. """
+
+        from ..model_development.station_dimension import StationDimension
+
+        if not os.path.exists(os.path.join(self.config.paths2create.aggregates, StationDimension.FILE)):
+            raise ValueError("The capacity feature needs the station dimension created by the DataAggregator class.")
+
+        station_dimension = StationDimension.load(directory=self.config.paths2create.aggregates)
+        hours = pd.to_datetime(self.data_for_modelling[["year", "month", "day", "hour"]])
+        self.data_for_modelling["docks_count"] = station_dimension.lookup(
+            column="docks_count",
+            station_ids=self.data_for_modelling["start_station_id"].to_numpy(),
+            times=hours
+        ).to_numpy()
+
     def __plot_rental_count_distribution(self):
         """ Plot the distribution of the rental_count attribute. """
         self.data_for_modelling.rental_count.plot.hist()
 
+    def __plot_hourly_rental_count_per_station(self):
+        """ Plot the hourly rental_count of each station over all years, with daily and weekly levels for the zoomed-out views. """
+
+        from ..model_development.demand_timeseries_plot import DemandTimeSeriesPlot
+
+        name = "Hourly_rental_count_of_the_20_busiest_stations"
+        plot = DemandTimeSeriesPlot(
+            data=self.data_for_modelling,
+            points_per_trace=self.config.demand_timeseries.points_per_trace,
+            daily_max_days=self.config.demand_timeseries.daily_max_days,
+            hourly_max_days=self.config.demand_timeseries.hourly_max_days
+        )
+        plot.write_html(path=os.path.join(self.config.paths2create.plots_path, name + ".html"), title=name.replace("_", " "))
+
     def __bin_rental_count_to_create_classes(self):
         """ 
         Create classes based on the rental_count attribute.
@@ -110,6 +161,9 @@ class DataEngineer:
     def __create_eda_report_for_modelling_data(self):
         """ Create an Exploratory Data Analysis report. """
 
+        # Imported here, as ydata_profiling is the slowest import of the pipeline
+        from ydata_profiling import ProfileReport
+
         # Prepare EDA report
         profile = ProfileReport(
             self.data_for_modelling
@@ -121,10 +175,33 @@ class DataEngineer:
             "eda_report.html"
         ))
 
-    # def build_ml_model_train_n_test(self):
-    #     return ModelBuilderTrainerTester(
-    #         config=self.config,
-    #         info_tracker=self.info_tracker,
-    #         data=self.data_for_modelling
-    #     )
-       
\ No newline at end of file
+    def build_ml_model_train_n_test(self):
+        """
+        Call ModelBuilderTrainerTester class to build, train and test the model.
+        FastModelSearch class is called instead in the fast search mode, and IncrementalModelTrainer class in the incremental training mode.
+        """
+
+        if self.config.modelling.training_mode == "incremental":
+            from ..model_development.incremental_training import IncrementalModelTrainer
+            return IncrementalModelTrainer(
+                config=self.config,
+                info_tracker=self.info_tracker,
+                data=self.data_for_modelling
+            )
+
+        if self.config.modelling.search_mode == "fast":
+            from ..model_development.fast_model_search import FastModelSearch
+            return FastModelSearch(
+                config=self.config,
+                info_tracker=self.info_tracker,
+                data=self.data_for_modelling
+            )
+
+        # Imported here to avoid initiating h2o unless the modelling step is reached
+        from ..model_development.model_development import ModelBuilderTrainerTester
+
+        return ModelBuilderTrainerTester(
+            config=self.config,
+            info_tracker=self.info_tracker,
+            data=self.data_for_modelling
+        )
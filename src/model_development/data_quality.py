@@ -0,0 +1,223 @@
+""" Count the null values of the London Cycle Hire data and save the results in the info_tracker object. """
+
+import json
+import os
+from statistics import NormalDist
+from typing import List
+import numpy as np
+import pandas as pd
+from ..model_development.data_1preview import DataPreviewer
+
+
+class DataQualityChecker:
+    """
+    Count the null values of the cycle_hire and the cycle_stations tables.
+    The columns to check are read from the table metadata, so the queries follow the table schema.
+    Three modes are available, selected by the data_quality configuration:
+        1. exact: Count the null values of every column with a single scan of each table.
+        2. incremental: Count the null values per year of the partition column and cache them.
+           If the table has not been modified since the last run, no query is run.
+           Otherwise the years from the last cached year onwards, and the rows without a year, are counted again.
+           Rows added to earlier years (e.g. backfills) are detected by comparing the row counts with the table metadata,
+           and the whole table is counted again.
+           Tables without the partition column are cached as a single partition.
+        3. sampled: Estimate the null values from a TABLESAMPLE of the table.
+           The estimates are reported with Wilson confidence intervals and scaled to the row count of the table metadata.
+           TABLESAMPLE SYSTEM samples storage blocks, not rows, so the intervals are optimistic for clustered data.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    NULL_PARTITION = "null"
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+
+        mode = self.config.data_quality.null_counts_mode
+        if mode == "exact":
+            self.info_tracker.hires_null_values_count = self.__count_null_values(table=self.config.database.hire_table)
+            self.info_tracker.stations_null_values_count = self.__count_null_values(table=self.config.database.station_table)
+        elif mode == "incremental":
+            self.info_tracker.hires_null_values_per_partition = self.__count_null_values_incrementally(table=self.config.database.hire_table)
+            self.info_tracker.hires_null_values_count = self.__sum_partitions(self.info_tracker.hires_null_values_per_partition)
+            self.info_tracker.stations_null_values_count = self.__sum_partitions(
+                self.__count_null_values_incrementally(table=self.config.database.station_table)
+            )
+        elif mode == "sampled":
+            self.info_tracker.hires_null_values_estimate = self.__estimate_null_values(table=self.config.database.hire_table)
+            self.info_tracker.hires_null_values_count = self.__estimate_to_counts(self.info_tracker.hires_null_values_estimate)
+            self.info_tracker.stations_null_values_estimate = self.__estimate_null_values(table=self.config.database.station_table)
+            self.info_tracker.stations_null_values_count = self.__estimate_to_counts(self.info_tracker.stations_null_values_estimate)
+        else:
+            raise ValueError(f"Unknown null_counts_mode '{mode}'. Use 'exact', 'incremental' or 'sampled'.")
+
+    def __nullable_columns(self, table_metadata) -> List[str]:
+        """ Return the columns whose null values can be counted, i.e. all columns except repeated and nested fields. """
+        return [
+            field.name for field in table_metadata.schema
+            if field.mode != "REPEATED" and field.field_type not in ("RECORD", "STRUCT")
+        ]
+
+    @staticmethod
+    def __build_null_count_select(columns: List[str]) -> str:
+        """ Build the select expressions that count the null values of the given columns. """
+        return ",\n".join(f"COUNTIF({column} IS NULL) AS {column}_null_count" for column in columns)
+
+    def __count_null_values(self, table: str) -> pd.DataFrame:
+        """ Count null values for each column in the given table, with a single scan of the table. """
+
+        table_metadata = self.__gcp_client.get_table(DataPreviewer.table_id(table=table))
+        columns = self.__nullable_columns(table_metadata=table_metadata)
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+              {self.__build_null_count_select(columns=columns)}
+            FROM {DataPreviewer.table_id(table=table)}
+            """
+        )
+        # Call query and extract data in pandas df
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __count_null_values_incrementally(self, table: str) -> pd.DataFrame:
+        """
+        Count null values for each column and each year of the partition column, using the cached counts of previous runs.
+        Only the last cached year onwards is counted again, unless the row counts no longer add up to the rows of the table.
+        """
+
+        table_metadata = self.__gcp_client.get_table(DataPreviewer.table_id(table=table))
+        columns = self.__nullable_columns(table_metadata=table_metadata)
+        table_modified = table_metadata.modified.isoformat()
+        partition_column = self.config.data_quality.partition_column
+        is_partitioned = partition_column in columns
+
+        # Load the cache of previous runs. It is only valid for the same table schema.
+        cache_path = os.path.join(self.config.paths2create.data_quality_cache, f"{table}_null_counts.json")
+        cache = {"table_modified": None, "columns": columns, "partitions": {}}
+        if os.path.exists(cache_path):
+            with open(cache_path) as file:
+                cached = json.load(file)
+            if cached["columns"] == columns:
+                cache = cached
+
+        # Count again only if the table has changed since the last run
+        if cache["table_modified"] != table_modified:
+            cached_years = [int(key) for key in cache["partitions"] if key != self.NULL_PARTITION]
+            count_all = not is_partitioned or not cached_years
+            if not count_all:
+                # New rows mostly arrive in the last cached year and later ones, e.g. late rides of December appended in January
+                where_clause = f"WHERE {partition_column} >= TIMESTAMP('{max(cached_years)}-01-01') OR {partition_column} IS NULL"
+                cache["partitions"].update(self.__count_partitions(table=table, columns=columns, is_partitioned=True, where_clause=where_clause))
+                # Rows added to earlier years are not counted above, and leave the partitions short of the table rows
+                counted_rows = sum(partition["row_count"] for partition in cache["partitions"].values())
+                count_all = counted_rows != table_metadata.num_rows
+            if count_all:
+                cache["partitions"] = self.__count_partitions(table=table, columns=columns, is_partitioned=is_partitioned, where_clause="")
+
+            cache["table_modified"] = table_modified
+            with open(cache_path, "w") as file:
+                json.dump(cache, file, indent=2)
+
+        df = pd.DataFrame.from_dict(cache["partitions"], orient="index")
+        df.index.name = "partition"
+        return df.sort_index()
+
+    def __count_partitions(self, table: str, columns: List[str], is_partitioned: bool, where_clause: str) -> dict:
+        """ Count the rows and the null values per year of the partition column, for the rows of the where clause. """
+
+        partition_column = self.config.data_quality.partition_column
+        partition_expression = f"EXTRACT(YEAR FROM {partition_column})" if is_partitioned else "NULL"
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+              {partition_expression} AS partition_key,
+              COUNT(*) AS row_count,
+              {self.__build_null_count_select(columns=columns)}
+            FROM {DataPreviewer.table_id(table=table)}
+            {where_clause}
+            GROUP BY partition_key
+            """
+        )
+        df = query_job.result().to_dataframe()
+
+        partitions = {}
+        for record in df.to_dict(orient="records"):
+            partition = record.pop("partition_key")
+            key = self.NULL_PARTITION if pd.isna(partition) else str(int(partition))
+            partitions[key] = {name: int(value) for name, value in record.items()}
+        return partitions
+
+    @staticmethod
+    def __sum_partitions(per_partition: pd.DataFrame) -> pd.DataFrame:
+        """ Sum the null counts of all partitions into a single row, in the same format as the exact mode. """
+        return per_partition.drop(columns="row_count").sum().to_frame().T.reset_index(drop=True)
+
+    def __estimate_null_values(self, table: str) -> pd.DataFrame:
+        """
+        Estimate the null values for each column from a TABLESAMPLE of the given table.
+        Each column gets the sampled null fraction, its Wilson confidence interval and the estimated null count for the whole table.
+        """
+
+        table_metadata = self.__gcp_client.get_table(DataPreviewer.table_id(table=table))
+        columns = self.__nullable_columns(table_metadata=table_metadata)
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+              COUNT(*) AS sampled_rows,
+              {self.__build_null_count_select(columns=columns)}
+            FROM {DataPreviewer.table_id(table=table)} TABLESAMPLE SYSTEM ({self.config.data_quality.sample_percent} PERCENT)
+            """
+        )
+        sample = query_job.result().to_dataframe().iloc[0]
+
+        n = float(sample["sampled_rows"])
+        null_counts = np.array([sample[f"{column}_null_count"] for column in columns], dtype=float)
+        z = NormalDist().inv_cdf(0.5 + self.config.data_quality.confidence_level / 2)
+
+        # Wilson score interval of the null fraction, vectorised over the columns
+        with np.errstate(invalid="ignore", divide="ignore"):
+            fraction = null_counts / n
+            denominator = 1 + z ** 2 / n
+            centre = (fraction + z ** 2 / (2 * n)) / denominator
+            half_width = z * np.sqrt(fraction * (1 - fraction) / n + z ** 2 / (4 * n ** 2)) / denominator
+
+        df = pd.DataFrame({
+            "column_name": columns,
+            "sampled_rows": int(n),
+            "sampled_null_count": null_counts.astype(int),
+            "null_fraction": fraction,
+            "null_fraction_ci_low": np.clip(centre - half_width, 0, 1),
+            "null_fraction_ci_high": np.clip(centre + half_width, 0, 1),
+        })
+        df["estimated_null_count"] = (df["null_fraction"] * table_metadata.num_rows).round()
+        df["estimated_null_count_ci_low"] = (df["null_fraction_ci_low"] * table_metadata.num_rows).round()
+        df["estimated_null_count_ci_high"] = (df["null_fraction_ci_high"] * table_metadata.num_rows).round()
+        return df
+
+    @staticmethod
+    def __estimate_to_counts(estimate: pd.DataFrame) -> pd.DataFrame:
+        """ Reshape the estimated null counts into a single row, in the same format as the exact mode. """
+        counts = estimate.set_index(estimate["column_name"] + "_null_count")["estimated_null_count"].rename_axis(None)
+        return counts.to_frame().T.reset_index(drop=True)
+
+    def preprocess_data(self):
+        """ Call DataPreprocessor class to preprocess the data. """
+
+        # Imported here, so the geo-spatial libraries are only loaded when the preprocessing step is reached
+        from ..model_development.data_2preprocessing import DataPreprocessor
+
+        return DataPreprocessor(
+            config=self.config,
+            info_tracker=self.info_tracker,
+            gcp_client=self.__gcp_client
+        )
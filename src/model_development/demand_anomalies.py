@@ -0,0 +1,317 @@
+""" Seasonal anomaly detection of the hourly station demand, with robust baselines per station, day of week and hour. """
+
+import os
+from typing import Callable, Dict, List
+import numpy as np
+import pandas as pd
+
+HOURS_PER_WEEK = 7 * 24
+# Epoch hour 0 is a Thursday, so Monday 00:00 is 72 hours earlier
+MONDAY_OFFSET_HOURS = 72
+# Scales the MAD to the standard deviation of normally distributed counts
+MAD_SCALE = 1.4826
+# The bulk pass stores the counts doubled in int16, so the median of an even number of weeks stays an integer,
+# and the sorting moves half the bytes of float32. Hours that were not observed hold the largest int16, so they sort last.
+UNOBSERVED = np.iinfo(np.int16).max
+MAX_COUNT = (UNOBSERVED - 1) // 2
+
+
+def nan_median(values: np.ndarray) -> np.ndarray:
+    """ The median over the last axis, ignoring NaN, with a single sort of the whole array. NaN where every value is NaN. """
+
+    ordered = np.sort(values, axis=-1)
+    n = (~np.isnan(values)).sum(axis=-1, keepdims=True)
+    lower = np.take_along_axis(ordered, np.maximum((n - 1) // 2, 0), axis=-1)
+    upper = np.take_along_axis(ordered, n // 2 - (n == 0), axis=-1)
+    median = ((lower + upper) / 2)[..., 0]
+    median[n[..., 0] == 0] = np.nan
+    return median
+
+
+def robust_scores(counts: np.ndarray, windows: np.ndarray, min_mad: float):
+    """
+    Score the counts against the same hour of the previous weeks, given over the last axis of windows (NaN if not observed).
+    The score is the distance from the median in scaled MADs. The MAD is floored at min_mad, so quiet stations are not flagged for a ride or two.
+
+    :return: The scores, the medians, the MADs and the number of observed weeks, each with the shape of counts.
+    """
+
+    median = nan_median(windows)
+    mad = nan_median(np.abs(windows - median[..., None]))
+    scores = (counts - median) / (MAD_SCALE * np.maximum(mad, min_mad))
+    return scores, median, mad, (~np.isnan(windows)).sum(axis=-1)
+
+
+def sort_weeks(weeks: List[np.ndarray]):
+    """ Sort equally shaped arrays element-wise in place, with an odd-even transposition network of vectorised minimums and maximums. """
+
+    buffer = np.empty_like(weeks[0])
+    for round_ in range(len(weeks)):
+        for i in range(round_ % 2, len(weeks) - 1, 2):
+            np.minimum(weeks[i], weeks[i + 1], out=buffer)
+            np.maximum(weeks[i], weeks[i + 1], out=weeks[i + 1])
+            weeks[i][...] = buffer
+
+
+def middle_sum(sorted_weeks: List[np.ndarray], observed: np.ndarray) -> np.ndarray:
+    """ The sum of the two middle observed values of element-wise sorted weeks, i.e. twice the median, as int32. """
+
+    n_weeks = len(sorted_weeks)
+    total = sorted_weeks[(n_weeks - 1) // 2].astype(np.int32) + sorted_weeks[n_weeks // 2]
+
+    # The few elements with unobserved weeks (e.g. the first weeks of a station) have their middle values earlier
+    partial = (observed > 0) & (observed < n_weeks)
+    if partial.any():
+        n = observed[partial][None].astype(np.int64)
+        stacked = np.stack([week[partial] for week in sorted_weeks])
+        lower = np.take_along_axis(stacked, (n - 1) // 2, axis=0)[0]
+        upper = np.take_along_axis(stacked, n // 2, axis=0)[0]
+        total[partial] = lower.astype(np.int32) + upper
+    return total
+
+
+def trailing_baselines(doubled: np.ndarray, window_weeks: int):
+    """
+    The median and the MAD of the same hour of the previous window_weeks weeks, for every week at once.
+
+    :param doubled: The doubled int16 counts of shape (stations, window_weeks + weeks, 168), starting with window_weeks unobserved weeks.
+    :return: The medians and the MADs in rentals (NaN without observed weeks) and the number of observed weeks, of shape (stations, weeks, 168).
+    """
+
+    n_weeks = doubled.shape[1] - window_weeks
+    weeks = [doubled[:, back:back + n_weeks].copy() for back in range(window_weeks)]
+    observed = sum((week != UNOBSERVED).astype(np.int8) for week in weeks)
+
+    sort_weeks(weeks)
+    doubled_median = (middle_sum(sorted_weeks=weeks, observed=observed) // 2).astype(np.int16)
+
+    # The deviations are reused in place of the weeks, with the unobserved weeks sorting last again
+    for week in weeks:
+        unobserved = week == UNOBSERVED
+        np.abs(week - doubled_median, out=week)
+        week[unobserved] = UNOBSERVED
+    sort_weeks(weeks)
+    mad = middle_sum(sorted_weeks=weeks, observed=observed) / np.float32(4)
+
+    median = doubled_median / np.float32(2)
+    median[observed == 0] = np.nan
+    mad[observed == 0] = np.nan
+    return median, mad, observed
+
+
+class SeasonalBaseline:
+    """
+    The streaming state of the seasonal baselines: the counts of the last window_weeks weeks of every station.
+        - The counts are stored in a stations x (window_weeks * 168) float32 ring, indexed by the week-aligned epoch hour
+          modulo the ring, so each hour overwrites the same hour window_weeks weeks earlier.
+        - Before a new hour is stored, its slot of every week holds the same day of week and hour of the previous window_weeks weeks,
+          so scoring and updating a new hour are one median over a stations x window_weeks array.
+        - Hours skipped between two updates are stored as NaN, i.e. not observed. Hours not after the last stored hour are scored only,
+          so a replay of older hours does not move the baselines back.
+
+    :param station_ids: The station ids of the ring rows.
+    :param window_weeks: The number of weeks of each baseline.
+    :param ring: The counts of the last window_weeks weeks, NaN if not observed.
+    :param last_hour: The last epoch hour stored in the ring, None if the ring is empty.
+    """
+
+    FILE = "seasonal_baseline.npz"
+
+    def __init__(self, station_ids: np.ndarray, window_weeks: int, ring: np.ndarray = None, last_hour: int = None):
+        self.station_ids = np.asarray(station_ids, dtype=np.int64)
+        self.window_weeks = window_weeks
+        self.ring = np.full((len(self.station_ids), window_weeks * HOURS_PER_WEEK), np.nan, dtype=np.float32) if ring is None else ring
+        self.last_hour = last_hour
+
+    def __position(self, hours):
+        """ The ring columns of epoch hours. """
+        return (hours + MONDAY_OFFSET_HOURS) % self.ring.shape[1]
+
+    def score(self, hour: int, counts: np.ndarray, min_mad: float):
+        """ Score the counts of every station (in the order of station_ids) in the given epoch hour, against the stored previous weeks. """
+
+        size = self.ring.shape[1]
+        slot = (hour + MONDAY_OFFSET_HOURS) % HOURS_PER_WEEK
+        windows = self.ring[:, slot::HOURS_PER_WEEK]
+
+        # Each column of the slot holds one of the previous weeks if that hour is stored, i.e. among the last ring-size hours
+        hours_back = (self.__position(hour) - (slot + np.arange(self.window_weeks) * HOURS_PER_WEEK)) % size
+        hours_back[hours_back == 0] = size
+        previous = hour - hours_back
+        if self.last_hour is not None:
+            windows = np.where((previous > self.last_hour - size) & (previous <= self.last_hour), windows, np.nan)
+        else:
+            windows = np.full_like(windows, np.nan)
+
+        return robust_scores(counts=np.asarray(counts, dtype=np.float32), windows=windows, min_mad=min_mad)
+
+    def update(self, hour: int, counts: np.ndarray, min_mad: float):
+        """ Score the counts of a new epoch hour, then store them. Return the scores, like the score method. """
+
+        scored = self.score(hour=hour, counts=counts, min_mad=min_mad)
+        if self.last_hour is not None and hour <= self.last_hour:
+            return scored
+
+        if self.last_hour is not None:
+            skipped = np.arange(self.last_hour + 1, hour)[-self.ring.shape[1]:]
+            self.ring[:, self.__position(skipped)] = np.nan
+        self.ring[:, self.__position(hour)] = counts
+        self.last_hour = hour
+        return scored
+
+    def save(self, directory: str):
+        """ Save the ring, replacing the file atomically. """
+
+        temporary_path = os.path.join(directory, "tmp_" + self.FILE)
+        np.savez(temporary_path, station_ids=self.station_ids, ring=self.ring, last_hour=np.int64(self.last_hour), window_weeks=self.window_weeks)
+        os.replace(temporary_path, os.path.join(directory, self.FILE))
+
+    @classmethod
+    def load(cls, directory: str) -> "SeasonalBaseline":
+        with np.load(os.path.join(directory, cls.FILE)) as saved:
+            return cls(
+                station_ids=saved["station_ids"],
+                window_weeks=int(saved["window_weeks"]),
+                ring=saved["ring"],
+                last_hour=int(saved["last_hour"])
+            )
+
+    @classmethod
+    def exists(cls, directory: str) -> bool:
+        return os.path.exists(os.path.join(directory, cls.FILE))
+
+
+class DemandAnomalyDetector:
+    """
+    Flag the station hours whose demand is unusual for their station, day of week and hour.
+        1. Count the rentals of every station per hour over the whole history, in a single aggregation query.
+        2. Scatter the counts into a dense stations x weeks x 168 int16 array, starting on a Monday. The hours without rentals are zero,
+           and the hours before the first rental of a station are unobserved, so a new station is not compared with the time before it opened.
+        3. Compare every hour with the same day of week and hour of the previous window_weeks weeks: the median and the MAD of these weeks
+           are computed for all hours at once by sorting the shifted week axis with a sorting network, in blocks of stations that fit in chunk_mb.
+        4. Flag the hours scoring at least threshold scaled MADs away from the median, with at least min_weeks observed weeks,
+           as spikes or drops, and save them in the info_tracker object.
+        5. Save the last window_weeks weeks as the SeasonalBaseline of the streaming monitor, which keeps updating it hour by hour.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    :param prefetcher: The QueryPrefetcher of the pipeline runner, if the hourly counts were prefetched.
+    """
+
+    # The name of the prefetched hourly counts
+    HOURLY_COUNTS = "anomaly_hourly_counts"
+
+    def __init__(self, config, info_tracker, gcp_client, prefetcher=None):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.demand_anomalies
+
+        if prefetcher is not None and prefetcher.has(self.HOURLY_COUNTS):
+            counts = prefetcher.take(self.HOURLY_COUNTS)
+        else:
+            counts = self.count_rentals_per_station_hour(config=self.config, gcp_client=self.__gcp_client)
+
+        self.station_ids, self.first_hour, self.weekly = self.__build_weekly_array(counts=counts)
+        self.last_hour = int(counts["epoch_hour"].max())
+        self.info_tracker.demand_anomalies = self.detect()
+        self.baseline().save(directory=self.config.paths2create.demand_anomalies)
+
+    @classmethod
+    def prefetch_jobs(cls, config) -> Dict[str, Callable]:
+        """ The jobs of this stage that the pipeline runner can start in advance. Each job takes the bigquery client. """
+        return {cls.HOURLY_COUNTS: lambda gcp_client: cls.count_rentals_per_station_hour(config=config, gcp_client=gcp_client)}
+
+    @staticmethod
+    def count_rentals_per_station_hour(config, gcp_client) -> pd.DataFrame:
+        """ Count the rentals per starting station and hour, with the hour as hours since the epoch. """
+
+        # Build query
+        query_job = gcp_client.query(
+            f"""
+            SELECT
+                start_station_id,
+                DIV(UNIX_SECONDS(start_date), 3600) AS epoch_hour,
+                COUNT(*) AS rental_count
+            FROM
+                bigquery-public-data.london_bicycles.{config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+            GROUP BY
+                start_station_id,
+                epoch_hour;
+            """
+        )
+        return query_job.result().to_dataframe()
+
+    def __build_weekly_array(self, counts: pd.DataFrame):
+        """ Scatter the counts into a stations x weeks x 168 array, from the Monday before the first hour to the end of the last week. """
+
+        hours = counts["epoch_hour"].to_numpy(dtype=np.int64)
+        first_hour = int(hours.min()) - (int(hours.min()) + MONDAY_OFFSET_HOURS) % HOURS_PER_WEEK
+        offsets = hours - first_hour
+        n_weeks = int(offsets.max()) // HOURS_PER_WEEK + 1
+
+        # Hashing the few hundred station ids is faster than sorting the rows
+        station_positions, station_ids = pd.factorize(counts["start_station_id"].to_numpy(dtype=np.int64), sort=True)
+        hourly = np.zeros((len(station_ids), n_weeks * HOURS_PER_WEEK), dtype=np.int16)
+        hourly[station_positions, offsets] = np.minimum(counts["rental_count"].to_numpy(dtype=np.int64), MAX_COUNT)
+
+        # The hours before the first rental of each station, and after the last hour of the data, were not observed
+        station_first = (hourly > 0).argmax(axis=1)
+        columns = np.arange(hourly.shape[1])
+        hourly[(columns[None, :] < station_first[:, None]) | (columns[None, :] > offsets.max())] = UNOBSERVED
+
+        return station_ids, first_hour, hourly.reshape(len(station_ids), n_weeks, HOURS_PER_WEEK)
+
+    def detect(self) -> pd.DataFrame:
+        """ Score every station hour against its previous weeks, and return the flagged hours. """
+
+        n_stations, n_weeks, _ = self.weekly.shape
+        window_weeks = self.__settings.window_weeks
+        # The previous weeks of week w are the weeks w to w + window_weeks - 1 of the array padded with window_weeks unobserved weeks
+        doubled = np.where(self.weekly == UNOBSERVED, UNOBSERVED, self.weekly * 2).astype(np.int16)
+        doubled = np.concatenate([np.full((n_stations, window_weeks, HOURS_PER_WEEK), UNOBSERVED, dtype=np.int16), doubled], axis=1)
+
+        # A station needs the int16 weeks, their observed counts, and the float32 counts, medians, MADs and scores of its hours
+        station_bytes = n_weeks * HOURS_PER_WEEK * (2 * (window_weeks + 2) + 4 * 4)
+        block = max(1, int(self.__settings.chunk_mb * 2 ** 20 // station_bytes))
+
+        flagged = []
+        for start in range(0, n_stations, block):
+            stop = min(start + block, n_stations)
+            median, mad, observed = trailing_baselines(doubled=doubled[start:stop], window_weeks=window_weeks)
+            current = doubled[start:stop, window_weeks:]
+            counts = current / np.float32(2)
+            scores = (counts - median) / (MAD_SCALE * np.maximum(mad, self.__settings.min_mad))
+            mask = (np.abs(scores) >= self.__settings.threshold) & (observed >= self.__settings.min_weeks) & (current != UNOBSERVED)
+
+            positions, weeks, slots = np.nonzero(mask)
+            flagged.append(pd.DataFrame({
+                "start_station_id": self.station_ids[start + positions],
+                "epoch_hour": self.first_hour + weeks * HOURS_PER_WEEK + slots,
+                "rental_count": counts[mask].astype(np.int64),
+                "baseline_median": median[mask],
+                "baseline_mad": mad[mask],
+                "score": scores[mask],
+            }))
+
+        anomalies = pd.concat(flagged, ignore_index=True)
+        anomalies.insert(1, "hour", pd.to_datetime(anomalies.pop("epoch_hour") * 3600, unit="s", utc=True))
+        anomalies["direction"] = np.where(anomalies["score"] > 0, "spike", "drop")
+        return anomalies.sort_values(["hour", "start_station_id"], ignore_index=True)
+
+    def baseline(self) -> SeasonalBaseline:
+        """ The SeasonalBaseline holding the last window_weeks weeks up to the last hour of the data. """
+
+        window_weeks = self.__settings.window_weeks
+        baseline = SeasonalBaseline(station_ids=self.station_ids, window_weeks=window_weeks, last_hour=self.last_hour)
+        hours = np.arange(self.last_hour - window_weeks * HOURS_PER_WEEK + 1, self.last_hour + 1)
+        offsets = hours - self.first_hour
+        hourly = self.weekly.reshape(len(self.station_ids), -1)[:, np.maximum(offsets, 0)]
+        baseline.ring[:, (hours + MONDAY_OFFSET_HOURS) % baseline.ring.shape[1]] = np.where(
+            (offsets >= 0) & (hourly != UNOBSERVED), hourly, np.nan
+        )
+        return baseline
@@ -0,0 +1,242 @@
+""" Hourly demand time series of many stations in one WebGL page, downsampled with Largest-Triangle-Three-Buckets. """
+
+import base64
+import json
+import numpy as np
+import pandas as pd
+import plotly.graph_objects as go
+
+
+def lttb(x: np.ndarray, y: np.ndarray, n_out: int) -> np.ndarray:
+    """
+    Largest-Triangle-Three-Buckets downsampling of several series sharing the same x values.
+    The first and the last points are kept, and the other points are split into n_out - 2 buckets.
+    Each bucket keeps the point forming the largest triangle with the point kept in the previous bucket
+    and the average point of the next bucket, so peaks and troughs survive the downsampling.
+    The buckets are processed in order, for all series at once.
+
+    :param x: The x values, with shape (n,).
+    :param y: The y values of each series, with shape (series, n).
+    :param n_out: The number of points to keep per series.
+    :return: The indices of the kept points of each series, with shape (series, n_out).
+    """
+
+    n_series, n = y.shape
+    if n <= n_out or n_out < 3:
+        return np.tile(np.arange(n), (n_series, 1))
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    edges = np.append(np.linspace(1, n - 1, n_out - 1).astype(np.int64), n)
+    rows = np.arange(n_series)
+
+    selected = np.empty((n_series, n_out), dtype=np.int64)
+    selected[:, 0] = 0
+    selected[:, -1] = n - 1
+    for bucket in range(n_out - 2):
+        start, end, next_end = edges[bucket], edges[bucket + 1], edges[bucket + 2]
+        average_x = x[end:next_end].mean()
+        average_y = y[:, end:next_end].mean(axis=1)
+
+        previous_x = x[selected[:, bucket]]
+        previous_y = y[rows, selected[:, bucket]]
+        areas = np.abs(
+            (previous_x - average_x)[:, None] * (y[:, start:end] - previous_y[:, None])
+            - (previous_x[:, None] - x[None, start:end]) * (average_y - previous_y)[:, None]
+        )
+        selected[:, bucket + 1] = start + np.argmax(areas, axis=1)
+
+    return selected
+
+
+class DemandTimeSeriesPlot:
+    """
+    Plot the hourly rentals of many stations over many years in a single page that stays small and responsive.
+        1. Scatter the hourly counts into a dense matrix of stations x hours, where the hours without rentals are zero.
+        2. Sum the matrix into daily and weekly levels, and downsample each level with LTTB to points_per_trace points per station.
+        3. Draw every level of every station as a WebGL (Scattergl) trace. Only the traces of the level matching the zoom are visible:
+           weekly above daily_max_days, daily above hourly_max_days, and hourly below.
+        4. The hourly counts are embedded once as base64 integers. When zoomed into the hourly level,
+           the visible window is downsampled with LTTB in the browser, so every zoom shows at most points_per_trace points per station.
+
+    :param data: The hourly rentals, with the columns start_station_id, year, month, day, hour and rental_count.
+    :param points_per_trace: The LTTB point budget of each trace.
+    :param daily_max_days: The widest zoom, in days, that shows the daily level.
+    :param hourly_max_days: The widest zoom, in days, that shows the hourly level.
+    """
+
+    def __init__(self, data: pd.DataFrame, points_per_trace: int, daily_max_days: int, hourly_max_days: int):
+        self.points_per_trace = points_per_trace
+        self.daily_max_days = daily_max_days
+        self.hourly_max_days = hourly_max_days
+        self.station_ids, self.start, self.hourly = self.__build_hourly_matrix(data=data)
+
+    @staticmethod
+    def __build_hourly_matrix(data: pd.DataFrame):
+        """ Scatter the counts into a stations x hours matrix, starting at midnight of a Monday, and padded to whole weeks. """
+
+        times = pd.to_datetime(data[["year", "month", "day", "hour"]]).to_numpy().astype("datetime64[h]")
+        start = times.min().astype("datetime64[D]")
+        # Start on a Monday, so the weekly level sums whole weeks. The 1st of January 1970 was a Thursday.
+        start = start - (start.astype(np.int64) + 3) % 7
+        hours = (times - start.astype("datetime64[h]")).astype(np.int64)
+        n_hours = (int(hours.max()) // (7 * 24) + 1) * 7 * 24
+
+        station_ids, station_positions = np.unique(data["start_station_id"].to_numpy(dtype=np.int64), return_inverse=True)
+        hourly = np.zeros((len(station_ids), n_hours), dtype=np.int64)
+        np.add.at(hourly, (station_positions, hours), data["rental_count"].to_numpy(dtype=np.int64))
+        return station_ids, start, hourly
+
+    def levels(self):
+        """ The x values (as datetime64) and the counts of each level, before downsampling. """
+
+        n_stations, n_hours = self.hourly.shape
+        daily = self.hourly.reshape(n_stations, -1, 24).sum(axis=2)
+        weekly = daily.reshape(n_stations, -1, 7).sum(axis=2)
+        start = self.start.astype("datetime64[h]")
+        return {
+            "hourly": (start + np.arange(n_hours), self.hourly),
+            "daily": (start + np.arange(daily.shape[1]) * 24, daily),
+            "weekly": (start + np.arange(weekly.shape[1]) * 7 * 24, weekly),
+        }
+
+    def figure(self, title: str, colours=None) -> go.Figure:
+        """
+        Draw every level of every station, showing the weekly level first.
+        The hourly traces are left empty, as they are filled with the visible window by the zoom script.
+        """
+
+        fig = go.Figure()
+        colours = colours or [None] * len(self.station_ids)
+        for level, (times, counts) in self.levels().items():
+            if level == "hourly":
+                times, counts = times[:0], counts[:, :0]
+            kept = lttb(x=times.astype(np.int64), y=counts, n_out=self.points_per_trace)
+            for position, station_id in enumerate(self.station_ids):
+                fig.add_trace(
+                    go.Scattergl(
+                        x=np.datetime_as_string(times[kept[position]], unit="D"),
+                        y=counts[position, kept[position]],
+                        mode="lines",
+                        line=dict(width=1, color=colours[position % len(colours)]),
+                        name=f"Station {station_id}",
+                        legendgroup=str(station_id),
+                        meta=level,
+                        visible=level == "weekly",
+                    )
+                )
+
+        fig.update_layout(
+            title_text=title,
+            title_x=0.5,
+            xaxis_title="Time",
+            yaxis_title="Number of rentals",
+            hovermode="x",
+            annotations=[dict(text="Weekly rentals", xref="paper", yref="paper", x=0, y=1.05, showarrow=False)],
+        )
+        fig.update_xaxes(showgrid=False, type="date")
+        fig.update_yaxes(showgrid=False)
+        return fig
+
+    def write_html(self, path: str, title: str, colours=None):
+        """ Save the figure, with the script that switches the levels on zoom. Plotly.js is loaded from its CDN to keep the page small. """
+
+        fig = self.figure(title=title, colours=colours)
+        fig.write_html(path, include_plotlyjs="cdn", post_script=self.__zoom_script())
+
+    def __zoom_script(self) -> str:
+        """ The script that shows the level matching the zoom, and downsamples the visible hourly window with LTTB. """
+
+        # Hourly counts fit in one or two bytes, little-endian as in the browser
+        dtype = np.uint8 if self.hourly.max() < 2 ** 8 else np.dtype("<u2")
+        hourly = [base64.b64encode(row.astype(dtype).tobytes()).decode("ascii") for row in self.hourly]
+        settings = {
+            "start": int(self.start.astype("datetime64[ms]").astype(np.int64)),
+            "bytes": np.dtype(dtype).itemsize,
+            "hourly": hourly,
+            "points": self.points_per_trace,
+            "dailyMaxDays": self.daily_max_days,
+            "hourlyMaxDays": self.hourly_max_days,
+        }
+        return ZOOM_SCRIPT_TEMPLATE.replace("__SETTINGS__", json.dumps(settings))
+
+
+# {plot_id} is replaced by plotly with the id of the figure's div
+ZOOM_SCRIPT_TEMPLATE = """
+const gd = document.getElementById('{plot_id}');
+const settings = __SETTINGS__;
+const HOUR = 3600000;
+const labels = {hourly: "Hourly rentals", daily: "Daily rentals", weekly: "Weekly rentals"};
+const hourly = settings.hourly.map(encoded => {
+  const bytes = Uint8Array.from(atob(encoded), c => c.charCodeAt(0));
+  return settings.bytes === 1 ? bytes : new Uint16Array(bytes.buffer);
+});
+let current = "weekly";
+let busy = false;
+
+function lttb(values, first, last, nOut) {
+  const n = last - first;
+  if (n <= nOut) return Array.from({length: n}, (_, i) => first + i);
+  const kept = [first];
+  const bucket = (n - 2) / (nOut - 2);
+  let previous = first;
+  for (let b = 0; b < nOut - 2; b++) {
+    const start = first + 1 + Math.floor(b * bucket);
+    const end = first + 1 + Math.floor((b + 1) * bucket);
+    const nextEnd = Math.min(first + 1 + Math.floor((b + 2) * bucket), last);
+    let averageX = 0, averageY = 0;
+    for (let i = end; i < nextEnd; i++) { averageX += i; averageY += values[i]; }
+    averageX /= Math.max(nextEnd - end, 1); averageY /= Math.max(nextEnd - end, 1);
+    let best = start, bestArea = -1;
+    for (let i = start; i < end; i++) {
+      const area = Math.abs((previous - averageX) * (values[i] - values[previous]) - (previous - i) * (averageY - values[previous]));
+      if (area > bestArea) { bestArea = area; best = i; }
+    }
+    kept.push(best);
+    previous = best;
+  }
+  kept.push(last - 1);
+  return kept;
+}
+
+function visibleRange() {
+  const range = gd.layout.xaxis.range;
+  if (!range) return null;
+  return range.map(value => typeof value === "number" ? value : Date.parse(String(value).replace(" ", "T") + "Z"));
+}
+
+gd.on("plotly_relayout", () => {
+  if (busy) return;
+  const range = visibleRange();
+  if (!range) return;
+  const days = (range[1] - range[0]) / (24 * HOUR);
+  const level = days > settings.dailyMaxDays ? "weekly" : days > settings.hourlyMaxDays ? "daily" : "hourly";
+
+  // Each station keeps the legend state of the level shown so far
+  const stationState = {};
+  gd.data.forEach(trace => { if (trace.meta === current) stationState[trace.legendgroup] = trace.visible; });
+  const update = {visible: gd.data.map(trace => trace.meta === level ? stationState[trace.legendgroup] : false)};
+  const indices = gd.data.map((_, i) => i);
+
+  if (level === "hourly") {
+    const first = Math.max(Math.floor((range[0] - settings.start) / HOUR) - 1, 0);
+    const last = Math.min(Math.ceil((range[1] - settings.start) / HOUR) + 1, hourly[0].length);
+    const hourlyTraces = indices.filter(i => gd.data[i].meta === "hourly");
+    update.x = gd.data.map(trace => trace.x);
+    update.y = gd.data.map(trace => trace.y);
+    hourlyTraces.forEach((i, station) => {
+      const kept = lttb(hourly[station], first, Math.max(last, first + 1), settings.points);
+      update.x[i] = kept.map(hour => settings.start + hour * HOUR);
+      update.y[i] = kept.map(hour => hourly[station][hour]);
+    });
+  } else if (level === current) {
+    return;
+  }
+
+  current = level;
+  busy = true;
+  Plotly.restyle(gd, update, indices)
+    .then(() => Plotly.relayout(gd, {"annotations[0].text": labels[level]}))
+    .then(() => { busy = false; });
+});
+"""
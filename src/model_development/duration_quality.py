@@ -0,0 +1,160 @@
+""" Duration quality: approximate duration quantiles per station-year, and consistent outlier trimming of the duration metrics. """
+
+import os
+from typing import Optional
+import numpy as np
+import pandas as pd
+from ..helper.sketches import GroupedTDigest
+
+# Station-year keys combine the year and the starting station id in a single integer
+STATION_YEAR_KEY_FACTOR = 1_000_000
+
+
+class DurationBounds:
+    """
+    The range of valid ride durations in seconds, per year and per station-year.
+    The duration metrics apply the yearly bounds in their queries, so every metric trims the same rides.
+    The station-year bounds are kept to inspect the outliers of each station.
+
+    :param per_year: The bounds per year, with the columns year, lower_secs and upper_secs.
+    :param per_station_year: The bounds per station-year, with the columns year, start_station_id, lower_secs and upper_secs.
+    """
+
+    PER_YEAR_FILE = "duration_bounds_per_year.parquet"
+    PER_STATION_YEAR_FILE = "duration_bounds_per_station_year.parquet"
+
+    def __init__(self, per_year: pd.DataFrame, per_station_year: pd.DataFrame):
+        self.per_year = per_year
+        self.per_station_year = per_station_year
+
+    def save(self, directory: str):
+        """ Save the bounds as Parquet files. """
+        self.per_year.to_parquet(os.path.join(directory, self.PER_YEAR_FILE), index=False)
+        self.per_station_year.to_parquet(os.path.join(directory, self.PER_STATION_YEAR_FILE), index=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "DurationBounds":
+        """ Load the bounds saved by a previous run. """
+        return cls(
+            per_year=pd.read_parquet(os.path.join(directory, cls.PER_YEAR_FILE)),
+            per_station_year=pd.read_parquet(os.path.join(directory, cls.PER_STATION_YEAR_FILE))
+        )
+
+    def sql_condition(self, duration_column: str = "duration", date_column: str = "start_date") -> str:
+        """ A BigQuery condition that keeps the rides within the bounds of their year. Rides of years without bounds are kept. """
+
+        lower_cases = " ".join(f"WHEN {int(row.year)} THEN {float(row.lower_secs)}" for row in self.per_year.itertuples())
+        upper_cases = " ".join(f"WHEN {int(row.year)} THEN {float(row.upper_secs)}" for row in self.per_year.itertuples())
+        year = f"EXTRACT(YEAR FROM {date_column})"
+        return (
+            f"{duration_column} BETWEEN "
+            f"CASE {year} {lower_cases} ELSE {duration_column} END "
+            f"AND CASE {year} {upper_cases} ELSE {duration_column} END"
+        )
+
+    @classmethod
+    def sql_condition_from_config(cls, config, duration_column: str = "duration", date_column: str = "start_date") -> str:
+        """
+        The trimming condition of the duration metrics. It keeps every ride unless trimming is enabled in the config,
+        in which case the bounds created by the DurationQualityChecker class are required.
+        """
+
+        if not config.duration_quality.trim_metrics:
+            return "TRUE"
+        if not os.path.exists(os.path.join(config.paths2create.aggregates, cls.PER_YEAR_FILE)):
+            raise ValueError("The duration trimming needs the duration bounds created by the DurationQualityChecker class.")
+        return cls.load(directory=config.paths2create.aggregates).sql_condition(duration_column=duration_column, date_column=date_column)
+
+
+class DurationQualityChecker:
+    """
+    Summarise the ride durations of every station-year with mergeable t-digests, and derive the valid duration range.
+        1. Count the rides per year, starting station and duration in BigQuery, and stream the counts page by page
+           into a GroupedTDigest with one digest per station-year, weighted by the counts.
+        2. Merge the station-year digests into yearly digests, without reading the rides again.
+        3. The valid range is between the configured lower and upper quantiles, and never below the minimum valid duration.
+           Zero and negative durations are thus always trimmed, as are multi-day outliers above the upper quantile.
+        4. Save the digests and the bounds in the aggregates directory and the bounds in the info_tracker object.
+           The duration metrics of the DataAggregator and DataExplorer classes apply the yearly bounds if trimming is enabled in the config.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    DIGESTS_FILE = "duration_digests.npz"
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.duration_quality
+
+        self.digests = self.__stream_durations_into_digests()
+        self.digests.save(os.path.join(self.config.paths2create.aggregates, self.DIGESTS_FILE))
+
+        self.bounds = DurationBounds(
+            per_year=self.__compute_bounds(digests=self.__merge_into_yearly_digests(), columns=["year"]),
+            per_station_year=self.__compute_bounds(digests=self.digests, columns=["year", "start_station_id"])
+        )
+        self.bounds.save(directory=self.config.paths2create.aggregates)
+        self.info_tracker.duration_bounds_per_year = self.bounds.per_year
+        self.info_tracker.duration_bounds_per_station_year = self.bounds.per_station_year
+
+    def __stream_durations_into_digests(self) -> GroupedTDigest:
+        """ Stream the ride counts per station-year and duration from BigQuery into the station-year digests. """
+
+        # Build query. Durations are whole seconds, so the counts are far fewer than the rides.
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                EXTRACT(YEAR FROM start_date) AS year,
+                start_station_id,
+                duration,
+                COUNT(*) AS number_of_rides
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND duration IS NOT NULL
+            GROUP BY
+                year,
+                start_station_id,
+                duration
+            """
+        )
+
+        digests = GroupedTDigest(compression=self.__settings.compression)
+        for page in query_job.result(page_size=self.__settings.page_size).to_dataframe_iterable():
+            digests.update(
+                groups=page["year"].to_numpy(dtype=np.int64) * STATION_YEAR_KEY_FACTOR + page["start_station_id"].to_numpy(dtype=np.int64),
+                values=page["duration"].to_numpy(dtype=np.float64),
+                weights=page["number_of_rides"].to_numpy(dtype=np.float64)
+            )
+        return digests
+
+    def __merge_into_yearly_digests(self) -> GroupedTDigest:
+        """ Merge the centroids of the station-year digests of each year into a yearly digest. """
+
+        yearly = GroupedTDigest(compression=self.__settings.compression)
+        yearly.update(groups=self.digests.groups // STATION_YEAR_KEY_FACTOR, values=self.digests.means, weights=self.digests.weights)
+        return yearly
+
+    def __compute_bounds(self, digests: GroupedTDigest, columns) -> pd.DataFrame:
+        """ Estimate the lower and upper quantiles of every digest, and apply the minimum valid duration. """
+
+        groups, quantiles = digests.quantiles([self.__settings.lower_quantile, self.__settings.upper_quantile])
+        years, station_ids = np.divmod(groups, STATION_YEAR_KEY_FACTOR)
+
+        df = pd.DataFrame({"year": groups} if columns == ["year"] else {"year": years, "start_station_id": station_ids})
+        df["lower_secs"] = np.maximum(quantiles[:, 0], self.__settings.min_duration_secs)
+        df["upper_secs"] = np.maximum(quantiles[:, 1], df["lower_secs"])
+        return df
+
+    @classmethod
+    def load_digests(cls, directory: str) -> Optional[GroupedTDigest]:
+        """ Load the station-year digests of a previous run, e.g. to estimate other quantiles. """
+
+        path = os.path.join(directory, cls.DIGESTS_FILE)
+        return GroupedTDigest.load(path) if os.path.exists(path) else None
@@ -0,0 +1,309 @@
+""" Build, train and test the demand prediction model with a time-budgeted successive halving search in scikit-learn. """
+
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class Candidate:
+    """ A model configuration of the search, with its cross-validated scores of the last round it completed. """
+    model_id: str
+    algo: str
+    params: Dict
+    round: int = -1
+    scores: Dict = field(default_factory=dict)
+    training_time_ms: float = 0.0
+
+
+def build_estimator(algo: str, params: Dict, categorical_mask: np.ndarray, seed: int):
+    """
+    Build the estimator of a candidate.
+        - HGB: a histogram gradient boosting classifier with early stopping, treating the station id as categorical.
+        - GLM: a multinomial logistic regression over the scaled numeric and one-hot encoded categorical predictors.
+    Both weigh the classes by their inverse frequency, like balance_classes in H2O.
+    """
+
+    from sklearn.ensemble import HistGradientBoostingClassifier
+
+    if algo == "HGB":
+        return HistGradientBoostingClassifier(
+            categorical_features=categorical_mask,
+            class_weight="balanced",
+            early_stopping=True,
+            validation_fraction=0.1,
+            n_iter_no_change=10,
+            random_state=seed,
+            **params
+        )
+
+    from sklearn.compose import ColumnTransformer
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.pipeline import make_pipeline
+    from sklearn.preprocessing import OneHotEncoder, StandardScaler
+
+    preprocessing = ColumnTransformer([
+        ("categorical", OneHotEncoder(handle_unknown="ignore"), np.flatnonzero(categorical_mask)),
+        ("numeric", StandardScaler(), np.flatnonzero(~categorical_mask)),
+    ])
+    return make_pipeline(preprocessing, LogisticRegression(class_weight="balanced", max_iter=500, **params))
+
+
+def fit_and_predict_fold(algo: str, params: Dict, categorical_mask: np.ndarray, seed: int,
+                         x: np.ndarray, y: np.ndarray, train_rows: np.ndarray, valid_rows: np.ndarray, deadline: float):
+    """
+    Fit a candidate on the training rows of a fold and predict the class probabilities of its validation rows.
+    A task starting after the deadline is skipped, so a round stops close to the time budget.
+    """
+
+    if time.time() > deadline:
+        return None
+
+    started = time.perf_counter()
+    estimator = build_estimator(algo=algo, params=params, categorical_mask=categorical_mask, seed=seed)
+    estimator.fit(x[train_rows], y[train_rows])
+    return estimator.predict_proba(x[valid_rows]), (time.perf_counter() - started) * 1000
+
+
+class FastModelSearch:
+    """
+    Build, train and test a demand prediction model in minutes, as a fast alternative to H2O AutoML.
+        1. Split the modelling dataset into training and test sets, keeping 30% unseen data for testing, stratified by the labels.
+        2. Split the training set into stratified folds once. The folds are cached in the model results directory
+           and shared by every candidate and every round, so all candidates are compared on the same rows.
+        3. Sample candidate configurations of gradient boosting (HGB) and logistic regression (GLM) models.
+        4. Successive halving: evaluate the candidates on a fraction of the training rows of each fold, keep the best 1 / halving_factor,
+           and give the remaining candidates halving_factor times more rows, until a single candidate uses all the rows.
+           The (candidate, fold) fits of a round run in parallel on all cores. The search stops when the time budget is spent,
+           and the candidates are ranked by the last round they completed, then by their score.
+        5. Save an H2O-like leaderboard, refit and save the best models on the whole training set,
+           and save the predictions of the leader on the test set.
+           The predictors and the station ids of the categorical codes are saved in a json file next to the models,
+           so the saved models can encode new data like their training did.
+    The time budget only stops new fits: the fits that are running when it is spent, and the refits of the best models, run past it.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param data: The modelling dataset, created by the DataEngineer class.
+    :param n_best_models: The number of best models to be saved.
+    """
+
+    TARGET = "labels"
+    CATEGORICAL_PREDICTORS = ("start_station_id",)
+    FOLDS_FILE = "fast_search_folds.npz"
+    ENCODING_FILE = "fast_search_encoding.json"
+
+    def __init__(self, config, info_tracker, data: pd.DataFrame, n_best_models: int = 3):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.data = data
+        self.n_best_models = n_best_models
+        self.__settings = self.config.modelling
+        self.__seed = self.config.random_state.seed
+
+        self.predictors = [column for column in data.columns if column not in (self.TARGET, "row_id")]
+        self.categorical_mask = np.array([column in self.CATEGORICAL_PREDICTORS for column in self.predictors])
+        self.x = data[self.predictors].to_numpy(dtype=np.float64, copy=True)
+        # Gradient boosting needs categorical codes below 255, while the station ids are larger
+        self.category_codes = {}
+        for position in np.flatnonzero(self.categorical_mask):
+            self.category_codes[self.predictors[position]], self.x[:, position] = np.unique(self.x[:, position], return_inverse=True)
+        self.y = data[self.TARGET].to_numpy(dtype=np.int64)
+        self.classes = np.unique(self.y)
+
+        self.train_rows, self.test_rows = self.__split_data_to_train_test_sets()
+        self.folds = self.__load_or_create_folds()
+        self.candidates = self.__sample_candidates()
+        self.__successive_halving()
+
+        self.info_tracker.h2o_leaderboard_df = self.__save_leaderboard()
+        self.best_models = self.__save_n_best_models()
+        self.__save_encoding()
+        self.__predict_with_bmodel()
+
+    def __split_data_to_train_test_sets(self):
+        """ Split the rows into training and test sets, stratified by the labels. """
+
+        from sklearn.model_selection import train_test_split
+
+        return train_test_split(
+            np.arange(len(self.y)),
+            test_size=self.__settings.test_fraction,
+            stratify=self.y,
+            random_state=self.__seed
+        )
+
+    def __load_or_create_folds(self) -> List[np.ndarray]:
+        """
+        Split the training rows into stratified folds, or load the folds of a previous run on the same training rows.
+        Each fold is stored as its validation rows. The training rows of each fold are shuffled once,
+        so the first n rows are a random subsample that every round and every candidate shares.
+        """
+
+        from sklearn.model_selection import StratifiedKFold
+
+        path = os.path.join(self.config.paths2create.model_results, self.FOLDS_FILE)
+        fingerprint = np.array([len(self.train_rows), self.__settings.nfolds, self.__seed, int(self.y[self.train_rows].sum())])
+        if os.path.exists(path):
+            cached = np.load(path)
+            if np.array_equal(cached["fingerprint"], fingerprint) and np.array_equal(cached["train_rows"], self.train_rows):
+                return [cached[f"fold_{fold}"] for fold in range(self.__settings.nfolds)]
+
+        splitter = StratifiedKFold(n_splits=self.__settings.nfolds, shuffle=True, random_state=self.__seed)
+        folds = [self.train_rows[valid] for _, valid in splitter.split(self.train_rows, self.y[self.train_rows])]
+        np.savez(path, fingerprint=fingerprint, train_rows=self.train_rows, **{f"fold_{fold}": rows for fold, rows in enumerate(folds)})
+        return folds
+
+    def __fold_training_rows(self, fold: int, fraction: float) -> np.ndarray:
+        """ The first fraction of the shuffled training rows of a fold. """
+
+        rng = np.random.default_rng(self.__seed + fold)
+        rows = np.setdiff1d(self.train_rows, self.folds[fold], assume_unique=True)
+        rows = rows[rng.permutation(len(rows))]
+        return rows[:max(int(len(rows) * fraction), 2 * len(self.classes))]
+
+    def __sample_candidates(self) -> List[Candidate]:
+        """ Sample the candidate configurations, a quarter of them logistic regressions and the rest gradient boosting models. """
+
+        rng = np.random.default_rng(self.__seed)
+        n_glm = max(self.__settings.n_candidates // 4, 1)
+        candidates = []
+        for position in range(self.__settings.n_candidates):
+            if position < n_glm:
+                algo, params = "GLM", {"C": float(10 ** rng.uniform(-3, 2))}
+            else:
+                algo, params = "HGB", {
+                    "learning_rate": float(10 ** rng.uniform(np.log10(0.02), np.log10(0.3))),
+                    "max_leaf_nodes": int(rng.choice([15, 31, 63, 127])),
+                    "min_samples_leaf": int(rng.choice([10, 20, 50, 100])),
+                    "l2_regularization": float(10 ** rng.uniform(-4, 0)),
+                    "max_iter": 500,
+                }
+            candidates.append(Candidate(model_id=f"{algo}_{position + 1}_FastSearch", algo=algo, params=params))
+        return candidates
+
+    def __successive_halving(self):
+        """ Run the rounds of successive halving until a single candidate is left, all the rows are used, or the time budget is spent. """
+
+        from joblib import Parallel, delayed
+
+        deadline = time.time() + self.__settings.time_budget_secs
+        factor = self.__settings.halving_factor
+        fraction = self.__settings.min_resource_fraction
+        remaining = list(self.candidates)
+        parallel = Parallel(n_jobs=self.__settings.n_jobs)
+
+        for round_number in range(len(self.candidates)):
+            training_rows = [self.__fold_training_rows(fold=fold, fraction=fraction) for fold in range(len(self.folds))]
+            results = parallel(
+                delayed(fit_and_predict_fold)(
+                    candidate.algo, candidate.params, self.categorical_mask, self.__seed,
+                    self.x, self.y, training_rows[fold], self.folds[fold], deadline
+                )
+                for candidate in remaining
+                for fold in range(len(self.folds))
+            )
+
+            completed = []
+            for position, candidate in enumerate(remaining):
+                fold_results = results[position * len(self.folds):(position + 1) * len(self.folds)]
+                if any(result is None for result in fold_results):
+                    continue
+                # The scores are computed on the out-of-fold predictions of all folds, as the H2O cross-validation metrics
+                probabilities = np.vstack([result[0] for result in fold_results])
+                candidate.scores = self.score(y=self.y[np.concatenate(self.folds)], probabilities=probabilities, classes=self.classes)
+                candidate.training_time_ms = float(sum(result[1] for result in fold_results))
+                candidate.round = round_number
+                completed.append(candidate)
+
+            if not completed:
+                if round_number == 0:
+                    raise ValueError("The time budget of the fast model search is too small to evaluate any candidate.")
+                break
+            if len(completed) == 1 or fraction >= 1 or time.time() > deadline:
+                break
+
+            completed.sort(key=lambda candidate: -candidate.scores[self.__settings.sort_metric])
+            remaining = completed[:max(len(completed) // factor, 1)]
+            fraction = min(fraction * factor, 1.0)
+
+    @staticmethod
+    def score(y: np.ndarray, probabilities: np.ndarray, classes: np.ndarray) -> Dict[str, float]:
+        """ The metrics of the H2O multinomial leaderboard, with the macro average precision as aucpr. """
+
+        from sklearn.metrics import average_precision_score, balanced_accuracy_score, log_loss
+        from sklearn.preprocessing import label_binarize
+
+        one_hot = label_binarize(y, classes=classes)
+        if one_hot.shape[1] == 1:
+            one_hot = np.hstack([1 - one_hot, one_hot])
+        mse = float(np.mean(np.sum((one_hot - probabilities) ** 2, axis=1)))
+        return {
+            "aucpr": float(average_precision_score(one_hot, probabilities, average="macro")),
+            "mean_per_class_error": float(1 - balanced_accuracy_score(y, classes[probabilities.argmax(axis=1)])),
+            "logloss": float(log_loss(y, probabilities, labels=classes)),
+            "rmse": float(np.sqrt(mse)),
+            "mse": mse,
+        }
+
+    def __save_leaderboard(self) -> pd.DataFrame:
+        """ Rank the candidates in an H2O-like leaderboard, and save it. Candidates that completed more rounds rank first. """
+
+        ascending = self.__settings.sort_metric != "aucpr"
+        evaluated = [candidate for candidate in self.candidates if candidate.round >= 0]
+        leaderboard = pd.DataFrame([
+            {"model_id": candidate.model_id, **candidate.scores, "algo": candidate.algo, "round": candidate.round,
+             "training_time_ms": round(candidate.training_time_ms), "params": candidate.params}
+            for candidate in evaluated
+        ])
+        leaderboard["__rank_metric"] = leaderboard[self.__settings.sort_metric] * (1 if ascending else -1)
+        leaderboard = leaderboard.sort_values(["round", "__rank_metric"], ascending=[False, True]).drop(columns="__rank_metric").reset_index(drop=True)
+
+        leaderboard.to_html(os.path.join(self.config.paths2create.model_results, "fast_search_report.html"))
+        return leaderboard
+
+    def __save_n_best_models(self) -> List:
+        """ Refit the best models on the whole training set, and save them with joblib. """
+
+        import joblib
+
+        best_models = []
+        for candidate in self.info_tracker.h2o_leaderboard_df.head(self.n_best_models).itertuples():
+            estimator = build_estimator(algo=candidate.algo, params=candidate.params, categorical_mask=self.categorical_mask, seed=self.__seed)
+            estimator.fit(self.x[self.train_rows], self.y[self.train_rows])
+            joblib.dump(estimator, os.path.join(self.config.paths2create.model_results, f"{candidate.model_id}.joblib"))
+            best_models.append(estimator)
+        return best_models
+
+    def __save_encoding(self):
+        """ Save the predictors and the station ids in the order of their categorical codes next to the models, replacing the file atomically. """
+
+        path = os.path.join(self.config.paths2create.model_results, self.ENCODING_FILE)
+        with open(f"{path}.tmp", "w") as file:
+            json.dump({
+                "predictors": self.predictors,
+                "station_codes": self.category_codes["start_station_id"].astype(np.int64).tolist(),
+            }, file, indent=2)
+        os.replace(f"{path}.tmp", path)
+
+    @classmethod
+    def read_encoding(cls, directory: str) -> Dict:
+        """ The predictors and the station codes of the models saved in the given directory. """
+        with open(os.path.join(directory, cls.ENCODING_FILE)) as file:
+            return json.load(file)
+
+    def __predict_with_bmodel(self):
+        """ Predict the test set with the leader and save the predictions next to the test data, in the format of the H2O predictions. """
+
+        probabilities = self.best_models[0].predict_proba(self.x[self.test_rows])
+        predictions = pd.DataFrame(probabilities, columns=[f"p{label}" for label in self.classes])
+        predictions.insert(0, "predict", self.classes[probabilities.argmax(axis=1)])
+
+        test_data = self.data.iloc[self.test_rows].rename_axis("row_id").reset_index()
+        pd.concat([predictions, test_data], axis=1).set_index("row_id").to_csv(
+            os.path.join(self.config.paths2create.model_results, "prediction_and_test_report.csv")
+        )
@@ -0,0 +1,167 @@
+""" Refresh the demand prediction model by continuing the training of the previous leader on the newly arrived hours. """
+
+import json
+import os
+from datetime import datetime
+import numpy as np
+import pandas as pd
+
+
+class IncrementalModelTrainer:
+    """
+    Refresh the leader of the FastModelSearch class in minutes, instead of searching the models again.
+        1. Read the watermark of the last training: the leader model, the last hour it was trained on and its reference metrics.
+           Without a watermark, the models are searched from scratch and the watermark is created.
+        2. Score the leader on the hours after the watermark, before training on them. These hours are unseen,
+           so their metrics are an honest check of the leader on the newest data.
+        3. Drift check: if the sort metric is worse than the reference by more than drift_threshold, the models are searched from scratch.
+        4. Otherwise, update the leader:
+           gradient boosting continues its training on the new hours only, by adding additional_trees trees with a shrunk learning rate
+           to the existing ones. Logistic regression has no such increment: refitting it on the new hours alone converges to the optimum
+           of those hours and discards the history. So it is refitted on the whole modelling history, new hours included,
+           starting from the previous coefficients, with the preprocessing of the full training kept as it is.
+           An update needs every label class in the new hours. Otherwise it is deferred, and the new hours accumulate until the next run.
+           New stations or new label classes need a retrain from scratch.
+        5. Save the updated leader and move the watermark to the last new hour.
+    Each refresh is logged in the info_tracker object.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param data: The modelling dataset, created by the DataEngineer class.
+    """
+
+    WATERMARK_FILE = "watermark.json"
+
+    def __init__(self, config, info_tracker, data: pd.DataFrame):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.data = data
+        self.__settings = self.config.modelling
+        self.__watermark_path = os.path.join(self.config.paths2create.model_results, self.WATERMARK_FILE)
+        self.hours = pd.to_datetime(data[["year", "month", "day", "hour"]])
+
+        watermark = self.read_watermark()
+        if watermark is None:
+            refresh = self.__retrain_from_scratch(reason="no watermark")
+        else:
+            refresh = self.__refresh(watermark=watermark)
+
+        refresh["refreshed_at"] = datetime.now().isoformat(timespec="seconds")
+        self.info_tracker.model_refreshes = pd.DataFrame([refresh])
+
+    def read_watermark(self):
+        """ The watermark of the last training, or None before the first training. """
+        if not os.path.exists(self.__watermark_path):
+            return None
+        with open(self.__watermark_path) as file:
+            return json.load(file)
+
+    def __write_watermark(self, watermark: dict):
+        """ Replace the watermark file atomically, so an interrupted run keeps the previous watermark. """
+        temporary_path = self.__watermark_path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(watermark, file, indent=2)
+        os.replace(temporary_path, self.__watermark_path)
+
+    def __retrain_from_scratch(self, reason: str) -> dict:
+        """ Search the models on the whole history, and set the watermark to the last hour with the cross-validated metrics of the leader. """
+
+        from ..model_development.fast_model_search import FastModelSearch
+
+        FastModelSearch(config=self.config, info_tracker=self.info_tracker, data=self.data)
+        leader = self.info_tracker.h2o_leaderboard_df.iloc[0]
+        # The encoding is read from the file saved with the models, so the watermark encodes new hours exactly like the training did
+        encoding = FastModelSearch.read_encoding(directory=self.config.paths2create.model_results)
+        self.__write_watermark({
+            "model_id": leader["model_id"],
+            "algo": leader["algo"],
+            "model_path": os.path.join(self.config.paths2create.model_results, f"{leader['model_id']}.joblib"),
+            # The learning rate of the full training, which the added trees are shrunk from on every refresh
+            "learning_rate": leader["params"].get("learning_rate"),
+            "predictors": encoding["predictors"],
+            "station_codes": encoding["station_codes"],
+            "watermark": self.hours.max().isoformat(),
+            "reference_metrics": {metric: float(leader[metric]) for metric in ("aucpr", "mean_per_class_error", "logloss", "rmse", "mse")},
+        })
+        return {"mode": "full", "reason": reason, "model_id": leader["model_id"], "new_rows": len(self.data)}
+
+    def __refresh(self, watermark: dict) -> dict:
+        """ Check the leader on the new hours, and either continue its training or retrain from scratch. """
+
+        import joblib
+        from ..model_development.fast_model_search import FastModelSearch
+
+        new = (self.hours > pd.Timestamp(watermark["watermark"])).to_numpy()
+        refresh = {"model_id": watermark["model_id"], "new_rows": int(new.sum())}
+        if not new.any():
+            return {**refresh, "mode": "unchanged", "reason": "no new hours"}
+
+        model = joblib.load(watermark["model_path"])
+        x, y = self.__encode(data=self.data[new], watermark=watermark)
+        if x is None:
+            return {**refresh, **self.__retrain_from_scratch(reason="new stations")}
+
+        new_classes = np.unique(y)
+        if np.setdiff1d(new_classes, model.classes_).size:
+            return {**refresh, **self.__retrain_from_scratch(reason="new label classes")}
+        if not np.array_equal(new_classes, model.classes_):
+            return {**refresh, "mode": "deferred", "reason": "the new hours do not have every label class"}
+
+        # The new hours are unseen by the leader, so they validate it before they are trained on
+        metrics = FastModelSearch.score(y=y, probabilities=model.predict_proba(x), classes=model.classes_)
+        metric = self.__settings.sort_metric
+        reference = watermark["reference_metrics"][metric]
+        degradation = reference - metrics[metric] if metric == "aucpr" else metrics[metric] - reference
+        refresh.update({f"new_hours_{name}": value for name, value in metrics.items()})
+        refresh["degradation"] = degradation
+
+        if degradation > self.__settings.drift_threshold:
+            return {**refresh, **self.__retrain_from_scratch(reason=f"{metric} degraded by {degradation:.4f}")}
+
+        if watermark["algo"] == "HGB":
+            self.__continue_boosting(model=model, learning_rate=watermark["learning_rate"], x=x, y=y)
+            mode = "incremental"
+        else:
+            x_history, y_history = self.__encode(data=self.data, watermark=watermark)
+            if x_history is None:
+                return {**refresh, **self.__retrain_from_scratch(reason="the stations of the history changed")}
+            self.__refit_on_history(model=model, x=x_history, y=y_history)
+            mode = "refit"
+        joblib.dump(model, watermark["model_path"])
+        self.__write_watermark({**watermark, "watermark": self.hours[new].max().isoformat()})
+        return {**refresh, "mode": mode, "reason": "no drift"}
+
+    def __encode(self, data: pd.DataFrame, watermark: dict):
+        """ Encode the predictors like the full training did. Return None if the new hours have stations the leader has not seen. """
+
+        x = data[watermark["predictors"]].to_numpy(dtype=np.float64, copy=True)
+        station_codes = pd.Index(watermark["station_codes"])
+        position = watermark["predictors"].index("start_station_id")
+        codes = station_codes.get_indexer(data["start_station_id"].to_numpy(dtype=np.int64))
+        if (codes < 0).any():
+            return None, None
+        x[:, position] = codes
+        return x, data["labels"].to_numpy(dtype=np.int64)
+
+    def __continue_boosting(self, model, learning_rate: float, x: np.ndarray, y: np.ndarray):
+        """ Continue the training of a gradient boosting leader on the new hours, in place. """
+
+        # Boosting continues from the current trees. Early stopping needs a validation split that a few new hours cannot spare.
+        # The added trees are shrunk, so a few hours of data refine the model instead of overriding the history.
+        model.set_params(
+            warm_start=True,
+            early_stopping=False,
+            max_iter=model.n_iter_ + self.__settings.additional_trees,
+            learning_rate=learning_rate * self.__settings.incremental_learning_rate_factor
+        )
+        model.fit(x, y)
+
+    @staticmethod
+    def __refit_on_history(model, x: np.ndarray, y: np.ndarray):
+        """ Refit a logistic regression leader on the whole history, in place. """
+
+        # The preprocessing keeps its categories and scaling. The optimum moves little with a few new hours,
+        # so starting from the previous coefficients converges in few iterations.
+        preprocessing, classifier = model[:-1], model[-1]
+        classifier.set_params(warm_start=True)
+        classifier.fit(preprocessing.transform(x), y)
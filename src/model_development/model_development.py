@@ -0,0 +1,156 @@
+""" Build, train and test the demand prediction model using H2O AutoML. """
+
+import os
+import h2o
+import pandas as pd
+from h2o.automl import H2OAutoML
+
+
+class ModelBuilderTrainerTester:
+    """
+    Build, train and test an H2O AutoML model on the modelling dataset.
+        1. Write the modelling dataset once as a Parquet file, including a row_id column.
+        2. Import the Parquet file into H2O with a single import_file call.
+        3. Convert the labels into factors and split the data into training and test sets on the H2O server.
+        4. Build and train the AutoML model.
+        5. Save the leaderboard, the best models and the predictions of the best model on the test set.
+           The predictions are joined back to the original data through the row_id column.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param data: The modelling dataset, created by the DataEngineer class.
+    :param n_best_models: The number of best models to be saved.
+    """
+
+    def __init__(self, config, info_tracker, data: pd.DataFrame, n_best_models: int = 3):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.data = data
+        self.n_best_models = n_best_models
+
+        # H2O frames, all created server-side from a single upload
+        self.h2o_df: h2o.H2OFrame = None
+        self.train_h2o_df: h2o.H2OFrame = None
+        self.test_h2o_df: h2o.H2OFrame = None
+        self.predictors = None
+        self.targets = None
+
+        h2o.init()
+        self.__parquet_path = self.__write_modelling_data_to_parquet()
+        self.__import_parquet_to_h2o_frame()
+        self.__define_train_n_targets()
+        self.__split_data_to_train_test_sets()
+
+        self.model = self.__build_model()
+        self.trained_model = self.__train_model()
+        self.__save_leaderboard()
+        self.__save_n_best_models()
+        self.__predict_with_bmodel()
+
+    def __write_modelling_data_to_parquet(self) -> str:
+        """
+        Write the modelling dataset as a Parquet file, which is the only hand-off between pandas and H2O.
+        The original index is kept in a row_id column, to join the predictions back to the modelling data.
+        """
+
+        parquet_path = os.path.abspath(os.path.join(
+            self.config.paths2create.model_results,
+            "modelling_data.parquet"
+        ))
+
+        # Keep the original index as row_id and write the data without the pandas index
+        self.data.rename_axis("row_id").reset_index().to_parquet(parquet_path, index=False)
+
+        return parquet_path
+
+    def __import_parquet_to_h2o_frame(self):
+        """ Import the Parquet file into H2O. The file is parsed by the H2O server, without a pandas conversion. """
+        self.h2o_df = h2o.import_file(path=self.__parquet_path)
+
+    def __define_train_n_targets(self):
+        """
+        Define predictors and dependent variables.
+        Convert the dependent variable into factors on the H2O server, before the split.
+        The row_id is not a predictor, it is only used to join the predictions back.
+        """
+
+        # Define predictors and dependent variable
+        dependent_variable = "labels"
+        predictors = [col for col in self.h2o_df.columns if col not in (dependent_variable, "row_id")]
+
+        # Convert dependent variable to factors, so both train and test sets inherit the factor levels
+        self.h2o_df[dependent_variable] = self.h2o_df[dependent_variable].asfactor()
+
+        self.predictors = predictors
+        self.targets = dependent_variable
+
+    def __split_data_to_train_test_sets(self):
+        """ Split data into training and test sets on the H2O server. Keep unseen data for testing (30% by default), stratified by the labels. """
+
+        split_column = self.h2o_df[self.targets].stratified_split(
+            test_frac=self.config.modelling.test_fraction,
+            seed=self.config.random_state.seed
+        )
+        self.train_h2o_df = self.h2o_df[split_column == "train", :]
+        self.test_h2o_df = self.h2o_df[split_column == "test", :]
+
+    def __build_model(self):
+        """ Build h2o model. """
+        model = H2OAutoML(
+            balance_classes=True,
+            max_models=3,
+            max_runtime_secs=1800,
+            nfolds=self.config.modelling.nfolds,
+            sort_metric='AUCPR',
+            seed=self.config.random_state.seed
+        )
+        print(model)
+        return model
+
+    def __train_model(self):
+        """ Train the h2o model. """
+        model = self.model
+        model.train(
+            x=self.predictors,
+            y=self.targets,
+            training_frame=self.train_h2o_df
+        )
+        print(model)
+        return model
+
+    def __save_leaderboard(self):
+        """ Save leaderboard with training results. """
+        leaderboard = self.trained_model.leaderboard
+        leaderboard.as_data_frame(use_pandas=True).to_html(os.path.join(
+            self.config.paths2create.model_results,
+            "h20_report.html"
+        ))
+        self.info_tracker.h2o_leaderboard = leaderboard
+
+    def __save_n_best_models(self):
+        """ Save best models. """
+        leaderboard = self.info_tracker.h2o_leaderboard
+        leaderboard_df = leaderboard.as_data_frame(use_pandas=True)
+        self.info_tracker.h2o_leaderboard_df = leaderboard_df
+        for indx in range(self.n_best_models):
+            if indx <= len(leaderboard_df) - 1:
+                best_m = h2o.get_model(leaderboard_df.iloc[indx, 0])
+                h2o.save_model(
+                    model=best_m,
+                    path=self.config.paths2create.model_results,
+                    force=True
+                )
+
+    def __predict_with_bmodel(self):
+        """
+        Predict with best model and save report.
+        The test frame already contains the row_id, so no re-indexed copy of the test set is needed.
+        """
+        predict_df = self.trained_model.leader.predict(self.test_h2o_df)
+        total_df = predict_df.cbind(self.test_h2o_df)
+        total_df.as_data_frame(use_pandas=True).set_index("row_id").to_csv(
+            os.path.join(
+                self.config.paths2create.model_results,
+                "prediction_and_test_report.csv"
+            )
+        )
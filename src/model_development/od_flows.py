@@ -0,0 +1,207 @@
+""" Sparse origin-destination flow matrices per time slice, with net inflows and outflows per station. """
+
+import os
+import shutil
+from typing import List, Optional
+import numpy as np
+import pandas as pd
+
+SECONDS_PER_HOUR = 3600
+
+
+class ODFlowStore:
+    """
+    The rides from each station to each station in each time slice, stored as one stacked sparse CSR matrix.
+        - Row slice * n_stations + i holds the rides starting at station i in that slice, and column j the rides ending at station j.
+          Stations are indexed by their sorted ids, and slices by their sorted labels.
+        - A slice is either an hour (labelled by the hours since the epoch) or a day of week and hour of day
+          (labelled by day_of_week * 24 + hour, with 0 for Sunday as in the usage profiles).
+        - Only the station pairs with rides are stored, and the matrix is saved compressed with scipy.sparse.save_npz.
+        - The outflows of every station in every slice are the row sums of the stacked matrix,
+          and the inflows are its column sums per slice, so both are computed for all slices at once.
+
+    :param directory: The directory of the stored matrices.
+    """
+
+    MATRIX_FILE = "od_matrix.npz"
+    STATION_IDS_FILE = "station_ids.npy"
+    SLICES_FILE = "slices.npy"
+
+    def __init__(self, directory: str):
+        from scipy import sparse
+
+        self.directory = directory
+        self.matrix = sparse.load_npz(os.path.join(directory, self.MATRIX_FILE)).tocsr()
+        self.station_ids = np.load(os.path.join(directory, self.STATION_IDS_FILE))
+        self.slices = np.load(os.path.join(directory, self.SLICES_FILE))
+        self.n_stations = len(self.station_ids)
+        self.__station_index = pd.Index(self.station_ids)
+
+    @classmethod
+    def save(cls, directory: str, slices: np.ndarray, start_station_ids: np.ndarray, end_station_ids: np.ndarray, counts: np.ndarray) -> "ODFlowStore":
+        """ Build the stacked matrix from the ride counts per slice and station pair, save it and return the store. """
+
+        from scipy import sparse
+
+        station_ids = np.union1d(start_station_ids, end_station_ids)
+        unique_slices, slice_positions = np.unique(slices, return_inverse=True)
+        rows = slice_positions * len(station_ids) + np.searchsorted(station_ids, start_station_ids)
+        columns = np.searchsorted(station_ids, end_station_ids)
+
+        # Duplicate entries are summed by the conversion to CSR
+        matrix = sparse.coo_matrix(
+            (counts.astype(np.int32), (rows, columns)),
+            shape=(len(unique_slices) * len(station_ids), len(station_ids))
+        ).tocsr()
+
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, cls.MATRIX_FILE), matrix, compressed=True)
+        np.save(os.path.join(directory, cls.STATION_IDS_FILE), station_ids)
+        np.save(os.path.join(directory, cls.SLICES_FILE), unique_slices)
+        return cls(directory=directory)
+
+    @staticmethod
+    def hourly_slice(timestamp) -> int:
+        """ The label of the hourly slice of a timestamp, in UTC. """
+
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tz is None:
+            timestamp = timestamp.tz_localize("UTC")
+        return int(timestamp.timestamp()) // SECONDS_PER_HOUR
+
+    def slice_position(self, label: int) -> int:
+        """ The position of a slice label. A slice without rides raises a KeyError. """
+
+        position = int(np.searchsorted(self.slices, label))
+        if position == len(self.slices) or self.slices[position] != label:
+            raise KeyError(f"No rides in slice {label}.")
+        return position
+
+    def slice_matrix(self, label: int):
+        """ The stations x stations CSR matrix of the rides of one slice. """
+        position = self.slice_position(label)
+        return self.matrix[position * self.n_stations:(position + 1) * self.n_stations]
+
+    def flow(self, label: int, start_station_id: int, end_station_id: int) -> int:
+        """ The rides from one station to another in one slice. """
+
+        start, end = self.__station_index.get_indexer([start_station_id, end_station_id])
+        if start < 0 or end < 0:
+            return 0
+        return int(self.matrix[self.slice_position(label) * self.n_stations + start, end])
+
+    def outflows(self) -> np.ndarray:
+        """ The rides starting at each station in each slice, as a slices x stations array. """
+        return np.asarray(self.matrix.sum(axis=1)).reshape(len(self.slices), self.n_stations)
+
+    def inflows(self) -> np.ndarray:
+        """ The rides ending at each station in each slice, as a slices x stations array. """
+
+        # The slice of each stored entry is the slice of its row
+        row_slices = np.repeat(np.arange(self.matrix.shape[0]) // self.n_stations, np.diff(self.matrix.indptr))
+        return np.bincount(
+            row_slices * self.n_stations + self.matrix.indices,
+            weights=self.matrix.data,
+            minlength=len(self.slices) * self.n_stations
+        ).reshape(len(self.slices), self.n_stations).astype(np.int64)
+
+    def net_flows(self, labels: Optional[List[int]] = None) -> pd.DataFrame:
+        """
+        The inflow, outflow and net inflow of every station in every slice, or in the given slices only.
+        Station-slices without any ride are left out.
+        """
+
+        inflows, outflows = self.inflows(), self.outflows()
+        positions = np.arange(len(self.slices)) if labels is None else np.array([self.slice_position(label) for label in labels], dtype=np.int64)
+        inflows, outflows = inflows[positions], outflows[positions]
+
+        df = pd.DataFrame({
+            "slice": np.repeat(self.slices[positions], self.n_stations),
+            "station_id": np.tile(self.station_ids, len(positions)),
+            "inflow": inflows.ravel(),
+            "outflow": outflows.ravel(),
+        })
+        df["net_flow"] = df["inflow"] - df["outflow"]
+        return df[(df["inflow"] > 0) | (df["outflow"] > 0)].reset_index(drop=True)
+
+
+class ODFlowBuilder:
+    """
+    Build the origin-destination flow matrices of the rides and save them with the ODFlowStore class.
+        1. Count the rides per slice and station pair in BigQuery, and stream the counts page by page.
+        2. Build one store per year with hourly slices, or one store of all years with day of week and hour slices.
+        3. Save the net inflows of every station per store in the info_tracker object.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.od_flows
+
+        if self.__settings.slicing == "dow_hour":
+            self.stores = {"dow_hour": self.__build_store(name="dow_hour", year=None)}
+        elif self.__settings.slicing == "hourly":
+            self.stores = {str(year): self.__build_store(name=str(year), year=year) for year in self.__settings.years}
+        else:
+            raise ValueError(f"Unknown OD slicing '{self.__settings.slicing}'. Use 'hourly' or 'dow_hour'.")
+
+        frames = []
+        for name, store in self.stores.items():
+            inflows, outflows = store.inflows().sum(axis=0), store.outflows().sum(axis=0)
+            frames.append(pd.DataFrame({
+                "store": name,
+                "station_id": store.station_ids,
+                "inflow": inflows,
+                "outflow": outflows,
+                "net_flow": inflows - outflows,
+            }))
+        self.info_tracker.od_net_flows = pd.concat(frames, ignore_index=True) if frames else None
+
+    def __build_store(self, name: str, year: Optional[int]) -> ODFlowStore:
+        """ Count the rides per slice and station pair, for one year with hourly slices, or for all years with day of week and hour slices. """
+
+        if year is None:
+            slice_expression = "(EXTRACT(DAYOFWEEK FROM start_date) - 1) * 24 + EXTRACT(HOUR FROM start_date)"
+            year_filter = ""
+        else:
+            slice_expression = f"DIV(UNIX_SECONDS(TIMESTAMP_TRUNC(start_date, HOUR)), {SECONDS_PER_HOUR})"
+            year_filter = f"AND EXTRACT(YEAR FROM start_date) = {int(year)}"
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                {slice_expression} AS time_slice,
+                start_station_id,
+                end_station_id,
+                COUNT(*) AS number_of_rides
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND end_station_id IS NOT NULL
+                {year_filter}
+            GROUP BY
+                time_slice,
+                start_station_id,
+                end_station_id
+            """
+        )
+
+        columns = {"time_slice": [], "start_station_id": [], "end_station_id": [], "number_of_rides": []}
+        for page in query_job.result(page_size=self.__settings.page_size).to_dataframe_iterable():
+            for column, values in columns.items():
+                values.append(page[column].to_numpy(dtype=np.int64))
+        slices, start_ids, end_ids, counts = (
+            np.concatenate(values) if values else np.empty(0, dtype=np.int64) for values in columns.values()
+        )
+
+        directory = os.path.join(self.config.paths2create.od_flows, name)
+        shutil.rmtree(directory, ignore_errors=True)
+        return ODFlowStore.save(directory=directory, slices=slices, start_station_ids=start_ids, end_station_ids=end_ids, counts=counts)
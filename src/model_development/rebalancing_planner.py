@@ -0,0 +1,330 @@
+""" Demand-aware rebalancing plan: simulate the station inventories over the next hours and move bikes with a min-cost flow. """
+
+import json
+import os
+from typing import Dict, Optional
+import numpy as np
+import pandas as pd
+from ..model_development.station_distances import StationDistanceMatrix
+
+HOURS_PER_WEEK = 7 * 24
+SECONDS_PER_HOUR = 3600
+
+
+class InventorySimulator:
+    """
+    Monte Carlo simulation of the bikes docked at every station, hour by hour.
+        - The rentals and returns of every station and hour are drawn once from Poisson distributions with the expected counts,
+          for n_scenarios scenarios, and stored as the net change of the inventory.
+        - Every start inventory is simulated on the same scenarios, so their lost trips are compared without sampling noise between them.
+        - Each hour adds the net change to the inventories of all scenarios and stations at once. A negative inventory is rentals
+          lost to an empty station, and an inventory above the docks is returns lost to a full station. Both are clipped.
+          The rentals and returns are netted within the hour, so the losses are a lower bound.
+
+    :param departures: The expected rentals, with shape (stations, hours).
+    :param arrivals: The expected returns, with shape (stations, hours).
+    :param docks: The number of docks of every station.
+    :param n_scenarios: The number of simulated scenarios.
+    :param seed: The seed of the random draws.
+    """
+
+    def __init__(self, departures: np.ndarray, arrivals: np.ndarray, docks: np.ndarray, n_scenarios: int, seed: int):
+        rng = np.random.default_rng(seed)
+        shape = (n_scenarios,) + departures.shape
+        self.docks = np.asarray(docks, dtype=np.int32)
+        # Hours first, so every step reads a contiguous scenarios x stations block
+        self.net_changes = np.ascontiguousarray(
+            (rng.poisson(arrivals, size=shape) - rng.poisson(departures, size=shape)).astype(np.int32).transpose(2, 0, 1)
+        )
+
+    def simulate(self, start: np.ndarray) -> Dict[str, np.ndarray]:
+        """
+        Simulate start inventories of shape (..., stations) over all scenarios.
+        Return the expected lost rentals, lost returns and end inventory, each of shape (..., stations).
+        """
+
+        start = np.asarray(start, dtype=np.int32)
+        inventory = np.broadcast_to(start[..., None, :], start.shape[:-1] + self.net_changes.shape[1:]).copy()
+        lost_rentals = np.zeros_like(inventory)
+        lost_returns = np.zeros_like(inventory)
+        for net_change in self.net_changes:
+            inventory += net_change
+            lost_rentals -= np.minimum(inventory, 0)
+            lost_returns += np.maximum(inventory - self.docks, 0)
+            np.clip(inventory, 0, self.docks, out=inventory)
+
+        return {
+            "lost_rentals": lost_rentals.mean(axis=-2),
+            "lost_returns": lost_returns.mean(axis=-2),
+            "end_inventory": inventory.mean(axis=-2),
+        }
+
+
+class RebalancingPlanner:
+    """
+    Plan the bikes to move between stations now, so the stations neither run empty nor full over the next horizon_hours hours.
+        1. Load the bikes and docks of every station from the cycle_stations table,
+           and the mean rentals and returns per station, day of week and hour over the last history_weeks weeks of the rides.
+        2. If enabled and saved, predict the demand class of the next hours of the stations of the incremental training leader,
+           and bring their expected rentals into the rental range of the predicted class.
+        3. Simulate every station from n_levels start inventories, from empty to full, with the InventorySimulator class.
+           The start inventories with at most loss_tolerance more expected lost trips than the best one are the target range of the station.
+        4. The stations above their range have a surplus and the stations below it a deficit. The bikes are moved with a min-cost flow
+           over the distance matrix of the stations: each surplus station can supply its nearest_stations nearest deficit stations
+           within max_move_km, and the surplus that is not needed stays where it is.
+        5. Simulate the planned inventories, and save the plan per station and the moves in the aggregates directory
+           and in the info_tracker object.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    PLAN_FILE = "rebalancing_plan.parquet"
+    MOVES_FILE = "rebalancing_plan_moves.parquet"
+    # The cost of a bike of deficit left unmet, in metres. It is above any move, so a reachable deficit is always supplied.
+    UNMET_DEFICIT_COST = 10 ** 9
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.rebalancing_plan
+
+        self.stations = self.__load_stations()
+        self.hours = self.__plan_hours()
+        departures, arrivals = self.__expected_demand()
+
+        simulator = InventorySimulator(
+            departures=departures,
+            arrivals=arrivals,
+            docks=self.stations["docks_count"].to_numpy(),
+            n_scenarios=self.__settings.n_scenarios,
+            seed=self.config.random_state.seed
+        )
+        low, high = self.__target_ranges(simulator=simulator)
+        moves = self.__plan_moves(low=low, high=high)
+        self.info_tracker.rebalancing_plan = self.__summarise(simulator=simulator, low=low, high=high, moves=moves)
+        self.info_tracker.rebalancing_plan_moves = moves
+
+        self.info_tracker.rebalancing_plan.to_parquet(os.path.join(self.config.paths2create.aggregates, self.PLAN_FILE), index=False)
+        moves.to_parquet(os.path.join(self.config.paths2create.aggregates, self.MOVES_FILE), index=False)
+
+    def __load_stations(self) -> pd.DataFrame:
+        """
+        Load the coordinates, bikes and docks of the stations with docks.
+        All the stations are kept apart for the distance matrix, which is cached from the same station set as the RouteMetrics class.
+        """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT id, latitude, longitude, bikes_count, docks_count
+            FROM bigquery-public-data.london_bicycles.{self.config.database.station_table}
+            """
+        )
+        self.__all_stations = query_job.result().to_dataframe()
+        df = self.__all_stations[self.__all_stations["docks_count"] > 0]
+        df = df.dropna(subset=["latitude", "longitude"]).sort_values("id").drop_duplicates(subset="id").reset_index(drop=True)
+        df["bikes_count"] = df["bikes_count"].fillna(0).clip(lower=0, upper=df["docks_count"]).astype(np.int32)
+        df["docks_count"] = df["docks_count"].astype(np.int32)
+        return df
+
+    def __plan_hours(self) -> pd.DatetimeIndex:
+        """ The UTC hours of the plan, from the configured start or the current hour. """
+
+        start = pd.Timestamp(self.__settings.plan_start) if self.__settings.plan_start else pd.Timestamp.now(tz="UTC")
+        start = (start.tz_localize("UTC") if start.tz is None else start.tz_convert("UTC")).floor("h")
+        return pd.date_range(start=start, periods=self.__settings.horizon_hours, freq="h")
+
+    def __expected_demand(self):
+        """ The expected rentals and returns of every station in every hour of the plan, with shape (stations, hours). """
+
+        rates = self.__mean_demand_per_day_of_week_n_hour()
+        station_positions = pd.Index(self.stations["id"]).get_indexer(rates["station_id"])
+        known = station_positions >= 0
+        slots = (rates["day_of_week"].to_numpy() * 24 + rates["hour"].to_numpy())[known]
+
+        departures = np.zeros((len(self.stations), HOURS_PER_WEEK))
+        arrivals = np.zeros((len(self.stations), HOURS_PER_WEEK))
+        departures[station_positions[known], slots] = rates["departures"].to_numpy(dtype=np.float64)[known]
+        arrivals[station_positions[known], slots] = rates["arrivals"].to_numpy(dtype=np.float64)[known]
+
+        # Day of week 0 is Sunday, as in BigQuery
+        plan_slots = ((self.hours.dayofweek.to_numpy() + 1) % 7) * 24 + self.hours.hour.to_numpy()
+        departures, arrivals = departures[:, plan_slots], arrivals[:, plan_slots]
+
+        if self.__settings.use_predictions:
+            predicted = self.__predicted_classes()
+            if predicted is not None:
+                departures = self.__bring_into_predicted_classes(departures=departures, predicted=predicted)
+        return departures, arrivals
+
+    def __mean_demand_per_day_of_week_n_hour(self) -> pd.DataFrame:
+        """ The mean rentals and returns per station, day of week (0 is Sunday) and hour, over the last history_weeks weeks of the rides. """
+
+        table = f"bigquery-public-data.london_bicycles.{self.config.database.hire_table}"
+        weeks = int(self.__settings.history_weeks)
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            WITH LastRide AS (
+                SELECT TIMESTAMP_SUB(MAX(start_date), INTERVAL {7 * weeks} DAY) AS history_start
+                FROM {table}
+            ),
+            Events AS (
+                SELECT start_station_id AS station_id, start_date AS event_date, 1 AS departures, 0 AS arrivals
+                FROM {table}, LastRide
+                WHERE start_date > history_start AND start_station_id IS NOT NULL
+                UNION ALL
+                SELECT end_station_id AS station_id, end_date AS event_date, 0 AS departures, 1 AS arrivals
+                FROM {table}, LastRide
+                WHERE end_date > history_start AND end_station_id IS NOT NULL
+            )
+            SELECT
+                station_id,
+                EXTRACT(DAYOFWEEK FROM event_date) - 1 AS day_of_week,
+                EXTRACT(HOUR FROM event_date) AS hour,
+                SUM(departures) / {weeks} AS departures,
+                SUM(arrivals) / {weeks} AS arrivals
+            FROM
+                Events
+            GROUP BY
+                station_id,
+                day_of_week,
+                hour;
+            """
+        )
+        return query_job.result().to_dataframe()
+
+    def __predicted_classes(self) -> Optional[pd.DataFrame]:
+        """
+        Predict the demand class of the plan hours for the stations of the incremental training leader, with the encoding of its watermark.
+        Return None if no leader was saved.
+        """
+
+        from ..model_development.incremental_training import IncrementalModelTrainer
+
+        watermark_path = os.path.join(self.config.paths2create.model_results, IncrementalModelTrainer.WATERMARK_FILE)
+        if not os.path.exists(watermark_path):
+            return None
+        with open(watermark_path) as file:
+            watermark = json.load(file)
+
+        import joblib
+        model = joblib.load(watermark["model_path"])
+
+        station_ids = np.intersect1d(watermark["station_codes"], self.stations["id"].to_numpy())
+        if len(station_ids) == 0:
+            return None
+        grid = pd.DataFrame({
+            "start_station_id": np.repeat(station_ids, len(self.hours)),
+            "hour_position": np.tile(np.arange(len(self.hours)), len(station_ids)),
+        })
+        hours = self.hours[grid["hour_position"]]
+        features = pd.DataFrame({
+            "start_station_id": pd.Index(watermark["station_codes"]).get_indexer(grid["start_station_id"]),
+            "year": hours.year,
+            "month": hours.month,
+            "day": hours.day,
+            "hour": hours.hour,
+            "docks_count": self.stations.set_index("id")["docks_count"].reindex(grid["start_station_id"]).to_numpy(),
+        })
+        grid["demand_class"] = model.predict(features[watermark["predictors"]].to_numpy(dtype=np.float64))
+        return grid
+
+    def __bring_into_predicted_classes(self, departures: np.ndarray, predicted: pd.DataFrame) -> np.ndarray:
+        """ Clip the expected rentals into the rental range of the predicted class, with the class thresholds of the DataEngineer class. """
+
+        bounds = np.concatenate([[-1.0], np.asarray(self.config.streaming.class_thresholds, dtype=np.float64), [np.inf]])
+        classes = predicted["demand_class"].to_numpy(dtype=np.int64)
+        rows = pd.Index(self.stations["id"]).get_indexer(predicted["start_station_id"])
+        columns = predicted["hour_position"].to_numpy()
+
+        departures = departures.copy()
+        departures[rows, columns] = np.clip(departures[rows, columns], bounds[classes] + 1, bounds[classes + 1])
+        return departures
+
+    def __target_ranges(self, simulator: InventorySimulator):
+        """ The lowest and the highest start inventory of every station whose expected lost trips are within loss_tolerance of the best. """
+
+        docks = self.stations["docks_count"].to_numpy()
+        fractions = np.linspace(0, 1, self.__settings.n_levels)
+        levels = np.rint(fractions[:, None] * docks[None, :]).astype(np.int32)
+
+        simulated = simulator.simulate(start=levels)
+        losses = simulated["lost_rentals"] + simulated["lost_returns"]
+        acceptable = losses <= losses.min(axis=0) + self.__settings.loss_tolerance
+
+        low = np.where(acceptable, levels, np.iinfo(np.int32).max).min(axis=0)
+        high = np.where(acceptable, levels, -1).max(axis=0)
+        return low, high
+
+    def __plan_moves(self, low: np.ndarray, high: np.ndarray) -> pd.DataFrame:
+        """ Move the surplus bikes to the deficit stations with a min-cost flow over the distances in metres. """
+
+        import networkx as nx
+
+        bikes = self.stations["bikes_count"].to_numpy()
+        surplus, deficit = np.maximum(bikes - high, 0), np.maximum(low - bikes, 0)
+        sources, sinks = np.flatnonzero(surplus), np.flatnonzero(deficit)
+        columns = ["from_station_id", "to_station_id", "bikes", "distance_km"]
+        if len(sources) == 0 or len(sinks) == 0:
+            return pd.DataFrame(columns=columns)
+
+        # Built from all the stations, so the cached matrix is shared with the RouteMetrics class. The planned stations are indexed into it.
+        matrix = StationDistanceMatrix.load_or_build(directory=self.config.paths2create.station_distances, stations=self.__all_stations)
+        positions = pd.Index(matrix.station_ids).get_indexer(self.stations["id"])
+        distances = np.asarray(matrix.distances[positions[sources][:, None], positions[sinks][None, :]])
+
+        # Nodes are station positions, and -1 takes the surplus that is not needed, or makes up the deficit that cannot be reached
+        graph = nx.DiGraph()
+        graph.add_node(-1, demand=int(surplus.sum() - deficit.sum()))
+        for source in sources:
+            graph.add_node(int(source), demand=-int(surplus[source]))
+            graph.add_edge(int(source), -1, weight=0)
+        for sink in sinks:
+            graph.add_node(int(sink), demand=int(deficit[sink]))
+            graph.add_edge(-1, int(sink), weight=self.UNMET_DEFICIT_COST)
+
+        n_nearest = min(self.__settings.nearest_stations, len(sinks))
+        nearest = np.argpartition(distances, n_nearest - 1, axis=1)[:, :n_nearest]
+        for row, source in enumerate(sources):
+            for column in nearest[row]:
+                if distances[row, column] <= self.__settings.max_move_km:
+                    graph.add_edge(int(source), int(sinks[column]), weight=int(round(distances[row, column] * 1000)))
+
+        flows = nx.min_cost_flow(graph)
+        moves = [
+            (source, sink, bikes_moved)
+            for source, targets in flows.items() if source >= 0
+            for sink, bikes_moved in targets.items() if sink >= 0 and bikes_moved > 0
+        ]
+        station_ids = self.stations["id"].to_numpy()
+        moves = pd.DataFrame(moves, columns=["source", "sink", "bikes"])
+        moves = pd.DataFrame({
+            "from_station_id": station_ids[moves["source"].to_numpy(dtype=np.int64)],
+            "to_station_id": station_ids[moves["sink"].to_numpy(dtype=np.int64)],
+            "bikes": moves["bikes"].to_numpy(dtype=np.int64),
+            "distance_km": np.asarray(matrix.distances[positions[moves["source"]], positions[moves["sink"]]], dtype=np.float64),
+        }, columns=columns)
+        return moves.sort_values(["bikes", "distance_km"], ascending=[False, True], ignore_index=True)
+
+    def __summarise(self, simulator: InventorySimulator, low: np.ndarray, high: np.ndarray, moves: pd.DataFrame) -> pd.DataFrame:
+        """ The plan per station, with the expected lost trips of the current and the planned inventories. """
+
+        plan = self.stations[["id", "bikes_count", "docks_count"]].rename(columns={"id": "station_id"})
+        plan["target_low"], plan["target_high"] = low, high
+        moved = (
+            moves.groupby("to_station_id")["bikes"].sum().reindex(plan["station_id"], fill_value=0).to_numpy()
+            - moves.groupby("from_station_id")["bikes"].sum().reindex(plan["station_id"], fill_value=0).to_numpy()
+        )
+        plan["planned_bikes"] = plan["bikes_count"] + moved
+
+        for name, start in (("current", plan["bikes_count"].to_numpy()), ("planned", plan["planned_bikes"].to_numpy())):
+            simulated = simulator.simulate(start=start)
+            plan[f"{name}_lost_rentals"] = simulated["lost_rentals"]
+            plan[f"{name}_lost_returns"] = simulated["lost_returns"]
+        plan["plan_start"] = self.hours[0]
+        return plan
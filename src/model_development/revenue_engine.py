@@ -0,0 +1,147 @@
+""" Evaluate tariff schedules over duration histograms of the rides. """
+
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Sequence, Union
+import numpy as np
+import pandas as pd
+
+
+@dataclass
+class Tariff:
+    """
+    A pay-per-ride tariff.
+        1. A hire fee is charged for every ride.
+        2. The first free_minutes of a ride are free.
+        3. Every started period of period_minutes after the free minutes costs price_per_period.
+        4. If a daily cap is given, the price of each started day of riding is capped.
+    """
+    name: str
+    free_minutes: float
+    period_minutes: float
+    price_per_period: float
+    daily_cap: Optional[float] = None
+    hire_fee: float = 0.0
+
+    @classmethod
+    def read_config(cls: type, obj: dict) -> "Tariff":
+        return cls(
+            name=obj["name"],
+            free_minutes=obj["free_minutes"],
+            period_minutes=obj["period_minutes"],
+            price_per_period=obj["price_per_period"],
+            daily_cap=obj.get("daily_cap"),
+            hire_fee=obj.get("hire_fee", 0.0)
+        )
+
+    def price(self, durations: np.ndarray) -> np.ndarray:
+        """ Price rides of the given durations in seconds. """
+
+        durations = np.maximum(np.asarray(durations, dtype=float), 0)
+        chargeable_periods = np.ceil(np.maximum(durations - self.free_minutes * 60, 0) / (self.period_minutes * 60))
+        prices = self.hire_fee + chargeable_periods * self.price_per_period
+
+        if self.daily_cap is not None:
+            started_days = np.maximum(np.ceil(durations / 86400), 1)
+            prices = np.minimum(prices, started_days * self.daily_cap)
+
+        return prices
+
+
+@dataclass
+class TariffMix:
+    """ A mix of tariffs, e.g. casual riders and members, weighted by the share of rides of each tariff. """
+    name: str
+    shares: Dict[str, float]
+
+    @classmethod
+    def read_config(cls: type, obj: dict) -> "TariffMix":
+        return cls(name=obj["name"], shares=dict(obj["shares"]))
+
+
+class RevenueEngine:
+    """
+    Evaluate any tariff schedule over a duration histogram per station and year, without scanning the rides again.
+        1. Index the histogram as a matrix of station-years by fixed-width duration bins.
+           The last bin collects all rides longer than the maximum duration.
+        2. Price a representative duration of each bin with each tariff, which gives a matrix of bins by tariffs.
+           Regular bins are priced at their midpoint, the overflow bin at the mean duration of its rides.
+           The prices are exact when the tariff periods are multiples of the bin width, except for rides ending exactly on a period boundary.
+        3. The revenue of every station-year under every tariff is the product of the two matrices.
+
+    :param histogram: The duration histogram, with the columns year, start_station_name, duration_bin, number_of_rides and total_duration.
+    :param bin_width_secs: The width of a duration bin in seconds.
+    :param max_duration_secs: The start of the overflow bin in seconds.
+    """
+
+    def __init__(self, histogram: pd.DataFrame, bin_width_secs: int, max_duration_secs: int):
+        self.bin_width_secs = bin_width_secs
+        self.n_bins = int(np.ceil(max_duration_secs / bin_width_secs)) + 1
+        self.station_years, self.counts = self.__build_histogram_matrix(histogram=histogram)
+        self.representative_durations = self.__compute_representative_durations(histogram=histogram)
+
+    def __build_histogram_matrix(self, histogram: pd.DataFrame):
+        """ Build the matrix of ride counts, with one row per station-year and one column per duration bin. """
+
+        keys = histogram[["year", "start_station_name"]]
+        station_years = keys.drop_duplicates().reset_index(drop=True)
+        codes = pd.MultiIndex.from_frame(station_years).get_indexer(pd.MultiIndex.from_frame(keys))
+        bins = np.minimum(histogram["duration_bin"].to_numpy(dtype=np.int64), self.n_bins - 1)
+
+        counts = np.bincount(
+            codes * self.n_bins + bins,
+            weights=histogram["number_of_rides"].to_numpy(dtype=np.float64),
+            minlength=len(station_years) * self.n_bins
+        ).reshape(len(station_years), self.n_bins)
+
+        return station_years, counts
+
+    def __compute_representative_durations(self, histogram: pd.DataFrame) -> np.ndarray:
+        """ Compute the duration each bin is priced at. """
+
+        durations = (np.arange(self.n_bins) + 0.5) * self.bin_width_secs
+
+        overflow = histogram["duration_bin"].to_numpy(dtype=np.int64) >= self.n_bins - 1
+        overflow_rides = histogram.loc[overflow, "number_of_rides"].sum()
+        if overflow_rides > 0:
+            durations[-1] = histogram.loc[overflow, "total_duration"].sum() / overflow_rides
+
+        return durations
+
+    def price_matrix(self, tariffs: Sequence[Union[Tariff, TariffMix]], tariffs_by_name: Dict[str, Tariff] = None) -> np.ndarray:
+        """
+        Price the representative duration of each bin with each tariff, which gives a matrix of bins by tariffs.
+        A tariff mix is priced as the weighted average of its tariffs, which are looked up in tariffs_by_name.
+        """
+
+        tariffs_by_name = tariffs_by_name or {tariff.name: tariff for tariff in tariffs if isinstance(tariff, Tariff)}
+        columns = []
+        for tariff in tariffs:
+            if isinstance(tariff, TariffMix):
+                columns.append(sum(
+                    share * tariffs_by_name[name].price(self.representative_durations)
+                    for name, share in tariff.shares.items()
+                ))
+            else:
+                columns.append(tariff.price(self.representative_durations))
+        return np.column_stack(columns)
+
+    def evaluate(self, tariffs: Sequence[Union[Tariff, TariffMix]], tariffs_by_name: Dict[str, Tariff] = None) -> pd.DataFrame:
+        """ Compute the revenue of every station-year under every tariff, with one column per tariff. """
+
+        revenue = self.counts @ self.price_matrix(tariffs=tariffs, tariffs_by_name=tariffs_by_name)
+        df = self.station_years.copy()
+        for position, tariff in enumerate(tariffs):
+            df[tariff.name] = revenue[:, position].round(2)
+        return df
+
+    def top_stations_per_year(self, tariff: Union[Tariff, TariffMix], n: int = 3, tariffs_by_name: Dict[str, Tariff] = None) -> pd.DataFrame:
+        """ Identify the n stations with the highest revenue per year under the given tariff. """
+
+        df = self.evaluate(tariffs=[tariff], tariffs_by_name=tariffs_by_name).rename(columns={tariff.name: "profit"})
+        df = df.sort_values(["year", "profit"], ascending=[True, False])
+        return df.groupby("year", sort=False).head(n).reset_index(drop=True)
+
+    @staticmethod
+    def read_tariffs(tariffs: List[dict], tariff_mixes: List[dict]) -> List[Union[Tariff, TariffMix]]:
+        """ Read the tariffs and the tariff mixes of the configuration. """
+        return [Tariff.read_config(obj=obj) for obj in tariffs] + [TariffMix.read_config(obj=obj) for obj in tariff_mixes]
@@ -0,0 +1,239 @@
+""" Approximate route rankings with bounded memory, using APPROX_TOP_COUNT in BigQuery or local streaming sketches. """
+
+from typing import Dict, List, Tuple
+import numpy as np
+import pandas as pd
+from ..helper.sketches import CountMinSketch, SpaceSaving
+
+
+class RouteAnalyser:
+    """
+    Identify the most popular routes without grouping and sorting every route, in one of two modes:
+        1. approx: Use APPROX_TOP_COUNT in BigQuery. The warehouse keeps a bounded summary per group instead of every route.
+           BigQuery does not report the error of APPROX_TOP_COUNT, so the error columns are left empty.
+        2. sketch: Count the rides per route and year (and month if configured) in BigQuery, stream the counts page by page,
+           and add them locally to Space-Saving sketches, one per year (and per month or borough if configured).
+           The all-time ranking merges the yearly sketches, and its counts are tightened with a Count-Min sketch.
+           Every count is an overestimate and is reported next to its maximum error.
+    Like the exact mode of the DataExplorer class, the routes are keyed by their station ids, so a renamed station is not split.
+    The routes are named after the stations of the cycle_stations table.
+
+    The per-borough ranking uses the station to borough mapping created by the DataPreprocessor class, so it is only available in sketch mode.
+    The results are saved in the info_tracker object, in the same format as the exact route rankings of the DataExplorer class.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    # Route keys combine the starting and the end station ids in a single integer
+    ROUTE_KEY_FACTOR = 1_000_000
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.route_analytics
+
+        if self.__settings.per_borough and self.info_tracker.cycle_station_data_with_borough_names is None:
+            raise ValueError("The per borough route ranking needs the station borough names created by the DataPreprocessor class.")
+
+        if self.__settings.mode == "approx":
+            if self.__settings.per_borough:
+                raise ValueError("The per borough route ranking is only available in sketch mode.")
+            self.__station_names = self.__load_station_names()
+            self.info_tracker.top_roots_of_all_time = self.__approx_top_routes(k=self.__settings.top_routes_of_all_time, periods=[])
+            self.info_tracker.top_roots_per_year = self.__approx_top_routes(k=self.__settings.top_routes_per_period, periods=["year"])
+            if self.__settings.per_month:
+                self.info_tracker.top_roots_per_month = self.__approx_top_routes(k=self.__settings.top_routes_per_period, periods=["year", "month"])
+        elif self.__settings.mode == "sketch":
+            self.__station_names = self.__load_station_names()
+            self.__sketches, self.__count_min = self.__stream_routes_into_sketches()
+            self.info_tracker.top_roots_of_all_time = self.__rank_routes_of_all_time()
+            self.info_tracker.top_roots_per_year = self.__rank_routes_per_group(group="year", columns=["year"])
+            if self.__settings.per_month:
+                self.info_tracker.top_roots_per_month = self.__rank_routes_per_group(group="month", columns=["year", "month"])
+            if self.__settings.per_borough:
+                self.info_tracker.top_roots_per_borough = self.__rank_routes_per_group(group="borough", columns=["borough_name"])
+        else:
+            raise ValueError(f"Unknown route analytics mode '{self.__settings.mode}'. Use 'approx' or 'sketch'.")
+
+    def __approx_top_routes(self, k: int, periods: List[str]) -> pd.DataFrame:
+        """ Rank the routes with APPROX_TOP_COUNT, for all years or per period (year, or year and month). """
+
+        period_expressions = {
+            "year": "EXTRACT(YEAR FROM start_date) AS year",
+            "month": "EXTRACT(MONTH FROM start_date) AS month",
+        }
+        select_periods = "".join(f"{period_expressions[period]},\n" for period in periods)
+        outer_periods = "".join(f"{period},\n" for period in periods)
+        group_by = f"GROUP BY {', '.join(periods)}" if periods else ""
+        count_column = "number_of_routes" if periods else "frequency"
+
+        # Build query. The route is a single integer key, as APPROX_TOP_COUNT counts one value per row.
+        query_job = self.__gcp_client.query(
+            f"""
+            WITH TopRoutes AS (
+                SELECT
+                    {select_periods}
+                    APPROX_TOP_COUNT(start_station_id * {self.ROUTE_KEY_FACTOR} + end_station_id, {k}) AS routes
+                FROM
+                    bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+                WHERE
+                    start_station_id IS NOT NULL
+                    AND end_station_id IS NOT NULL
+                {group_by}
+            )
+
+            SELECT
+                {outer_periods}
+                route.value AS route_key,
+                route.count AS {count_column}
+            FROM
+                TopRoutes, UNNEST(routes) AS route
+            ORDER BY
+                {outer_periods}
+                {count_column} DESC;
+            """
+        )
+        df = query_job.result().to_dataframe()
+        routes = self.__routes_to_frame(
+            keys=df["route_key"].to_numpy(dtype=np.int64),
+            counts=df[count_column].to_numpy(dtype=np.int64),
+            errors=np.full(len(df), np.nan),
+            count_column=count_column
+        )
+        return pd.concat([df[periods].reset_index(drop=True), routes], axis=1)
+
+    def __load_station_names(self) -> pd.Series:
+        """ Load the name of each station, to name the ranked routes. """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT id, name
+            FROM bigquery-public-data.london_bicycles.{self.config.database.station_table}
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df.set_index("id")["name"]
+
+    def __stream_routes_into_sketches(self) -> Tuple[Dict[str, Dict], CountMinSketch]:
+        """
+        Count the rides per route and period in BigQuery, stream the counts page by page, and add them to a Space-Saving sketch per group.
+        The warehouse returns one row per route and period instead of one per ride.
+        Only one page is held in memory at a time, and every sketch keeps at most sketch_capacity routes.
+        """
+
+        month = "EXTRACT(MONTH FROM start_date)" if self.__settings.per_month else "0"
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                EXTRACT(YEAR FROM start_date) AS year,
+                {month} AS month,
+                start_station_id,
+                end_station_id,
+                COUNT(*) AS number_of_rides
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+                AND end_station_id IS NOT NULL
+            GROUP BY
+                year,
+                month,
+                start_station_id,
+                end_station_id
+            """
+        )
+
+        boroughs = None
+        if self.__settings.per_borough:
+            boroughs = self.info_tracker.cycle_station_data_with_borough_names.set_index("id")["borough_name"]
+
+        sketches = {"year": {}, "month": {}, "borough": {}}
+        count_min = CountMinSketch(
+            width=self.__settings.count_min_width,
+            depth=self.__settings.count_min_depth,
+            seed=self.config.random_state.seed
+        )
+
+        for page in query_job.result(page_size=self.__settings.page_size).to_dataframe_iterable():
+            keys = page["start_station_id"].to_numpy(dtype=np.int64) * self.ROUTE_KEY_FACTOR + page["end_station_id"].to_numpy(dtype=np.int64)
+            counts = page["number_of_rides"].to_numpy(dtype=np.int64)
+            count_min.update(keys=keys, counts=counts)
+
+            years = page["year"].to_numpy(dtype=np.int64)
+            self.__update_group_sketches(sketches=sketches["year"], groups=years, keys=keys, counts=counts)
+            if self.__settings.per_month:
+                months = years * 100 + page["month"].to_numpy(dtype=np.int64)
+                self.__update_group_sketches(sketches=sketches["month"], groups=months, keys=keys, counts=counts)
+            if boroughs is not None:
+                page_boroughs = boroughs.reindex(page["start_station_id"]).fillna("no_borough").to_numpy()
+                self.__update_group_sketches(sketches=sketches["borough"], groups=page_boroughs, keys=keys, counts=counts)
+
+        return sketches, count_min
+
+    def __update_group_sketches(self, sketches: Dict, groups: np.ndarray, keys: np.ndarray, counts: np.ndarray):
+        """ Update the sketch of each group with the route keys of that group and their ride counts. """
+
+        unique_groups, inverse = np.unique(groups, return_inverse=True)
+        order = np.argsort(inverse, kind="stable")
+        boundaries = np.searchsorted(inverse[order], np.arange(len(unique_groups) + 1))
+
+        for position, group in enumerate(unique_groups):
+            group = group.item() if isinstance(group, np.generic) else group
+            if group not in sketches:
+                sketches[group] = SpaceSaving(capacity=self.__settings.sketch_capacity)
+            rows = order[boundaries[position]:boundaries[position + 1]]
+            sketches[group].update(keys=keys[rows], counts=counts[rows])
+
+    def __routes_to_frame(self, keys: np.ndarray, counts: np.ndarray, errors: np.ndarray, count_column: str) -> pd.DataFrame:
+        """ Convert route keys, counts and errors into a dataframe with the station names. """
+
+        start_ids, end_ids = np.divmod(keys, self.ROUTE_KEY_FACTOR)
+        return pd.DataFrame({
+            "start_station_name": self.__station_names.reindex(start_ids).to_numpy(),
+            "end_station_name": self.__station_names.reindex(end_ids).to_numpy(),
+            count_column: counts,
+            f"{count_column}_error": errors,
+        })
+
+    def __rank_routes_of_all_time(self) -> pd.DataFrame:
+        """
+        Merge the yearly sketches into an all-time sketch and rank its routes.
+        The counts are the lowest of the Space-Saving and the Count-Min estimates, as both overestimate the true count.
+        The error is the lowest of the Space-Saving error and the Count-Min error bound.
+        """
+
+        all_time = SpaceSaving(capacity=self.__settings.sketch_capacity)
+        for sketch in self.__sketches["year"].values():
+            all_time.merge(sketch)
+
+        keys, counts, errors = all_time.top(k=all_time.capacity)
+        counts = np.minimum(counts, self.__count_min.estimate(keys))
+        errors = np.minimum(errors, np.floor(self.__count_min.error_bound)).astype(np.int64)
+
+        order = np.argsort(-counts, kind="stable")[:self.__settings.top_routes_of_all_time]
+        return self.__routes_to_frame(keys=keys[order], counts=counts[order], errors=errors[order], count_column="frequency")
+
+    def __rank_routes_per_group(self, group: str, columns: List[str]) -> pd.DataFrame:
+        """ Rank the routes of each group's sketch. """
+
+        frames = []
+        for value, sketch in sorted(self.__sketches[group].items()):
+            keys, counts, errors = sketch.top(k=self.__settings.top_routes_per_period)
+            df = self.__routes_to_frame(keys=keys, counts=counts, errors=errors, count_column="number_of_routes")
+            if group == "month":
+                df.insert(0, "year", value // 100)
+                df.insert(1, "month", value % 100)
+            else:
+                df.insert(0, columns[0], value)
+            frames.append(df)
+
+        if not frames:
+            return pd.DataFrame(columns=columns + ["start_station_name", "end_station_name", "number_of_routes", "number_of_routes_error"])
+        return pd.concat(frames, ignore_index=True)
@@ -0,0 +1,112 @@
+""" Time-valid station dimension with vectorised as-of lookups. """
+
+import os
+from typing import List
+import numpy as np
+import pandas as pd
+
+
+class StationDimension:
+    """
+    The versions of each station of the cycle_stations table, each valid from its install date until its removal date.
+        - A version without an install date is valid since always, and a version without a removal date is still valid.
+        - The versions are sorted by station id and start of validity, and indexed by a single int64 key per version:
+          the position of the station id times (n + 1) plus the rank of the start of validity among the n distinct starts.
+          A ride gets the same kind of key from its station and start date, so a single np.searchsorted over the version keys
+          finds the latest version of its station that started before the ride, for all rides at once.
+        - The dimension is stored as a Parquet file, so the stations existing at any time are answered locally without querying the warehouse.
+
+    :param versions: The station versions, with at least the columns id, install_date and removal_date.
+    """
+
+    FILE = "station_dimension.parquet"
+    # Any time before the first install date and after the last removal date
+    MIN_TIME = np.iinfo(np.int64).min
+    MAX_TIME = np.iinfo(np.int64).max
+
+    def __init__(self, versions: pd.DataFrame):
+        versions = versions.copy()
+        versions["valid_from"] = self.to_int64_times(versions["install_date"], missing=self.MIN_TIME)
+        versions["valid_to"] = self.to_int64_times(versions["removal_date"], missing=self.MAX_TIME)
+        self.versions = versions.sort_values(["id", "valid_from"], kind="stable").reset_index(drop=True)
+
+        self.__station_ids = np.unique(self.versions["id"].to_numpy(dtype=np.int64))
+        self.__starts = np.unique(self.versions["valid_from"].to_numpy())
+        self.__valid_to = self.versions["valid_to"].to_numpy()
+        self.__version_ids = self.versions["id"].to_numpy(dtype=np.int64)
+        self.__keys = self.__key(station_ids=self.__version_ids, times=self.versions["valid_from"].to_numpy())
+
+    @staticmethod
+    def to_int64_times(values, missing: int) -> np.ndarray:
+        """ Convert dates or timestamps into int64 nanoseconds since the epoch, in UTC without time zone. Missing values get the given value. """
+
+        times = pd.to_datetime(pd.Series(values), utc=True).dt.tz_localize(None)
+        return np.where(times.isna(), missing, times.to_numpy(dtype="datetime64[ns]").astype(np.int64))
+
+    def __key(self, station_ids: np.ndarray, times: np.ndarray) -> np.ndarray:
+        """ The sortable key of station ids and times. Unknown stations get the position of the next known station. """
+
+        station_positions = np.searchsorted(self.__station_ids, station_ids)
+        time_ranks = np.searchsorted(self.__starts, times, side="right")
+        return station_positions * (len(self.__starts) + 1) + time_ranks
+
+    def as_of(self, station_ids, times) -> np.ndarray:
+        """
+        Find the version of each station that was valid at each time, for arrays of station ids and times.
+        Return the position of the version in self.versions, or -1 if the station did not exist at that time.
+        """
+
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+        times = self.to_int64_times(times, missing=self.MIN_TIME)
+
+        positions = np.searchsorted(self.__keys, self.__key(station_ids=station_ids, times=times), side="right") - 1
+        candidates = np.maximum(positions, 0)
+        valid = (
+            (positions >= 0)
+            & (self.__version_ids[candidates] == station_ids)
+            & (times < self.__valid_to[candidates])
+        )
+        return np.where(valid, positions, -1)
+
+    def lookup(self, column: str, station_ids, times) -> pd.Series:
+        """ The value of a column of the version of each station valid at each time. Stations that did not exist get a missing value. """
+
+        positions = self.as_of(station_ids=station_ids, times=times)
+        values = self.versions[column].reindex(positions)
+        return values.reset_index(drop=True)
+
+    def existing_between(self, start, end) -> pd.DataFrame:
+        """ The station versions that were valid at any time between start (inclusive) and end (exclusive). """
+
+        start = self.to_int64_times([start], missing=self.MIN_TIME)[0]
+        end = self.to_int64_times([end], missing=self.MAX_TIME)[0]
+        overlaps = (self.versions["valid_from"].to_numpy() < end) & (self.__valid_to > start)
+        return self.versions[overlaps]
+
+    def existing_in_year(self, year: int) -> pd.DataFrame:
+        """ The station versions that existed at any time in the given year. """
+        return self.existing_between(start=f"{year}-01-01", end=f"{year + 1}-01-01")
+
+    def count_per_year(self, years: List[int]) -> pd.DataFrame:
+        """ Count the stations existing in each year, with one vectorised interval overlap test over all years. """
+
+        years = np.asarray(sorted(years), dtype=np.int64)
+        starts = self.to_int64_times([f"{year}-01-01" for year in years], missing=self.MIN_TIME)
+        ends = self.to_int64_times([f"{year + 1}-01-01" for year in years], missing=self.MAX_TIME)
+        overlaps = (self.versions["valid_from"].to_numpy()[None, :] < ends[:, None]) & (self.__valid_to[None, :] > starts[:, None])
+
+        # A station with several versions in a year is counted once
+        station_positions = np.searchsorted(self.__station_ids, self.__version_ids)
+        existing = np.zeros((len(years), len(self.__station_ids)), dtype=bool)
+        rows, columns = np.nonzero(overlaps)
+        existing[rows, station_positions[columns]] = True
+        return pd.DataFrame({"year": years, "number_of_stations": existing.sum(axis=1)})
+
+    def save(self, directory: str):
+        """ Save the station versions as a Parquet file. """
+        self.versions.drop(columns=["valid_from", "valid_to"]).to_parquet(os.path.join(directory, self.FILE), index=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "StationDimension":
+        """ Load the station versions saved by a previous run. """
+        return cls(versions=pd.read_parquet(os.path.join(directory, cls.FILE)))
@@ -0,0 +1,235 @@
+""" Station-to-station distance matrix, and distance, speed and round-trip metrics of the route and destination rankings. """
+
+import hashlib
+import os
+from typing import Optional
+import numpy as np
+import pandas as pd
+
+EARTH_RADIUS_KM = 6371.0088
+
+
+class StationDistanceMatrix:
+    """
+    A memory-mapped float32 matrix of the great-circle distances in km between all stations.
+        - Rows and columns follow the sorted station ids, which are stored next to the matrix and looked up with a hash index.
+        - The matrix is only recomputed when the station ids or coordinates change, which is detected with a hash of the coordinates.
+        - The distances are computed with a vectorised haversine formula, a block of rows at a time, directly into the memory-mapped file.
+
+    :param directory: The directory of the stored matrix.
+    """
+
+    DISTANCES_FILE = "distances.npy"
+    STATION_IDS_FILE = "station_ids.npy"
+    COORDINATES_HASH_FILE = "coordinates_hash.txt"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.distances = np.load(os.path.join(directory, self.DISTANCES_FILE), mmap_mode="r")
+        self.station_ids = np.load(os.path.join(directory, self.STATION_IDS_FILE))
+        self.__station_index = pd.Index(self.station_ids)
+
+    @classmethod
+    def load_or_build(cls, directory: str, stations: pd.DataFrame, block_size: int = 1024) -> "StationDistanceMatrix":
+        """ Load the stored matrix if it was built from the same station coordinates, otherwise rebuild it. """
+
+        stations = stations.dropna(subset=["latitude", "longitude"]).sort_values("id").drop_duplicates(subset="id")
+        station_ids = stations["id"].to_numpy(dtype=np.int64)
+        latitudes = stations["latitude"].to_numpy(dtype=np.float64)
+        longitudes = stations["longitude"].to_numpy(dtype=np.float64)
+
+        coordinates_hash = hashlib.sha1(station_ids.tobytes() + latitudes.tobytes() + longitudes.tobytes()).hexdigest()
+        hash_path = os.path.join(directory, cls.COORDINATES_HASH_FILE)
+        distances_path = os.path.join(directory, cls.DISTANCES_FILE)
+        station_ids_path = os.path.join(directory, cls.STATION_IDS_FILE)
+        if all(os.path.exists(path) for path in (hash_path, distances_path, station_ids_path)):
+            with open(hash_path) as file:
+                if file.read().strip() == coordinates_hash:
+                    return cls(directory=directory)
+
+        # Remove the hash first and write it last, so an interrupted rebuild is never mistaken for a valid matrix.
+        # The files are written to temporary paths and moved into place, so a reader never sees a partial file.
+        if os.path.exists(hash_path):
+            os.remove(hash_path)
+
+        latitudes, longitudes = np.radians(latitudes), np.radians(longitudes)
+        distances = np.lib.format.open_memmap(
+            f"{distances_path}.tmp", mode="w+", dtype=np.float32, shape=(len(station_ids), len(station_ids))
+        )
+        for start in range(0, len(station_ids), block_size):
+            rows = slice(start, start + block_size)
+            distances[rows] = cls.haversine(
+                latitudes[rows, None], longitudes[rows, None], latitudes[None, :], longitudes[None, :]
+            ).astype(np.float32)
+        distances.flush()
+        del distances
+        os.replace(f"{distances_path}.tmp", distances_path)
+
+        with open(f"{station_ids_path}.tmp", "wb") as file:
+            np.save(file, station_ids)
+        os.replace(f"{station_ids_path}.tmp", station_ids_path)
+
+        with open(f"{hash_path}.tmp", "w") as file:
+            file.write(coordinates_hash)
+        os.replace(f"{hash_path}.tmp", hash_path)
+        return cls(directory=directory)
+
+    @staticmethod
+    def haversine(latitudes1, longitudes1, latitudes2, longitudes2) -> np.ndarray:
+        """ The great-circle distance in km between points given in radians, broadcast over the arrays. """
+
+        a = (
+            np.sin((latitudes2 - latitudes1) / 2) ** 2
+            + np.cos(latitudes1) * np.cos(latitudes2) * np.sin((longitudes2 - longitudes1) / 2) ** 2
+        )
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+    def lookup(self, start_station_ids, end_station_ids) -> np.ndarray:
+        """ The distances between pairs of stations. Pairs with an unknown station get NaN. """
+
+        starts = self.__station_index.get_indexer(np.asarray(start_station_ids))
+        ends = self.__station_index.get_indexer(np.asarray(end_station_ids))
+        known = (starts >= 0) & (ends >= 0)
+
+        distances = np.full(len(starts), np.nan, dtype=np.float32)
+        distances[known] = self.distances[starts[known], ends[known]]
+        return distances
+
+
+class RouteMetrics:
+    """
+    Add distance, implied speed and round-trip metrics to the route and destination rankings of the info_tracker object.
+        1. Load or build the StationDistanceMatrix from the coordinates of the cycle_stations table.
+        2. Map the station names of the rankings to station ids, with the names of the route aggregate of the DataAggregator class,
+           or with the names of the cycle_stations table if the aggregate is not available.
+        3. Route rankings get the distance, the average duration, the implied speed and a round-trip flag.
+           Rankings with a year column use the durations of that year, the others the durations of all years.
+        4. Destination rankings get the average distance and speed of the rides ending at the destination from another station,
+           and the share of round trips. They need the route aggregate, as the rankings do not keep the starting stations.
+    The implied speed is the straight-line distance over the riding time, so it underestimates the riding speed,
+    and it is left empty for round trips.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    ROUTE_RANKINGS = ("top_roots_of_all_time", "top_roots_per_year", "top_roots_per_month", "top_roots_per_borough")
+    DESTINATION_RANKINGS = ("top_destinations", "top_destinations_per_year")
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+
+        stations = self.__load_stations()
+        self.matrix = StationDistanceMatrix.load_or_build(directory=self.config.paths2create.station_distances, stations=stations)
+        self.__routes = self.__load_route_aggregate()
+        self.__station_ids_by_name = self.__map_station_names_to_ids(stations=stations)
+
+        for name in self.ROUTE_RANKINGS:
+            ranking = getattr(self.info_tracker, name, None)
+            if ranking is not None and len(ranking) > 0:
+                setattr(self.info_tracker, name, self.add_route_metrics(ranking=ranking))
+
+        if self.__routes is not None:
+            for name in self.DESTINATION_RANKINGS:
+                ranking = getattr(self.info_tracker, name, None)
+                if ranking is not None and len(ranking) > 0:
+                    setattr(self.info_tracker, name, self.add_destination_metrics(ranking=ranking))
+
+    def __load_stations(self) -> pd.DataFrame:
+        """ Load the id, name and coordinates of each station. """
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT id, name, latitude, longitude
+            FROM bigquery-public-data.london_bicycles.{self.config.database.station_table}
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __load_route_aggregate(self) -> Optional[pd.DataFrame]:
+        """ Get the route aggregate from the info tracker, or from the aggregates directory if it was created by a previous run. """
+
+        if self.info_tracker.route_year_aggregate is not None:
+            routes = self.info_tracker.route_year_aggregate
+        else:
+            from ..model_development.data_aggregation import DataAggregator
+            path = os.path.join(self.config.paths2create.aggregates, DataAggregator.ROUTE_YEAR_FILE)
+            if not os.path.exists(path):
+                return None
+            routes = pd.read_parquet(path)
+
+        routes = routes.copy()
+        routes["distance_km"] = self.matrix.lookup(routes["start_station_id"], routes["end_station_id"])
+        return routes
+
+    def __map_station_names_to_ids(self, stations: pd.DataFrame) -> pd.Series:
+        """ Map each station name to a station id. The names of the rides are preferred, as they are the names of the rankings. """
+
+        if self.__routes is not None:
+            names = pd.concat([
+                self.__routes[["start_station_name", "start_station_id"]].set_axis(["name", "id"], axis=1),
+                self.__routes[["end_station_name", "end_station_id"]].set_axis(["name", "id"], axis=1),
+                stations[["name", "id"]],
+            ], ignore_index=True)
+        else:
+            names = stations[["name", "id"]]
+        return names.drop_duplicates(subset="name").set_index("name")["id"]
+
+    def add_route_metrics(self, ranking: pd.DataFrame) -> pd.DataFrame:
+        """ Add the distance, the average duration, the implied speed and the round-trip flag of each ranked route. """
+
+        ranking = ranking.copy()
+        start_ids = self.__station_ids_by_name.reindex(ranking["start_station_name"]).to_numpy()
+        end_ids = self.__station_ids_by_name.reindex(ranking["end_station_name"]).to_numpy()
+
+        ranking["distance_km"] = self.matrix.lookup(np.nan_to_num(start_ids, nan=-1), np.nan_to_num(end_ids, nan=-1)).round(3)
+        ranking["round_trip"] = start_ids == end_ids
+
+        if self.__routes is None:
+            return ranking
+
+        keys = ["year", "start_station_id", "end_station_id"] if "year" in ranking.columns else ["start_station_id", "end_station_id"]
+        totals = self.__routes.groupby(keys, sort=False)[["number_of_rides", "total_duration_in_hours"]].sum()
+        lookup = [ranking["year"].to_numpy(), start_ids, end_ids] if "year" in ranking.columns else [start_ids, end_ids]
+        positions = totals.index.get_indexer(pd.MultiIndex.from_arrays(lookup))
+
+        rides = np.where(positions >= 0, totals["number_of_rides"].to_numpy(dtype=float)[positions], np.nan)
+        hours = np.where(positions >= 0, totals["total_duration_in_hours"].to_numpy(dtype=float)[positions], np.nan)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ranking["average_duration_mins"] = (hours / rides * 60).round(1)
+            speed = ranking["distance_km"].to_numpy(dtype=float) / (hours / rides)
+        ranking["implied_speed_kmh"] = np.where(ranking["round_trip"], np.nan, speed).round(1)
+        return ranking
+
+    def add_destination_metrics(self, ranking: pd.DataFrame) -> pd.DataFrame:
+        """ Add the average distance and speed of the rides ending at each ranked destination, and their share of round trips. """
+
+        # The distance and speed are averaged over the rides between two different stations with known coordinates
+        routes = self.__routes
+        round_trip = routes["start_station_id"] == routes["end_station_id"]
+        measured = routes["distance_km"].notna() & ~round_trip
+        routes = routes.assign(
+            ride_distance_km=(routes["distance_km"] * routes["number_of_rides"]).where(measured, 0),
+            measured_hours=routes["total_duration_in_hours"].where(measured, 0),
+            measured_rides=routes["number_of_rides"].where(measured, 0),
+            round_trips=routes["number_of_rides"].where(round_trip, 0),
+        )
+
+        keys = ["year", "end_station_name"] if "year" in ranking.columns else ["end_station_name"]
+        totals = routes.groupby(keys, sort=False)[["ride_distance_km", "measured_hours", "measured_rides", "round_trips", "number_of_rides"]].sum()
+        lookup = [ranking["year"].to_numpy(), ranking["top_destinations"].to_numpy()] if "year" in ranking.columns else [ranking["top_destinations"].to_numpy()]
+        positions = totals.index.get_indexer(pd.MultiIndex.from_arrays(lookup) if len(lookup) > 1 else pd.Index(lookup[0]))
+        totals = totals.reset_index(drop=True).reindex(positions).to_numpy(dtype=float).T
+        ride_distance, measured_hours, measured_rides, round_trips, rides = totals
+
+        ranking = ranking.copy()
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ranking["average_distance_km"] = (ride_distance / measured_rides).round(3)
+            ranking["implied_speed_kmh"] = (ride_distance / measured_hours).round(1)
+            ranking["round_trip_share"] = (round_trips / rides).round(3)
+        return ranking
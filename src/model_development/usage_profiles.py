@@ -0,0 +1,174 @@
+""" Per-station usage profiles by day of week and hour of day, with station clustering and nearest-neighbour lookup. """
+
+import os
+from typing import List, Tuple
+import numpy as np
+import pandas as pd
+
+
+class StationProfileStore:
+    """
+    A memory-mapped tensor of ride counts, with shape stations x day of week x hour, or stations x years x day of week x hour.
+        - The tensor is stored as float32 in a .npy file, next to the station ids (and years) it is indexed by.
+        - Loading memory-maps the tensor, so only the profiles that are used are read from disk.
+        - The profiles are normalised, clustered and compared with vectorised operations over the whole tensor.
+
+    :param directory: The directory of the stored tensor.
+    """
+
+    PROFILES_FILE = "profiles.npy"
+    STATION_IDS_FILE = "station_ids.npy"
+    YEARS_FILE = "years.npy"
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.profiles = np.load(os.path.join(directory, self.PROFILES_FILE), mmap_mode="r")
+        self.station_ids = np.load(os.path.join(directory, self.STATION_IDS_FILE))
+        years_path = os.path.join(directory, self.YEARS_FILE)
+        self.years = np.load(years_path) if os.path.exists(years_path) else None
+        self.__station_index = pd.Index(self.station_ids)
+
+    @classmethod
+    def save(cls, directory: str, profiles: np.ndarray, station_ids: np.ndarray, years: np.ndarray = None) -> "StationProfileStore":
+        """ Save a profile tensor and return the memory-mapped store. """
+
+        np.save(os.path.join(directory, cls.PROFILES_FILE), profiles.astype(np.float32))
+        np.save(os.path.join(directory, cls.STATION_IDS_FILE), station_ids)
+        years_path = os.path.join(directory, cls.YEARS_FILE)
+        if years is not None:
+            np.save(years_path, years)
+        elif os.path.exists(years_path):
+            os.remove(years_path)
+        return cls(directory=directory)
+
+    def normalised(self, method: str = "share", year: int = None) -> np.ndarray:
+        """
+        Flatten the profiles into a matrix of stations x (7 * 24) and normalise each station.
+            - share: divide by the total rides of the station, so stations of any size are compared by the shape of their usage.
+            - zscore: subtract the mean and divide by the standard deviation of the station.
+        Per-year tensors are summed over the years, unless a year is given.
+        """
+
+        profiles = self.profiles
+        if self.years is not None:
+            profiles = profiles[:, int(np.flatnonzero(self.years == year)[0])] if year is not None else profiles.sum(axis=1)
+        matrix = np.asarray(profiles, dtype=np.float32).reshape(len(self.station_ids), -1)
+
+        if method == "share":
+            totals = matrix.sum(axis=1, keepdims=True)
+            return np.divide(matrix, totals, out=np.zeros_like(matrix), where=totals > 0)
+        if method == "zscore":
+            std = matrix.std(axis=1, keepdims=True)
+            return np.divide(matrix - matrix.mean(axis=1, keepdims=True), std, out=np.zeros_like(matrix), where=std > 0)
+        raise ValueError(f"Unknown normalisation '{method}'. Use 'share' or 'zscore'.")
+
+    def cluster(self, n_clusters: int, method: str = "kmeans", normalisation: str = "share", seed: int = 0) -> pd.DataFrame:
+        """ Cluster the stations by their normalised profiles, with k-means or Ward hierarchical clustering. """
+
+        matrix = self.normalised(method=normalisation)
+
+        if method == "kmeans":
+            from sklearn.cluster import KMeans
+            labels = KMeans(n_clusters=n_clusters, n_init=10, random_state=seed).fit_predict(matrix)
+        elif method == "hierarchical":
+            from scipy.cluster.hierarchy import fcluster, linkage
+            labels = fcluster(linkage(matrix, method="ward"), t=n_clusters, criterion="maxclust") - 1
+        else:
+            raise ValueError(f"Unknown clustering '{method}'. Use 'kmeans' or 'hierarchical'.")
+
+        return pd.DataFrame({"station_id": self.station_ids, "cluster": labels})
+
+    def nearest_stations(self, station_id: int, n: int = 5, normalisation: str = "share") -> List[Tuple[int, float]]:
+        """ Return the n stations with the most similar profile to the given station, by cosine similarity. """
+
+        matrix = self.normalised(method=normalisation)
+        norms = np.linalg.norm(matrix, axis=1)
+        unit = np.divide(matrix, norms[:, None], out=np.zeros_like(matrix), where=norms[:, None] > 0)
+
+        position = self.__station_index.get_loc(station_id)
+        similarity = unit @ unit[position]
+        similarity[position] = -np.inf
+
+        nearest = np.argpartition(-similarity, min(n, len(similarity) - 1))[:n]
+        nearest = nearest[np.argsort(-similarity[nearest])]
+        return [(self.station_ids[i].item(), float(similarity[i])) for i in nearest]
+
+
+class StationUsageProfiler:
+    """
+    Build the usage profile of every station and group the stations by profile.
+        1. Count the rides per starting station, day of week and hour (and year, if configured) in a single aggregation query.
+        2. Scatter the counts into a float32 tensor and store it memory-mapped with the StationProfileStore class.
+        3. Cluster the stations by their normalised profiles and save the clusters in the info_tracker object.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client. Initiated at the beginning of the pipeline.
+    """
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+
+        self.store = self.__build_profile_store(counts=self.__count_rides_per_station_day_n_hour())
+        self.info_tracker.station_usage_clusters = self.store.cluster(
+            n_clusters=self.config.usage_profiles.n_clusters,
+            method=self.config.usage_profiles.clustering,
+            normalisation=self.config.usage_profiles.normalisation,
+            seed=self.config.random_state.seed
+        )
+
+    def __count_rides_per_station_day_n_hour(self) -> pd.DataFrame:
+        """ Count the rides per starting station, day of week (0 is Sunday) and hour of day, and per year if configured. """
+
+        year_select = "EXTRACT(YEAR FROM start_date) AS year," if self.config.usage_profiles.per_year else ""
+        year_group = "year," if self.config.usage_profiles.per_year else ""
+
+        # Build query
+        query_job = self.__gcp_client.query(
+            f"""
+            SELECT
+                start_station_id,
+                {year_select}
+                EXTRACT(DAYOFWEEK FROM start_date) - 1 AS day_of_week,
+                EXTRACT(HOUR FROM start_date) AS hour,
+                COUNT(*) AS number_of_rides
+            FROM
+                bigquery-public-data.london_bicycles.{self.config.database.hire_table}
+            WHERE
+                start_date IS NOT NULL
+                AND start_station_id IS NOT NULL
+            GROUP BY
+                start_station_id,
+                {year_group}
+                day_of_week,
+                hour;
+            """
+        )
+        df = query_job.result().to_dataframe()
+        return df
+
+    def __build_profile_store(self, counts: pd.DataFrame) -> StationProfileStore:
+        """ Scatter the counts into the profile tensor with vectorised indexing and store it. """
+
+        station_ids, station_positions = np.unique(counts["start_station_id"].to_numpy(dtype=np.int64), return_inverse=True)
+        days = counts["day_of_week"].to_numpy(dtype=np.int64)
+        hours = counts["hour"].to_numpy(dtype=np.int64)
+        values = counts["number_of_rides"].to_numpy(dtype=np.float32)
+
+        if self.config.usage_profiles.per_year:
+            years, year_positions = np.unique(counts["year"].to_numpy(dtype=np.int64), return_inverse=True)
+            profiles = np.zeros((len(station_ids), len(years), 7, 24), dtype=np.float32)
+            profiles[station_positions, year_positions, days, hours] = values
+        else:
+            years = None
+            profiles = np.zeros((len(station_ids), 7, 24), dtype=np.float32)
+            profiles[station_positions, days, hours] = values
+
+        return StationProfileStore.save(
+            directory=self.config.paths2create.usage_profiles,
+            profiles=profiles,
+            station_ids=station_ids,
+            years=years
+        )
@@ -0,0 +1,241 @@
+""" In-memory query service over the precomputed aggregates of the London Cycle Hire data. """
+
+import hashlib
+import os
+from typing import Dict, List, Optional, Sequence, Tuple
+import numpy as np
+import pandas as pd
+from ..model_development.data_aggregation import DataAggregator
+
+
+def to_python(value):
+    """ Convert a numpy scalar into the equivalent python object, so query results can be serialised as json. """
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def column_to_numpy(series: pd.Series) -> np.ndarray:
+    """ Convert a column into a plain numpy array. Nullable integer columns without nulls become int64 arrays. """
+    if pd.api.types.is_integer_dtype(series) and not series.isna().any():
+        return series.to_numpy(dtype="int64")
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype="float64", na_value=np.nan)
+    return series.astype(object).to_numpy()
+
+
+class RankedIndex:
+    """
+    Rows of an aggregate, held as numpy arrays and sorted once per partition and metric.
+    The top-n rows of a partition are a slice of the sorted array, so a query does not sort or scan anything.
+
+    :param df: The aggregate to index.
+    :param partition_columns: The columns that define a partition, e.g. ["year"]. An empty list indexes the whole aggregate.
+    :param metrics: The metrics the rows can be ranked by.
+    """
+
+    def __init__(self, df: pd.DataFrame, partition_columns: Sequence[str], metrics: Sequence[str]):
+        self.partition_columns = list(partition_columns)
+        self.columns = {column: column_to_numpy(df[column]) for column in df.columns}
+        self.__orders: Dict[str, np.ndarray] = {}
+        self.__partitions: Dict[Tuple, Tuple[int, int]] = {}
+
+        for metric in metrics:
+            self.__orders[metric] = self.__sort_rows(metric=metric)
+
+        self.__find_partition_boundaries(order=self.__orders[metrics[0]])
+
+    def __sort_rows(self, metric: str) -> np.ndarray:
+        """ Sort the rows by the partition columns and by the metric in descending order. """
+        sort_keys = [-self.columns[metric]] + [self.columns[column] for column in reversed(self.partition_columns)]
+        return np.lexsort(sort_keys)
+
+    def __find_partition_boundaries(self, order: np.ndarray):
+        """ Find the first and the last row of each partition in the sorted rows. The boundaries are the same for every metric. """
+
+        n_rows = len(order)
+        if not self.partition_columns:
+            self.__partitions[()] = (0, n_rows)
+            return
+
+        # A partition starts wherever any partition column changes
+        changes = np.zeros(n_rows, dtype=bool)
+        changes[:1] = True
+        for column in self.partition_columns:
+            values = self.columns[column][order]
+            changes[1:] |= values[1:] != values[:-1]
+        starts = np.flatnonzero(changes)
+        ends = np.append(starts[1:], n_rows)
+
+        for start, end in zip(starts, ends):
+            first_row = order[start]
+            key = tuple(to_python(self.columns[column][first_row]) for column in self.partition_columns)
+            self.__partitions[key] = (int(start), int(end))
+
+    def top(self, n: int, metric: str, key: Tuple = ()) -> List[dict]:
+        """ Return the top n rows of a partition by the given metric. An unknown partition returns no rows. """
+
+        if metric not in self.__orders:
+            raise ValueError(f"Unknown metric '{metric}'. Use one of {list(self.__orders)}.")
+        if key not in self.__partitions:
+            return []
+
+        start, end = self.__partitions[key]
+        rows = self.__orders[metric][start:min(end, start + n)]
+        return [
+            {column: to_python(values[row]) for column, values in self.columns.items()}
+            for row in rows
+        ]
+
+
+class AggregateQueryService:
+    """
+    Load the precomputed aggregates created by the DataAggregator class and answer top-n questions in memory.
+        1. Load the station, route and borough aggregates from the aggregates directory.
+        2. Roll them up per station, destination, route and borough, for all years and per year.
+        3. Index every roll-up with a RankedIndex, so each question is answered with a slice of a sorted array.
+
+    The available questions are:
+        - stations: the busiest starting stations, optionally per year and borough.
+        - destinations: the top destinations, optionally per year.
+        - routes: the most popular routes, optionally per year and starting station.
+        - boroughs: the boroughs with the most rides or riding duration, optionally per year.
+
+    :param aggregates_dir: The directory where the DataAggregator class saved the aggregates.
+    """
+
+    METRICS = ("number_of_rides", "total_duration_in_hours")
+
+    def __init__(self, aggregates_dir: str):
+        self.aggregates_dir = aggregates_dir
+        self.version = self.__compute_version()
+        self.__indexes: Dict[Tuple[str, Tuple[str, ...]], RankedIndex] = {}
+
+        station_year_hour = pd.read_parquet(os.path.join(aggregates_dir, DataAggregator.STATION_YEAR_HOUR_FILE))
+        route_year = pd.read_parquet(os.path.join(aggregates_dir, DataAggregator.ROUTE_YEAR_FILE))
+        station_borough = self.__load_station_borough_mapping()
+
+        self.__index_stations(station_year_hour=station_year_hour, station_borough=station_borough)
+        self.__index_destinations(route_year=route_year)
+        self.__index_routes(route_year=route_year)
+        if station_borough is not None:
+            self.__index_boroughs(station_year_hour=station_year_hour, station_borough=station_borough)
+
+    def __compute_version(self) -> str:
+        """ Hash the name, size and modification time of the aggregate files. The version changes whenever the aggregates are rebuilt. """
+
+        digest = hashlib.sha1()
+        for file_name in sorted(os.listdir(self.aggregates_dir)):
+            stat = os.stat(os.path.join(self.aggregates_dir, file_name))
+            digest.update(f"{file_name}:{stat.st_size}:{stat.st_mtime_ns};".encode())
+        return digest.hexdigest()
+
+    def __load_station_borough_mapping(self) -> Optional[pd.DataFrame]:
+        """ Load the station to borough mapping, if it was saved by the DataAggregator class. """
+        path = os.path.join(self.aggregates_dir, DataAggregator.STATION_BOROUGH_FILE)
+        if not os.path.exists(path):
+            return None
+        return pd.read_parquet(path)
+
+    def __add_index(self, dimension: str, df: pd.DataFrame, partitions: Sequence[Sequence[str]]):
+        """ Index a roll-up once for every partitioning of the given dimension. """
+        for partition_columns in partitions:
+            self.__indexes[(dimension, tuple(partition_columns))] = RankedIndex(
+                df=df,
+                partition_columns=partition_columns,
+                metrics=self.METRICS
+            )
+
+    @classmethod
+    def __roll_up(cls, df: pd.DataFrame, by: List[str]) -> pd.DataFrame:
+        """ Sum the metrics of an aggregate over the given columns. """
+        return df.groupby(by, as_index=False, sort=False, dropna=False)[list(cls.METRICS)].sum()
+
+    @staticmethod
+    def __canonical_names(df: pd.DataFrame, prefixes: Sequence[str]) -> pd.Series:
+        """
+        One name per station id, from the id and name columns of the given prefixes (e.g. "start_station"): the name of its latest year.
+        The aggregates keep any name of a station per group, so a renamed station has several names over the years.
+        """
+        names = pd.concat(
+            [df[["year", f"{prefix}_id", f"{prefix}_name"]].set_axis(["year", "id", "name"], axis=1) for prefix in prefixes],
+            ignore_index=True
+        )
+        return names.sort_values("year", kind="stable").groupby("id")["name"].last()
+
+    @staticmethod
+    def __add_names(rolled_up: pd.DataFrame, names: pd.Series, prefixes: Sequence[str]) -> pd.DataFrame:
+        """ Attach the canonical name of the station id column of every given prefix to a roll-up. """
+        for prefix in prefixes:
+            rolled_up[f"{prefix}_name"] = names.reindex(rolled_up[f"{prefix}_id"]).to_numpy()
+        return rolled_up
+
+    def __index_stations(self, station_year_hour: pd.DataFrame, station_borough: Optional[pd.DataFrame]):
+        """ Index the starting stations, for all years and per year, and per borough if the mapping is available. """
+
+        names = self.__canonical_names(df=station_year_hour, prefixes=["start_station"])
+        per_year = self.__roll_up(df=station_year_hour, by=["year", "start_station_id"])
+        per_year["start_station_name"] = names.reindex(per_year["start_station_id"]).to_numpy()
+        partitions = [["year"]]
+
+        if station_borough is not None:
+            boroughs = station_borough.set_index("id")["borough_name"]
+            per_year["borough_name"] = boroughs.reindex(per_year["start_station_id"]).fillna("no_borough").to_numpy()
+            partitions.append(["year", "borough_name"])
+
+        all_time = self.__roll_up(df=per_year, by=[column for column in per_year.columns if column not in self.METRICS and column != "year"])
+        self.__add_index(dimension="stations", df=per_year, partitions=partitions)
+        self.__add_index(dimension="stations", df=all_time, partitions=[[]] + ([["borough_name"]] if station_borough is not None else []))
+
+    def __index_destinations(self, route_year: pd.DataFrame):
+        """ Index the end stations, for all years and per year. The roll-ups are by station id, with one name per station. """
+
+        names = self.__canonical_names(df=route_year, prefixes=["start_station", "end_station"])
+        per_year = self.__add_names(rolled_up=self.__roll_up(df=route_year, by=["year", "end_station_id"]), names=names, prefixes=["end_station"])
+        all_time = self.__add_names(rolled_up=self.__roll_up(df=per_year, by=["end_station_id"]), names=names, prefixes=["end_station"])
+        self.__add_index(dimension="destinations", df=per_year, partitions=[["year"]])
+        self.__add_index(dimension="destinations", df=all_time, partitions=[[]])
+
+    def __index_routes(self, route_year: pd.DataFrame):
+        """ Index the routes, for all years and per year, and per starting station. The roll-ups are by station ids, with one name per station. """
+
+        prefixes = ["start_station", "end_station"]
+        names = self.__canonical_names(df=route_year, prefixes=prefixes)
+        per_year = self.__add_names(rolled_up=self.__roll_up(df=route_year, by=["year", "start_station_id", "end_station_id"]), names=names, prefixes=prefixes)
+        all_time = self.__add_names(rolled_up=self.__roll_up(df=route_year, by=["start_station_id", "end_station_id"]), names=names, prefixes=prefixes)
+        self.__add_index(dimension="routes", df=per_year, partitions=[["year"], ["year", "start_station_id"]])
+        self.__add_index(dimension="routes", df=all_time, partitions=[[], ["start_station_id"]])
+
+    def __index_boroughs(self, station_year_hour: pd.DataFrame, station_borough: pd.DataFrame):
+        """ Index the boroughs, for all years and per year. The station ids are mapped to boroughs with a hash lookup. """
+
+        boroughs = station_borough.set_index("id")["borough_name"]
+        with_borough = station_year_hour.assign(
+            borough_name=boroughs.reindex(station_year_hour["start_station_id"]).fillna("no_borough").to_numpy()
+        )
+        per_year = self.__roll_up(df=with_borough, by=["year", "borough_name"])
+        all_time = self.__roll_up(df=per_year, by=["borough_name"])
+        self.__add_index(dimension="boroughs", df=per_year, partitions=[["year"]])
+        self.__add_index(dimension="boroughs", df=all_time, partitions=[[]])
+
+    @property
+    def dimensions(self) -> List[str]:
+        """ The dimensions that can be queried. """
+        return sorted({dimension for dimension, _ in self.__indexes})
+
+    def top(self, dimension: str, n: int = 10, metric: str = "number_of_rides", year: int = None,
+            station_id: int = None, borough: str = None) -> List[dict]:
+        """
+        Return the top n rows of a dimension by the given metric.
+        The optional filters select the partition to rank, e.g. the routes of a starting station in a given year.
+        """
+
+        filters = {"year": year, "start_station_id": station_id, "borough_name": borough}
+        partition_columns = tuple(column for column, value in filters.items() if value is not None)
+
+        index = self.__indexes.get((dimension, partition_columns))
+        if index is None:
+            raise ValueError(
+                f"Dimension '{dimension}' cannot be filtered by {list(partition_columns) or 'nothing'}. "
+                f"Available dimensions: {self.dimensions}."
+            )
+
+        return index.top(n=n, metric=metric, key=tuple(filters[column] for column in partition_columns))
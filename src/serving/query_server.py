@@ -0,0 +1,99 @@
+""" HTTP endpoint of the analytics query service, with ETag caching. """
+
+import hashlib
+import json
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlsplit
+from ..serving.aggregate_store import AggregateQueryService
+
+
+class AggregateQueryServer:
+    """
+    Serve the AggregateQueryService over HTTP.
+        - GET /dimensions returns the dimensions that can be queried.
+        - GET /top/<dimension>?n=10&metric=number_of_rides&year=2015&station_id=1&borough=Camden returns the top n rows.
+
+    The responses only change when the aggregates are rebuilt, so the ETag is derived from the aggregates version and the request,
+    without computing the response. A request with a matching If-None-Match header is answered with 304 Not Modified.
+
+    :param service: The query service to serve.
+    :param host: The host to bind to.
+    :param port: The port to listen on.
+    :param max_age_secs: The max-age of the Cache-Control header.
+    """
+
+    INTEGER_PARAMETERS = ("n", "year", "station_id")
+
+    def __init__(self, service: AggregateQueryService, host: str, port: int, max_age_secs: int):
+        self.service = service
+        self.max_age_secs = max_age_secs
+        self.httpd = ThreadingHTTPServer((host, port), self.__make_handler())
+
+    def __make_handler(self):
+        """ Create the request handler class, bound to this server. """
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                etag = server.etag(path=self.path)
+                if self.headers.get("If-None-Match") == etag:
+                    self.send_response(304)
+                    self.send_header("ETag", etag)
+                    self.end_headers()
+                    return
+
+                status, body = server.answer(path=self.path)
+                payload = json.dumps(body).encode()
+
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(payload)))
+                if status == 200:
+                    self.send_header("ETag", etag)
+                    self.send_header("Cache-Control", f"max-age={server.max_age_secs}")
+                self.end_headers()
+                self.wfile.write(payload)
+
+            def log_message(self, format, *args):
+                # The dashboard polls constantly, so requests are not logged
+                pass
+
+        return Handler
+
+    def etag(self, path: str) -> str:
+        """ Derive the ETag of a request from the aggregates version and the normalised request. """
+
+        url = urlsplit(path)
+        query = sorted(parse_qs(url.query).items())
+        digest = hashlib.sha1(f"{self.service.version}|{url.path}|{query}".encode()).hexdigest()
+        return f'"{digest}"'
+
+    def answer(self, path: str):
+        """ Answer a request. Return the HTTP status and the json body. """
+
+        url = urlsplit(path)
+        parts = [part for part in url.path.split("/") if part]
+
+        if parts == ["dimensions"]:
+            return 200, self.service.dimensions
+
+        if len(parts) != 2 or parts[0] != "top":
+            return 404, {"error": f"Unknown path '{url.path}'."}
+
+        try:
+            parameters = {name: values[-1] for name, values in parse_qs(url.query).items()}
+            for name in self.INTEGER_PARAMETERS:
+                if name in parameters:
+                    parameters[name] = int(parameters[name])
+            return 200, self.service.top(dimension=parts[1], **parameters)
+        except (TypeError, ValueError) as error:
+            return 400, {"error": str(error)}
+
+    def serve_forever(self):
+        """ Serve requests until the process is stopped. """
+        try:
+            self.httpd.serve_forever()
+        finally:
+            self.httpd.server_close()
@@ -0,0 +1,175 @@
+""" Streaming demand monitoring: count the rentals of every station as they arrive and classify the demand as each hour closes. """
+
+import os
+from datetime import datetime, timezone
+from typing import Dict, List
+import numpy as np
+import pandas as pd
+from ..streaming.event_sources import RentalEventReplay, SocketEventSource
+from ..streaming.hourly_counters import SECONDS_PER_HOUR, HourlyRingBuffer
+
+
+class StreamingDemandMonitor:
+    """
+    Consume a rental event feed and raise same-hour demand alerts.
+        1. Read the events from the replay file of cycle_hire rows (exported on the first run) or from a socket feed.
+        2. Count them per station and hour in the fixed-size arrays of the HourlyRingBuffer class.
+        3. When an hour closes, classify the observed demand of every station with the classes of the DataEngineer class,
+           and predict the class of the next hour, from the rolling features or with a saved H2O model if configured.
+        4. Alert on the stations whose observed or predicted demand reaches the alert class, and save the alerts in the info_tracker object.
+        5. If enabled, score every closed hour against the seasonal baselines of the DemandAnomalyDetector class, alert on the anomalies,
+           and update the baselines with the closed hour. The updated baselines are saved when the feed ends.
+
+    :param config: An object that reads the pipeline configurations from a yaml file and load them. Initiated at the beginning of the pipeline.
+    :param info_tracker: An object that is used throughout the pipeline to track useful information. Initiated at the beginning of the pipeline.
+    :param gcp_client: A Google Cloud Platform client, only used to export the replay file. Initiated at the beginning of the pipeline.
+    """
+
+    REPLAY_FILE = "rental_events.parquet"
+    CLASS_NAMES = np.array(["low", "medium", "high"])
+
+    def __init__(self, config, info_tracker, gcp_client):
+        self.config = config
+        self.info_tracker = info_tracker
+        self.__gcp_client = gcp_client
+        self.__settings = self.config.streaming
+
+        self.buffer = HourlyRingBuffer(max_station_id=self.__settings.max_station_id, window_hours=self.__settings.window_hours)
+        self.__thresholds = np.asarray(self.__settings.class_thresholds, dtype=np.float32)
+        self.__model = self.__load_model()
+        self.__baseline = self.__load_baseline()
+        self.alerts: List[Dict] = []
+
+        for timestamps, station_ids in self.__event_batches():
+            for hour, counts in self.buffer.update(timestamps=timestamps, station_ids=station_ids):
+                self.__on_hour_closed(hour=hour, counts=counts)
+
+        # The feed ended, so the open hour is complete
+        if self.buffer.current_hour is not None:
+            hour, counts = self.buffer.close_hour()
+            self.__on_hour_closed(hour=hour, counts=counts)
+        if self.__baseline is not None:
+            self.__baseline.save(directory=self.config.paths2create.demand_anomalies)
+
+        self.info_tracker.demand_alerts = pd.DataFrame(
+            self.alerts,
+            columns=["hour", "start_station_id", "kind", "demand_class", "rental_count", "expected_count"]
+        )
+
+    def __event_batches(self):
+        """ Select the event feed of the configuration. """
+
+        if self.__settings.source == "file":
+            replay = RentalEventReplay(path=os.path.join(self.config.paths2create.streaming, self.REPLAY_FILE))
+            if not replay.exists:
+                replay.export(config=self.config, gcp_client=self.__gcp_client)
+            return replay.batches(batch_size=self.__settings.batch_size, speedup=self.__settings.replay_speedup)
+        if self.__settings.source == "socket":
+            return SocketEventSource(host=self.__settings.host, port=self.__settings.port, batch_size=self.__settings.batch_size).batches()
+        raise ValueError(f"Unknown streaming source '{self.__settings.source}'. Use 'file' or 'socket'.")
+
+    def __load_model(self):
+        """ Load the saved H2O model of the configuration, if any. The rolling features are used otherwise. """
+
+        if not self.__settings.model_path:
+            return None
+
+        # Imported here to avoid initiating h2o unless a model is configured
+        import h2o
+        h2o.init()
+        return h2o.load_model(self.__settings.model_path)
+
+    def __load_baseline(self):
+        """ Load the seasonal baselines saved by the 'anomalies' stage, if enabled and saved. """
+
+        from ..model_development.demand_anomalies import SeasonalBaseline
+
+        if not self.config.demand_anomalies.streaming or not SeasonalBaseline.exists(directory=self.config.paths2create.demand_anomalies):
+            return None
+        return SeasonalBaseline.load(directory=self.config.paths2create.demand_anomalies)
+
+    def classify(self, counts: np.ndarray) -> np.ndarray:
+        """ Bin rental counts into the demand classes of the DataEngineer class: up to the first threshold is low, above the last is high. """
+        return np.digitize(counts, self.__thresholds, right=True)
+
+    def __predict_next_hour(self, hour: int, stations: np.ndarray):
+        """ Predict the demand class of the next hour, and the expected rental count when it is predicted from the rolling features. """
+
+        if self.__model is not None:
+            next_hour = datetime.fromtimestamp((hour + 1) * SECONDS_PER_HOUR, tz=timezone.utc)
+            return self.__predict_with_model(next_hour=next_hour, stations=stations), np.full(len(stations), np.nan)
+
+        # The expected count is the mean of the available features: the last 3 hours, and the same hour one day and one week earlier
+        features = self.buffer.features(hour=hour)[stations, 1:]
+        available = ~np.isnan(features)
+        expected = np.where(available, features, 0).sum(axis=1) / np.maximum(available.sum(axis=1), 1)
+        return self.classify(expected), expected
+
+    def __predict_with_model(self, next_hour: datetime, stations: np.ndarray) -> np.ndarray:
+        """ Predict the demand class of the next hour with the H2O model, which is trained on the attributes of the DataEngineer class. """
+
+        import h2o
+        frame = h2o.H2OFrame(pd.DataFrame({
+            "start_station_id": stations,
+            "year": next_hour.year,
+            "month": next_hour.month,
+            "day": next_hour.day,
+            "hour": next_hour.hour,
+        }))
+        predictions = self.__model.predict(frame).as_data_frame(use_pandas=True)
+        return predictions["predict"].to_numpy(dtype=np.int64)
+
+    def __on_hour_closed(self, hour: int, counts: np.ndarray):
+        """ Classify the closed hour, predict the next hour and raise the alerts. """
+
+        stations = np.flatnonzero(self.buffer.seen)
+        observed = self.classify(counts[stations])
+        predicted, expected = self.__predict_next_hour(hour=hour, stations=stations)
+
+        if self.__baseline is not None:
+            self.__raise_anomaly_alerts(hour=hour, counts=counts)
+
+        alert_class = self.__settings.alert_class
+        for kind, alert_hour, classes in (("observed", hour, observed), ("predicted", hour + 1, predicted)):
+            for position in np.flatnonzero(classes >= alert_class):
+                alert = {
+                    "hour": pd.Timestamp(alert_hour * SECONDS_PER_HOUR, unit="s", tz="UTC"),
+                    "start_station_id": int(stations[position]),
+                    "kind": kind,
+                    "demand_class": int(classes[position]),
+                    "rental_count": int(counts[stations[position]]) if kind == "observed" else None,
+                    "expected_count": float(expected[position]) if kind == "predicted" else None,
+                }
+                self.alerts.append(alert)
+                if self.config.show_outcome.show_outcome:
+                    print(
+                        f"{alert['hour']:%Y-%m-%d %H:00} station {alert['start_station_id']}: "
+                        f"{kind} {self.CLASS_NAMES[min(alert['demand_class'], len(self.CLASS_NAMES) - 1)]} demand"
+                    )
+
+    def __raise_anomaly_alerts(self, hour: int, counts: np.ndarray):
+        """ Score the closed hour against the seasonal baselines, update them, and alert on the anomalies. """
+
+        # The baseline stations beyond the counted station ids were not observed
+        station_ids = self.__baseline.station_ids
+        counted = station_ids < len(counts)
+        observed = np.where(counted, counts[np.where(counted, station_ids, 0)], np.nan)
+
+        settings = self.config.demand_anomalies
+        scores, median, _, weeks = self.__baseline.update(hour=hour, counts=observed, min_mad=settings.min_mad)
+        for position in np.flatnonzero((np.abs(scores) >= settings.threshold) & (weeks >= settings.min_weeks)):
+            alert = {
+                "hour": pd.Timestamp(hour * SECONDS_PER_HOUR, unit="s", tz="UTC"),
+                "start_station_id": int(station_ids[position]),
+                "kind": "anomaly",
+                "demand_class": int(self.classify(observed[position])),
+                "rental_count": int(observed[position]),
+                "expected_count": float(median[position]),
+            }
+            self.alerts.append(alert)
+            if self.config.show_outcome.show_outcome:
+                direction = "spike" if scores[position] > 0 else "drop"
+                print(
+                    f"{alert['hour']:%Y-%m-%d %H:00} station {alert['start_station_id']}: "
+                    f"demand {direction} of {alert['rental_count']} rentals, {alert['expected_count']:.0f} expected"
+                )
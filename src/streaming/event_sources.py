@@ -0,0 +1,162 @@
+""" Rental event feeds: a local replay of cycle_hire rows from a file or over a socket. """
+
+import os
+import socket
+import socketserver
+import time
+from typing import Iterator, Tuple
+import numpy as np
+
+# A batch of rental events, as epoch seconds and starting station ids
+EventBatch = Tuple[np.ndarray, np.ndarray]
+
+
+class RentalEventReplay:
+    """
+    Export a window of cycle_hire rows as a replay file of rental events, ordered by start time.
+    The file stands in for the live rental event feed, either read directly or served over a socket.
+
+    :param path: The path of the replay Parquet file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    @property
+    def exists(self) -> bool:
+        return os.path.exists(self.path)
+
+    def export(self, config, gcp_client):
+        """ Export the start time and the starting station of the rentals of the configured replay window. """
+
+        # Build query
+        query_job = gcp_client.query(
+            f"""
+            SELECT
+                UNIX_SECONDS(start_date) AS start_time,
+                start_station_id
+            FROM
+                bigquery-public-data.london_bicycles.{config.database.hire_table}
+            WHERE
+                start_date >= TIMESTAMP('{config.streaming.replay_start}')
+                AND start_date < TIMESTAMP_ADD(TIMESTAMP('{config.streaming.replay_start}'), INTERVAL {config.streaming.replay_days} DAY)
+                AND start_station_id IS NOT NULL
+            ORDER BY
+                start_time
+            """
+        )
+        query_job.result().to_dataframe().to_parquet(self.path, index=False)
+
+    def batches(self, batch_size: int, speedup: float = 0) -> Iterator[EventBatch]:
+        """
+        Read the replay file in batches of events.
+        With a speedup, the batches are paced so that an hour of events takes 3600 / speedup seconds, otherwise they are read as fast as possible.
+        """
+
+        import pyarrow.parquet as pq
+
+        replay_start = None
+        clock_start = time.monotonic()
+        for batch in pq.ParquetFile(self.path).iter_batches(batch_size=batch_size, columns=["start_time", "start_station_id"]):
+            timestamps = batch.column("start_time").to_numpy(zero_copy_only=False).astype(np.int64)
+            station_ids = batch.column("start_station_id").to_numpy(zero_copy_only=False).astype(np.int64)
+            if len(timestamps) == 0:
+                continue
+
+            if speedup > 0:
+                replay_start = timestamps[0] if replay_start is None else replay_start
+                delay = (timestamps[-1] - replay_start) / speedup - (time.monotonic() - clock_start)
+                if delay > 0:
+                    time.sleep(delay)
+
+            yield timestamps, station_ids
+
+
+class SocketEventSource:
+    """
+    Read rental events from a TCP feed of "start_time,start_station_id" lines, with the start time in epoch seconds.
+    The lines are parsed in batches of up to batch_size events. A batch is also returned when the feed pauses,
+    so that the hours keep closing while the feed is slow.
+
+    :param host: The host of the feed.
+    :param port: The port of the feed.
+    :param batch_size: The maximum number of events per batch.
+    :param idle_timeout_secs: The pause after which a partial batch is returned.
+    """
+
+    def __init__(self, host: str, port: int, batch_size: int, idle_timeout_secs: float = 1.0):
+        self.host = host
+        self.port = port
+        self.batch_size = batch_size
+        self.idle_timeout_secs = idle_timeout_secs
+
+    def batches(self) -> Iterator[EventBatch]:
+        """ Read the feed until it is closed. """
+
+        with socket.create_connection((self.host, self.port)) as connection:
+            connection.settimeout(self.idle_timeout_secs)
+            buffer = b""
+            lines = []
+            closed = False
+            while not closed:
+                try:
+                    chunk = connection.recv(1 << 16)
+                    closed = not chunk
+                    buffer += chunk
+                    *complete, buffer = buffer.split(b"\n")
+                    lines.extend(line for line in complete if line)
+                except socket.timeout:
+                    pass
+                else:
+                    if len(lines) < self.batch_size and not closed:
+                        continue
+
+                while lines:
+                    batch, lines = lines[:self.batch_size], lines[self.batch_size:]
+                    yield self.parse(batch)
+
+    @staticmethod
+    def parse(lines) -> EventBatch:
+        """ Parse "start_time,start_station_id" lines into arrays. """
+        values = np.array(b",".join(lines).split(b","), dtype=np.int64).reshape(-1, 2)
+        return values[:, 0], values[:, 1]
+
+
+class ReplayFeedServer:
+    """
+    Serve a replay file as a TCP feed of "start_time,start_station_id" lines, which stands in for the live rental event feed.
+    Every connection receives the whole replay, paced like RentalEventReplay.batches.
+
+    :param replay: The replay to serve.
+    :param host: The host to bind to.
+    :param port: The port to listen on.
+    :param batch_size: The number of events read from the file at a time.
+    :param speedup: The replay speed, as replayed seconds per second. Zero sends the events as fast as possible.
+    """
+
+    def __init__(self, replay: RentalEventReplay, host: str, port: int, batch_size: int, speedup: float = 0):
+        self.replay = replay
+        self.batch_size = batch_size
+        self.speedup = speedup
+        self.server = socketserver.ThreadingTCPServer((host, port), self.__make_handler())
+
+    def __make_handler(self):
+        """ Create the request handler class, bound to this server. """
+
+        server = self
+
+        class Handler(socketserver.StreamRequestHandler):
+
+            def handle(self):
+                for timestamps, station_ids in server.replay.batches(batch_size=server.batch_size, speedup=server.speedup):
+                    lines = np.char.add(np.char.add(timestamps.astype(str), ","), station_ids.astype(str))
+                    self.wfile.write(("\n".join(lines.tolist()) + "\n").encode())
+
+        return Handler
+
+    def serve_forever(self):
+        """ Serve connections until the process is stopped. """
+        try:
+            self.server.serve_forever()
+        finally:
+            self.server.server_close()
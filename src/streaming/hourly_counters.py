@@ -0,0 +1,106 @@
+""" Per-station ring buffers of hourly rental counts, with rolling demand features. """
+
+from typing import List, Tuple
+import numpy as np
+
+SECONDS_PER_HOUR = 3600
+
+
+class HourlyRingBuffer:
+    """
+    Count the rentals of every station per hour in a fixed-size ring buffer.
+        - The counts are stored in a stations x window_hours array, indexed by station id and by hour modulo the window,
+          so the memory does not grow with the length of the stream.
+        - Events are counted in batches with np.bincount. The open hour closes when an event of a later hour arrives,
+          and the slot of the next hour is reset.
+        - Late events of a closed hour are still counted while the hour is in the window, but the hour is not closed again.
+        - Events of unknown stations (ids above max_station_id) or of hours that left the window are dropped and counted.
+
+    :param max_station_id: The highest station id that is counted.
+    :param window_hours: The number of hours kept per station.
+    """
+
+    def __init__(self, max_station_id: int, window_hours: int):
+        self.n_stations = max_station_id + 1
+        self.window_hours = window_hours
+        self.counts = np.zeros((self.n_stations, window_hours), dtype=np.int32)
+        self.seen = np.zeros(self.n_stations, dtype=bool)
+        self.current_hour = None
+        self.first_hour = None
+        self.n_dropped = 0
+
+    def update(self, timestamps: np.ndarray, station_ids: np.ndarray) -> List[Tuple[int, np.ndarray]]:
+        """
+        Count a batch of events, given as epoch seconds and station ids.
+        Return the hours closed by the batch, as pairs of the epoch hour and the counts of every station in that hour.
+        """
+
+        hours = np.asarray(timestamps, dtype=np.int64) // SECONDS_PER_HOUR
+        station_ids = np.asarray(station_ids, dtype=np.int64)
+
+        known = (station_ids >= 0) & (station_ids < self.n_stations)
+        self.n_dropped += int((~known).sum())
+        hours, station_ids = hours[known], station_ids[known]
+        if len(hours) == 0:
+            return []
+
+        if self.current_hour is None:
+            self.current_hour = self.first_hour = int(hours.min())
+
+        order = np.argsort(hours, kind="stable")
+        hours, station_ids = hours[order], station_ids[order]
+        unique_hours, starts = np.unique(hours, return_index=True)
+        ends = np.append(starts[1:], len(hours))
+
+        closed = []
+        for hour, start, end in zip(unique_hours.tolist(), starts, ends):
+            while self.current_hour < hour:
+                closed.append(self.close_hour())
+            self.__count(hour=hour, station_ids=station_ids[start:end])
+        return closed
+
+    def __count(self, hour: int, station_ids: np.ndarray):
+        """ Add the events of one hour to its slot, unless the hour already left the window. """
+
+        if hour <= self.current_hour - self.window_hours:
+            self.n_dropped += len(station_ids)
+            return
+        self.counts[:, hour % self.window_hours] += np.bincount(station_ids, minlength=self.n_stations).astype(np.int32)
+        self.seen[station_ids] = True
+
+    def close_hour(self) -> Tuple[int, np.ndarray]:
+        """ Close the open hour and open the next one. Return the closed hour and a copy of its counts. """
+
+        hour = self.current_hour
+        counts = self.counts[:, hour % self.window_hours].copy()
+        self.current_hour += 1
+        self.counts[:, self.current_hour % self.window_hours] = 0
+        return hour, counts
+
+    def lag(self, hour: int, hours_back: int) -> np.ndarray:
+        """ The counts of every station hours_back hours before the given hour, or NaN if that hour is not in the buffer. """
+
+        lagged = hour - hours_back
+        if hours_back >= self.window_hours or self.first_hour is None or lagged < self.first_hour:
+            return np.full(self.n_stations, np.nan, dtype=np.float32)
+        return self.counts[:, lagged % self.window_hours].astype(np.float32)
+
+    def rolling_mean(self, hour: int, n_hours: int) -> np.ndarray:
+        """ The mean counts of every station over the n_hours hours ending with the given hour, over the hours in the buffer. """
+
+        first = max(hour - n_hours + 1, self.first_hour, hour - self.window_hours + 1)
+        slots = np.arange(first, hour + 1) % self.window_hours
+        return self.counts[:, slots].mean(axis=1, dtype=np.float32)
+
+    def features(self, hour: int) -> np.ndarray:
+        """
+        The rolling features of every station for the hour after the given closed hour, as a stations x 4 float32 array:
+        the count of the closed hour, the mean of the last 3 hours, and the counts of the next hour one day and one week earlier.
+        """
+
+        return np.column_stack([
+            self.counts[:, hour % self.window_hours].astype(np.float32),
+            self.rolling_mean(hour=hour, n_hours=3),
+            self.lag(hour=hour + 1, hours_back=24),
+            self.lag(hour=hour + 1, hours_back=168),
+        ])